@@ -1,36 +1,122 @@
+import argparse
 import sys
-from PyQt5.QtWidgets import QApplication
-from pdf2image import convert_from_path
 
-from src.analyze_process import process_ocr_result
-from src.GUIs.mainWindow import MainWindow
+# Only cheap imports up here, the GUI, OpenCV and the OCR engines are imported where they are needed
+from src.ocr import DEFAULT_CONFIGS, EASYOCR_CONFIG, PADDLE_CONFIG
+from src.preprocess import DEFAULT_PREPROCESS, STEPS
 
 
-import easyocr
+def main(use_cache=True, engine="paddleocr", preprocess=None, trace=None, metrics=None, sample_profile=None,
+         project=None):
+    from PyQt5.QtCore import QTimer
+    from PyQt5.QtWidgets import QApplication
+    from src.GUIs.mainWindow import MainWindow
+    from src.instrumentation import recording
+    from src.startup_profile import profiling_requested, report_window_visible
 
-from paddleocr import PaddleOCR
+    profiling = profiling_requested()
+    app = QApplication(sys.argv)
+    with recording(trace=trace, metrics=metrics, sample_profile=sample_profile):
+        window = MainWindow(use_cache=use_cache, engine_config=DEFAULT_CONFIGS[engine], preprocess=preprocess)
+        window.show()
+        if project:
+            window.open_project(project)
+        if profiling:
+            QTimer.singleShot(0, lambda: report_window_visible(app))
+        exit_code = app.exec_()
+    sys.exit(exit_code)
 
+def batch(args):
+    from src.batch import run_batch
+    from src.instrumentation import recording
 
-def main():
-    app = QApplication(sys.argv)
-    window = MainWindow()
-    window.show()
-    sys.exit(app.exec_())
+    with recording(trace=args.trace, metrics=args.metrics, sample_profile=args.sample_profile):
+        failed = run_batch(args.input_dir, args.out, key=args.key, key_from_name=args.key_from_filename,
+                           workers=args.workers, use_cache=not args.no_cache,
+                           engine_config=DEFAULT_CONFIGS[args.engine], detect_sections=args.sections == "auto",
+                           preprocess=args.preprocess, songbook=args.songbook)
+    sys.exit(1 if failed else 0)
+
+def ocr_test(engine_config):
+    import cv2
+    from src.analyze_process import process_detections
+    from src.detections import Detections
+    from src.ocr import create_engine
+
+    engine = create_engine(engine_config)
+    image = cv2.imread('examples/1.png')
+    final_json = process_detections(Detections.from_records(engine.detect(image)), 'G', 'test')
 
 def easy_ocr_test():
-    reader = easyocr.Reader(['de', 'en'])
-    result = reader.readtext('examples/1.png')
-    final_json = process_ocr_result(result, 'G', 'test')
+    ocr_test(EASYOCR_CONFIG)
 
 
 
 def paddle_ocr_test():
-    # Initialize PaddleOCR
-    ocr = PaddleOCR(use_angle_cls=True, lang='en')  # Set 'lang' to the desired language
-    results = ocr.ocr('examples/1.png')
-    
-    final_json = process_ocr_result(results, 'G', 'test')
-        
+    ocr_test(PADDLE_CONFIG)
+
+
+def preprocess_steps(value):
+    """`--preprocess` value: 'default' or a comma separated list of steps -> preprocessing config."""
+    if value == "default":
+        return dict(DEFAULT_PREPROCESS)
+    steps = [step.strip() for step in value.split(",") if step.strip()]
+    unknown = [step for step in steps if step not in STEPS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown steps {', '.join(unknown)}, available: {', '.join(STEPS)}")
+    return dict(DEFAULT_PREPROCESS, steps=steps)
+
+
+def add_instrumentation_args(parser):
+    parser.add_argument("--trace", metavar="PATH", help="Write a Chrome trace json of all spans (chrome://tracing, Perfetto)")
+    parser.add_argument("--metrics", metavar="PATH", help="Write span totals and counters in Prometheus text format")
+    parser.add_argument("--sample-profile", metavar="PATH",
+                        help="Sample the main thread and write collapsed stacks for flamegraph.pl/speedscope")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="chordsheet-label")
+    subparsers = parser.add_subparsers(dest="command")
+
+    gui_parser = subparsers.add_parser("gui", help="Start the labeling GUI")
+    gui_parser.add_argument("--no-cache", action="store_true", help="Always run OCR, never use cached results")
+    gui_parser.add_argument("--engine", choices=DEFAULT_CONFIGS, default="paddleocr")
+    gui_parser.add_argument("--preprocess", nargs="?", const="default", type=preprocess_steps, metavar="STEPS",
+                            help=f"Preprocess regions before OCR, 'default' or some of {', '.join(STEPS)}")
+    gui_parser.add_argument("--profile-startup", action="store_true",
+                            help="Measure the time until the window is visible and report the slowest imports")
+    gui_parser.add_argument("--project", metavar="PATH", help="Open a saved project (its .cslp folder)")
+    add_instrumentation_args(gui_parser)
+
+    batch_parser = subparsers.add_parser("batch", help="Label all PDFs/images in a folder without the GUI")
+    batch_parser.add_argument("input_dir")
+    batch_parser.add_argument("--out", required=True, help="Folder for the exported json files")
+    batch_parser.add_argument("--key", help="Key used for every song (default: estimated from the chords of each song)")
+    batch_parser.add_argument("--key-from-filename", action="store_true",
+                              help="Take the key from the file name, e.g. 'Song - G.pdf'")
+    batch_parser.add_argument("--workers", type=int, help="Number of OCR worker processes (default: all cores)")
+    batch_parser.add_argument("--no-cache", action="store_true", help="Always run OCR, never use cached results")
+    batch_parser.add_argument("--engine", choices=DEFAULT_CONFIGS, default="paddleocr")
+    batch_parser.add_argument("--preprocess", nargs="?", const="default", type=preprocess_steps, metavar="STEPS",
+                              help=f"Preprocess pages before OCR, 'default' or some of {', '.join(STEPS)}")
+    batch_parser.add_argument("--sections", choices=["auto", "page"], default="auto",
+                              help="auto: split pages at VERSE/CHORUS/... headers, page: one section per page")
+    batch_parser.add_argument("--songbook", metavar="PATH",
+                              help="Also stream all songs into one songbook file, JSON Lines (.jsonl) or msgpack (.msgpack)")
+    add_instrumentation_args(batch_parser)
+    return parser.parse_args(argv)
+
 
 if __name__ == '__main__':
-    paddle_ocr_test()
\ No newline at end of file
+    args = parse_args()
+    if args.command == "batch":
+        batch(args)
+    elif args.command == "gui" and args.profile_startup:
+        from src.startup_profile import profile_startup
+
+        sys.exit(profile_startup(__file__, [arg for arg in sys.argv[1:] if arg != "--profile-startup"]))
+    elif args.command == "gui":
+        main(use_cache=not args.no_cache, engine=args.engine, preprocess=args.preprocess, trace=args.trace,
+             metrics=args.metrics, sample_profile=args.sample_profile, project=args.project)
+    else:
+        paddle_ocr_test()
@@ -1,35 +1,87 @@
+import itertools
+import math
+import os
 import random
 import sys
-import cv2
-import numpy as np
 import json
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, 
-                             QFileDialog, QLabel, QListWidget, QFrame, QSplitter, QStackedWidget,
-                             QTextEdit, QLineEdit, QMessageBox, QScrollArea)
-from PyQt5.QtGui import QPixmap, QImage, QColor, QPainter, QBrush, QPen
-from PyQt5.QtCore import Qt, QThreadPool
-import easyocr
-from paddleocr import PaddleOCR
-from pdf2image import convert_from_path
+                             QFileDialog, QLabel, QListWidget, QListWidgetItem, QFrame, QSplitter, QStackedWidget,
+                             QTextEdit, QLineEdit, QMessageBox, QDockWidget, QShortcut, QComboBox)
+from PyQt5.QtGui import QColor, QKeySequence
+from PyQt5.QtCore import Qt, QRectF, QTimer, pyqtSignal
 
 # Import your custom widget classes
-from src.widgets import OCRWorker, SectionNameDialog, KeyOfSongWidget, ImageLabel, SelectImagePage
+from src.widgets import SectionNameDialog, KeyOfSongWidget, PageViewer, SelectImagePage, LatencyTable, SectionOverview
+from src.analyze_process import IncrementalClassifier, SectionKeys, align_chords_to_lyrics
+from src.chord_theory import estimate_key, get_nashville_table
+from src.export import build_song_json, write_song
+from src.layout import parse_page_keep_records
+from src.ocr import PADDLE_CONFIG, union_rect
+from src.ocr_cache import OCRCache
+from src.ocr_pool import OCRPool, keep_records
+from src.page_detections import PageDetections
+from src.page_source import PageSource
+from src.preprocess import rotates_detections
+from src.project import PROJECT_EXTENSION, Project
+from src.song_document import SongDocument
+
+OCR_WORKERS = 2
+OCR_BATCH_WINDOW_MS = 150     # Sections drawn within this window are OCR'd with one engine call
+AUTOSAVE_INTERVAL_MS = 2000     # Changes are appended to the open project at most this often
 
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    # job id, (page detections, OCR'd rect, detections) or () if the OCR failed, timings
+    ocr_finished = pyqtSignal(int, tuple, dict)
+    ocr_progress = pyqtSignal(int, int)         # finished jobs, submitted jobs
+    ocr_failed = pyqtSignal(str)                # message for the status bar
+    ocr_worker_ready = pyqtSignal(bool, str)
+    sections_proposed = pyqtSignal(object, tuple, list, list)     # page detections, page rect, detections, proposals
+    export_finished = pyqtSignal(str, str)      # file path, error or "" if the file was written
+    project_progress = pyqtSignal(int, int)     # pages stored in the project, pages of the source
+
+    def __init__(self, use_cache=True, engine_config=PADDLE_CONFIG, preprocess=None):
         super().__init__()
         self.setWindowTitle("OCR Music Sheet Reader")
         self.setGeometry(100, 100, 1200, 800)
-        #self.reader = easyocr.Reader(['de', 'en'])
-        self.reader =  PaddleOCR(use_angle_cls=True, lang='en')
+        self.use_cache = use_cache
+        self.engine_config = engine_config
+        self.preprocess = preprocess
+        self.level_skew = rotates_detections(preprocess)    # The workers map their detections back from a deskew
+        self.ocr_cache = None
+        self.ocr_pool = None
+        self.ocr_finished.connect(self.update_ocr_result)
+        self.ocr_worker_ready.connect(self.on_ocr_worker_ready)
+        self.sections_proposed.connect(self.on_sections_proposed)
+        self.export_finished.connect(self.on_export_finished)
+        self.project_progress.connect(self.on_project_progress)
+        self.export_executor = ThreadPoolExecutor(max_workers=1)     # Files are written off the GUI thread
+
+        self.model_status_label = QLabel("OCR model: warming")
+        self.statusBar().addPermanentWidget(self.model_status_label)
+        self.ocr_progress_label = QLabel()
+        self.statusBar().addPermanentWidget(self.ocr_progress_label)
+        self.ocr_progress.connect(self.on_ocr_progress)
+        self.ocr_failed.connect(self.on_ocr_failed)
+        # Start the OCR workers once the window is visible, they load their models while the user picks a file
+        QTimer.singleShot(0, self.start_ocr_pool)
+
+        # Debug panel with the latency of every OCR job, F12 shows/hides it
+        self.latency_table = LatencyTable()
+        self.debug_dock = QDockWidget("OCR Latenz", self)
+        self.debug_dock.setWidget(self.latency_table)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.debug_dock)
+        self.debug_dock.hide()
+        QShortcut(QKeySequence(Qt.Key_F12), self, activated=self.toggle_debug_panel)
         
         self.central_widget = QStackedWidget()
         self.setCentralWidget(self.central_widget)
 
         # Page 1: Select Image
         self.select_image_page = SelectImagePage()
-        self.select_image_page.image_selected.connect(self.on_image_selected)
+        self.select_image_page.source_selected.connect(self.on_source_selected)
+        self.select_image_page.project_selected.connect(self.open_project)
         self.central_widget.addWidget(self.select_image_page)
 
         # Page 2: Main Interface
@@ -37,15 +89,15 @@ class MainWindow(QMainWindow):
         self.main_layout = QHBoxLayout(self.main_page)
         self.central_widget.addWidget(self.main_page)
         
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-
-        self.image_label = ImageLabel(self)
-        self.image_label.section_selected.connect(self.on_section_selected)
-        self.scroll_area.setWidget(self.image_label)
-        self.main_layout.addWidget(self.scroll_area)
+        self.page_viewer = PageViewer(self)
+        self.page_viewer.section_selected.connect(self.on_section_selected)
+        self.page_viewer.selection_changing.connect(self.on_selection_changing)
+        self.page_viewer.section_resizing.connect(self.on_section_resizing)
+        self.page_viewer.section_edited.connect(self.on_section_edited)
+        self.main_layout.addWidget(self.page_viewer)
 
         self.key_of_song = None
+        self.key_estimated = False      # The key was estimated from the chords, not entered
         self.song_name = None
 
         # Right panel
@@ -74,8 +126,25 @@ class MainWindow(QMainWindow):
         self.current_key_label = QLabel("Current Key: None")
         self.right_panel_layout.addWidget(self.current_key_label)
 
+        # Preview of the chords transposed to another key
+        self.transpose_widget = QWidget()
+        self.transpose_layout = QHBoxLayout(self.transpose_widget)
+        self.transpose_box = QComboBox()
+        self.transpose_box.addItems(["Nashville"] + [key for key in get_nashville_table().key_names if key])
+        self.transpose_box.currentTextChanged.connect(self.on_transpose_changed)
+        self.transpose_layout.addWidget(QLabel("Akkorde in:"))
+        self.transpose_layout.addWidget(self.transpose_box)
+        self.right_panel_layout.addWidget(self.transpose_widget)
+
+        # Automatic section detection
+        self.detect_sections_button = QPushButton("Detect Sections")
+        self.detect_sections_button.clicked.connect(self.detect_sections)
+        self.right_panel_layout.addWidget(self.detect_sections_button)
+
         # Sections List
         self.sections_list = QListWidget()
+        self.sections_list.setToolTip("Entf löscht die ausgewählte Section")
+        self.sections_list.installEventFilter(self)
         self.right_panel_layout.addWidget(self.sections_list)
         self.sections_list.itemClicked.connect(self.on_item_clicked)
 
@@ -84,124 +153,507 @@ class MainWindow(QMainWindow):
         self.export_button.clicked.connect(self.export_to_json)
         self.right_panel_layout.addWidget(self.export_button)
 
+        # Project, autosaved once it is saved or opened
+        self.save_project_button = QPushButton("Projekt speichern")
+        self.save_project_button.clicked.connect(self.save_project)
+        self.right_panel_layout.addWidget(self.save_project_button)
+
         # Section Data Overview
-        self.section_data_overview = QTextEdit()
+        self.section_data_overview = SectionOverview()
         self.section_data_overview.setReadOnly(False)
         self.right_panel_layout.addWidget(self.section_data_overview)
 
+        self.page_source = None
+        self.page_index = 0
+        self.shared_page = None     # Current page at OCR resolution in the pool's shared memory, once needed
+        # Detections of all OCR jobs of the current page, sections are analyzed from here
+        self.page_detections = PageDetections(self.level_skew)
         self.image = None
         self.sections = []
+        # Rendered preview of every section, only changed sections are rendered and shown again
+        self.document = SongDocument()
         self.section_colors = {}
-        self.thread_pool = QThreadPool()
-        self.ocr_threads = []
+        self.section_ids = itertools.count()
+
+        # In-flight OCR: job id -> futures of the job's rects. A section is analyzed once all rects of its
+        # current job are in the page detections, deleting or editing it cancels the job and drops it from here.
+        self.ocr_jobs = {}
+        self.ocr_job_ids = itertools.count()
+        self.ocr_jobs_submitted = 0
+        self.ocr_jobs_finished = 0
+
+        self.project = None
+        # What the project holds already: (song name, key) and section id -> (rect, ocr data) of this page
+        self.saved_song = None
+        self.saved_sections = {}
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosave)
+
+        self.pending_sections = []
+        self.ocr_batch_timer = QTimer(self)
+        self.ocr_batch_timer.setSingleShot(True)
+        self.ocr_batch_timer.timeout.connect(self.flush_pending_sections)
+
+    def start_ocr_pool(self):
+        self.ocr_cache = OCRCache() if self.use_cache else None
+        self.ocr_pool = OCRPool(workers=OCR_WORKERS, cache=self.ocr_cache, engine_config=self.engine_config,
+                                on_worker_ready=lambda ok, info: self.ocr_worker_ready.emit(ok, str(info)),
+                                preprocess=self.preprocess)
+
+    def on_ocr_worker_ready(self, ok, info):
+        if not ok:
+            self.model_status_label.setText("OCR model: failed to load")
+            self.model_status_label.setToolTip(info)
+        elif self.ocr_pool.ready_workers < self.ocr_pool.workers:
+            self.model_status_label.setText(f"OCR model: warming ({self.ocr_pool.ready_workers}/{self.ocr_pool.workers})")
+        else:
+            self.model_status_label.setText("OCR model: ready")
 
     def set_song_name(self):
         self.song_name = self.song_name_input.text()
 
+    def on_source_selected(self, page_source):
+        if self.shared_page is not None:
+            self.shared_page.release()
+            self.shared_page = None
+        self.page_detections = PageDetections(self.level_skew)
+        self.page_source = page_source
+        self.page_index = 0
+        self.on_image_selected(page_source.preview(self.page_index))
+
     def on_image_selected(self, image):
         self.image = image
-        height, width, channel = self.image.shape
-        bytes_per_line = 3 * width
-        q_image = QImage(self.image.data, width, height, bytes_per_line, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(q_image)
-        self.image_label.setPixmap(pixmap)
-        self.image_label.setFixedSize(width, height)
+        self.page_viewer.set_page(image)
         self.central_widget.setCurrentWidget(self.main_page)
 
-    def key_of_song_entered(self, key_of_song):
+    def key_of_song_entered(self, key_of_song, estimated=False):
+        """Set the key, the sections are converted to the new key right away without OCR."""
         self.key_of_song = key_of_song
-        self.current_key_label.setText(f"Current Key: {self.key_of_song}")
+        self.key_estimated = estimated
+        self.current_key_label.setText(f"Current Key: {self.key_of_song}" + (" (geschätzt)" if estimated else ""))
+        for section in self.sections:
+            if section["keys"] is not None:
+                self.document.set_ocr_data(section, section["keys"].nashville_data(key_of_song))
+        self.on_transpose_changed(self.transpose_box.currentText())
+
+    def estimate_song_key(self):
+        """Until a key is entered, the key is the one that fits the chords of all sections best."""
+        if self.key_of_song and not self.key_estimated:
+            return
+        key = estimate_key(chord for section in self.sections if section["keys"] is not None
+                           for line in section["keys"].chart for chord in line["chords"].values())
+        if key and key != self.key_of_song:
+            self.key_of_song_entered(key, estimated=True)
+            self.statusBar().showMessage(f"Tonart aus den Akkorden geschätzt: {key}", 5000)
+
+    def on_transpose_changed(self, to_key):
+        self.document.set_transposition(self.key_of_song, None if to_key == "Nashville" else to_key)
+        self.update_section_data_overview()
 
-    def on_section_selected(self, rect):
-        if self.key_of_song:
-            dialog = SectionNameDialog(self)
-            if dialog.exec_():
-                section_name = dialog.get_name()
-                if section_name:
-                    self.save_section(section_name, rect)
-        else:
-            QMessageBox.warning(self, "Warning", "Du hast noch keine Tonart festgelegt. Bitte wähle eine Tonart aus du kek.")
-                
-    def save_section(self, name, rect):
-        x, y, w, h = rect.getRect()
-        self.sections.append({"name": name, "rect": (x, y, w, h), "ocr_data": None})
+    def on_selection_changing(self, rect):
+        """Preview of what a section drawn right now would contain, from what is known of the page."""
+        if not len(self.page_detections) or self.page_source is None:
+            return
+        _, detections = self.page_detections.query(self.page_rect(rect.getRect()))
+        self.statusBar().showMessage(f"Auswahl: {len(detections.lines())} Zeilen, {len(detections)} Wörter", 2000)
 
-        color = QColor(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), 100)
+    def on_section_selected(self, rect):
+        # Without a key the key is estimated from the chords once they are read
+        dialog = SectionNameDialog(self)
+        if dialog.exec_():
+            section_name = dialog.get_name()
+            if section_name:
+                self.save_section(section_name, rect)
+
+    def add_section(self, name, rect, ocr_data=None, color=None, section_id=None, chart=None):
+        """A section, its data either from `chart` (see `SectionKeys`) or, without one, `ocr_data` as it is."""
+        x, y, w, h = rect
+        section_id = next(self.section_ids) if section_id is None else section_id
+        keys = SectionKeys(chart) if chart is not None else None
+        if keys is not None:
+            ocr_data = keys.nashville_data(self.key_of_song)
+        section = {"id": section_id, "name": name, "rect": (x, y, w, h), "ocr_data": ocr_data, "keys": keys,
+                   "job": None, "classifier": IncrementalClassifier()}
+        self.sections.append(section)
+        self.document.mark_dirty(section)
+
+        color = color or QColor(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), 100)
         self.section_colors[name] = color
 
-        self.repaint_image_with_sections()
+        self.page_viewer.add_section(section["id"], (x, y, w, h), color)
 
-        self.sections_list.addItem(name)
+        item = QListWidgetItem(name)
+        item.setData(Qt.UserRole, section["id"])
+        self.sections_list.addItem(item)
+        return section
 
-        worker = OCRWorker(self.image, (x, y, w, h), self.reader, self.key_of_song, name)
-        worker.finished.connect(self.update_ocr_result)
-        self.ocr_threads.append(worker)
-        worker.start()
+    def find_section(self, section_id):
+        return next((section for section in self.sections if section["id"] == section_id), None)
 
-    def repaint_image_with_sections(self):
-        height, width, channel = self.image.shape
-        img_copy = self.image.copy()
+    def save_section(self, name, rect):
+        x, y, w, h = rect.getRect()
+        section = next((section for section in self.sections if section["name"] == name), None)
+        if section is None:
+            section = self.add_section(name, (x, y, w, h))
+        else:
+            # Same name again: the section is redrawn, its running OCR is outdated
+            self.cancel_section_ocr(section)
+            section["rect"] = (x, y, w, h)
+            section["keys"] = None
+            self.document.set_ocr_data(section, None)
+            self.page_viewer.remove_section(section["id"])
+            self.page_viewer.add_section(section["id"], (x, y, w, h), self.section_colors[name])
+        if section["id"] not in self.pending_sections:
+            self.pending_sections.append(section["id"])
+        self.ocr_batch_timer.start(OCR_BATCH_WINDOW_MS)
+
+    def on_section_resizing(self, section_id, rect):
+        """An edge is being dragged: re-analyze from the detections at hand, OCR waits for the release."""
+        section = self.find_section(section_id)
+        if section is None:
+            return
+        x, y, w, h = rect.getRect()
+        section["rect"] = (x, y, w, h)
+        if self.page_detections.covered:
+            self.analyze_section(section)
+            self.update_section_data_overview()
+
+    def on_section_edited(self, section_id, rect):
+        section = self.find_section(section_id)
+        if section is None:
+            return
+        self.cancel_section_ocr(section)
+        x, y, w, h = rect.getRect()
+        section["rect"] = (x, y, w, h)
+        if section_id not in self.pending_sections:
+            self.pending_sections.append(section_id)
+        self.ocr_batch_timer.start(OCR_BATCH_WINDOW_MS)
+
+    def delete_section(self, section_id):
+        section = self.find_section(section_id)
+        if section is None:
+            return
+        self.cancel_section_ocr(section)
+        if section_id in self.pending_sections:
+            self.pending_sections.remove(section_id)
+        self.sections.remove(section)
+        self.document.discard(section)
+        self.section_data_overview.remove_section(section_id)
+        self.section_colors.pop(section["name"], None)
+        self.page_viewer.remove_section(section_id)
+        for row in range(self.sections_list.count()):
+            if self.sections_list.item(row).data(Qt.UserRole) == section_id:
+                self.sections_list.takeItem(row)
+                break
+        self.update_section_data_overview()
 
-        bytes_per_line = 3 * width
-        q_image = QImage(img_copy.data, width, height, bytes_per_line, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(q_image)
+    def cancel_section_ocr(self, section):
+        job = self.ocr_jobs.pop(section["job"], None)
+        section["job"] = None
+        if job is not None:
+            for future in job["futures"]:
+                # Not started yet: never OCR'd. Running: cancel fails, the result only goes into the page detections.
+                future.cancel()
+            self.finish_ocr_job()
+
+    def section_priority(self, rect):
+        """Sections inside the visible part of the page are OCR'd first."""
+        visible = self.page_viewer.mapToScene(self.page_viewer.viewport().rect()).boundingRect()
+        return 0 if visible.intersects(QRectF(*rect)) else 1
+
+    def page_rect(self, rect):
+        """Preview rect -> rect in page pixels at OCR resolution."""
+        scale = self.page_source.scale
+        x, y, w, h = rect
+        return int(x * scale), int(y * scale), max(1, int(w * scale)), max(1, int(h * scale))
+
+    def flush_pending_sections(self):
+        """
+        OCR what the sections saved or edited within the batch window still need. Parts of a section that
+        are already in the page detections are not OCR'd again: an edited section only gets the newly
+        exposed strips OCR'd, one job per strip. New sections are OCR'd together with a single job.
+        """
+        pending = [self.find_section(section_id) for section_id in self.pending_sections]
+        pending = [section for section in pending if section is not None]
+        self.pending_sections = []
+        if not pending:
+            return
+        whole = []
+        for section in pending:
+            rect = self.page_rect(section["rect"])
+            strips = self.page_detections.missing(rect)
+            if not strips:
+                self.analyze_section(section)
+            elif strips == [rect]:
+                whole.append((section, rect))
+            else:
+                self.submit_section_ocr(section, [self.submit_page_rects([(section["name"], strip)])[0]
+                                                  for strip in strips], strips)
+        if whole:
+            futures = self.submit_page_rects([(section["name"], rect) for section, rect in whole],
+                                             min(self.section_priority(section["rect"]) for section, _ in whole))
+            for (section, rect), future in zip(whole, futures):
+                self.submit_section_ocr(section, [future], [rect])
+        self.ocr_progress.emit(self.ocr_jobs_finished, self.ocr_jobs_submitted)
+        self.update_section_data_overview()
 
-        painter = QPainter(pixmap)
+    def submit_page_rects(self, regions, priority=0):
+        """
+        OCR (name, rect in page pixels) regions with one job, the futures resolve to their detections. Never
+        waits for the pool's queue to drain, the GUI would freeze until a worker is free.
+        """
+        if self.shared_page is not None or not self.page_source.is_pdf:
+            # The whole page is in memory anyway, the workers read the regions straight from shared memory
+            return self.ocr_pool.submit_regions(self.current_shared_page(), regions, self.key_of_song,
+                                                parse=keep_records, priority=priority, block=False)
+        # The preview is low resolution, the union of the regions is rasterized again at OCR resolution
+        scale = self.page_source.scale
+        ux, uy, uw, uh = union_rect([rect for _, rect in regions])
+        preview = (int(ux / scale), int(uy / scale))
+        preview += (math.ceil((ux + uw) / scale) - preview[0], math.ceil((uy + uh) / scale) - preview[1])
+        roi = self.page_source.render_region(self.page_index, preview)
+        ox, oy = int(preview[0] * scale), int(preview[1] * scale)
+        return self.ocr_pool.submit_regions(roi, [(name, (x - ox, y - oy, w, h)) for name, (x, y, w, h) in regions],
+                                            self.key_of_song, parse=keep_records, priority=priority, block=False)
+
+    def submit_section_ocr(self, section, futures, rects):
+        job_id = next(self.ocr_job_ids)
+        section["job"] = job_id
+        self.ocr_jobs[job_id] = {"futures": futures, "remaining": len(futures), "failed": 0}
+        self.ocr_jobs_submitted += 1
+        for future, rect in zip(futures, rects):
+            future.add_done_callback(lambda f, job_id=job_id, name=section["name"], rect=rect,
+                                     store=self.page_detections: self.on_ocr_done(job_id, name, store, rect, f))
+
+    def analyze_section(self, section):
+        """Section data from the page detections in its rect, only changed lines are classified again."""
+        ids, detections = self.page_detections.query(self.page_rect(section["rect"]))
+        lines = section["classifier"].classify(detections, ids)
+        section["keys"] = SectionKeys(align_chords_to_lyrics(lines))
+        self.document.set_ocr_data(section, section["keys"].nashville_data(self.key_of_song))
+
+    def current_shared_page(self):
+        if self.shared_page is None:
+            self.shared_page = self.ocr_pool.share_page(self.page_source.page(self.page_index))
+        return self.shared_page
+
+    def on_ocr_done(self, job_id, name, store, rect, future):
+        # Runs in the pool's collector thread, the signal hands the result over to the GUI thread
+        if future.cancelled():
+            return
+        timings = getattr(future, "timings", {})
+        if future.exception() is not None:
+            self.ocr_failed.emit(f"OCR von {name} fehlgeschlagen: {future.exception()}")
+            self.ocr_finished.emit(job_id, (), timings)
+            return
+        self.ocr_finished.emit(job_id, (store, rect, future.result()), timings)
+
+    def finish_ocr_job(self):
+        self.ocr_jobs_finished += 1
+        if not self.ocr_jobs:   # Everything done, the next batch of work counts from zero again
+            self.ocr_jobs_submitted = self.ocr_jobs_finished = 0
+        self.ocr_progress.emit(self.ocr_jobs_finished, self.ocr_jobs_submitted)
+
+    def on_ocr_progress(self, finished, submitted):
+        self.ocr_progress_label.setText(f"OCR: {finished}/{submitted}" if submitted else "")
+
+    def on_ocr_failed(self, message):
+        self.statusBar().showMessage(message, 10000)
+
+    def detect_sections(self):
+        """OCR the whole page once and add a section for every VERSE/CHORUS/... header found on it."""
+        if self.page_source is None or self.ocr_pool is None:
+            return
+        self.detect_sections_button.setEnabled(False)
+        page = self.current_shared_page()
+        page_rect = (0, 0, page.shape[1], page.shape[0])
+        # Lower priority than hand drawn sections, the user is waiting for those
+        future = self.ocr_pool.submit(page, self.key_of_song, f"Page {self.page_index + 1}",
+                                      parse=parse_page_keep_records, priority=2, block=False)
+        future.add_done_callback(lambda f, store=self.page_detections: self.on_page_ocr_done(store, page_rect, f))
+
+    def on_page_ocr_done(self, store, page_rect, future):
+        # Collector thread, see on_ocr_done
+        if future.exception() is not None:
+            self.ocr_failed.emit(f"Detect Sections fehlgeschlagen: {future.exception()}")
+            self.sections_proposed.emit(store, page_rect, [], [])
+            return
+        records, proposals = future.result()
+        self.sections_proposed.emit(store, page_rect, list(records), list(proposals))
+
+    def on_sections_proposed(self, store, page_rect, records, proposals):
+        self.detect_sections_button.setEnabled(True)
+        if records:
+            store.add(page_rect, records)   # Editing the proposed sections needs no more OCR
+        if store is not self.page_detections:
+            return      # Another file was opened in the meantime
+        if records and self.project is not None:
+            self.project.add_detections(self.page_index, page_rect, records)
+        scale = self.page_source.scale      # Proposals are in OCR pixels, the viewer shows the preview
+        for proposal in proposals:
+            x, y, w, h = proposal.rect
+            rect = (int(x / scale), int(y / scale), int(w / scale), int(h / scale))
+            # Detecting again proposes the same sections, the ones already there (maybe edited) are kept
+            if any(section["name"] == proposal.name or section["rect"] == rect for section in self.sections):
+                continue
+            self.add_section(proposal.name, rect, chart=proposal.chart)
+        self.estimate_song_key()
+        self.update_section_data_overview()
 
+    def update_ocr_result(self, job_id, data, timings):
+        if data:
+            store, rect, records = data
+            store.add(rect, records)    # Also if the section changed meanwhile, the detections stay valid
+            if self.project is not None and store is self.page_detections:
+                self.project.add_detections(self.page_index, rect, records)
+        job = self.ocr_jobs.get(job_id)
+        if job is None:
+            return      # Section was deleted or edited in the meantime
+        job["remaining"] -= 1
+        job["failed"] += not data
+        if job["remaining"]:
+            return
+        del self.ocr_jobs[job_id]
         for section in self.sections:
-            name = section["name"]
-            x, y, w, h = section["rect"]
-            color = self.section_colors[name]
-            painter.setBrush(QBrush(color))
-            painter.setPen(QPen(Qt.NoPen))
-            painter.drawRect(x, y, w, h)
-
-        painter.end()
-        self.image_label.setPixmap(pixmap)
-
-    def update_ocr_result(self, region, data):
-        name_of_part, ocr_data = data
-        for section in self.sections:
-            if str(section["rect"]) == region:
-                section["ocr_data"] = ocr_data
+            if section["job"] == job_id:
+                section["job"] = None
+                if job["failed"] < len(job["futures"]):
+                    self.analyze_section(section)
+                    self.estimate_song_key()
+                self.latency_table.add_timings(section["name"], timings)
                 break
+        self.finish_ocr_job()
         self.update_section_data_overview()
 
+    def toggle_debug_panel(self):
+        self.debug_dock.setVisible(not self.debug_dock.isVisible())
+
     def on_item_clicked(self, item):
         item_text = item.text()
-        section_data = next((section for section in self.sections if section["name"] == item_text), None)
+        section_data = self.find_section(item.data(Qt.UserRole))
         if section_data and section_data["ocr_data"]:
-            self.section_data_overview.setText(f"Details for {item_text}:\n{json.dumps(section_data['ocr_data'], indent=2)}")
+            self.section_data_overview.show_details(f"Details for {item_text}:\n{json.dumps(section_data['ocr_data'], indent=2)}")
         else:
-            self.section_data_overview.setText(f"Details for {item_text}: No OCR data available.")
+            self.section_data_overview.show_details(f"Details for {item_text}: No OCR data available.")
 
     def update_section_data_overview(self):
-        overview = ""
-        for section in self.sections:
-            overview += f"Section: {section['name']}\n"
-            if section['ocr_data']:
-                overview += json.dumps(section['ocr_data'], indent=2) + "\n"
-            else:
-                overview += "  No OCR data available\n"
-            overview += "\n"
-        self.section_data_overview.setText(overview)
+        """Show the sections changed since the last update, the previews of all others stay as they are."""
+        if not self.section_data_overview.showing_overview:
+            self.section_data_overview.set_sections([(section["id"], self.document.preview(section))
+                                                     for section in self.sections])
+            return
+        for section_id, preview in self.document.take_dirty(self.sections):
+            self.section_data_overview.update_section(section_id, preview)
 
     def export_to_json(self):
-        data = {
-            "header": {
-                "name": self.song_name or "Untitled",
-                "key": self.key_of_song or "Unknown",
-                "authors": []
-            },
-            "data": {}
-        }
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save JSON", "",
+                                                   "JSON Files (*.json);;MessagePack Files (*.msgpack)")
+        if not file_path:
+            return
+        # Section data is replaced on every analysis, never changed in place, so the song stays as it is now
+        # while the export thread writes it
+        song = build_song_json(self.song_name, self.key_of_song,
+                               ((section["name"], section["ocr_data"]) for section in self.sections))
+        future = self.export_executor.submit(write_song, file_path, song)
+        future.add_done_callback(lambda f: self.export_finished.emit(file_path, str(f.exception() or "")))
+
+    def on_export_finished(self, file_path, error):
+        if error:
+            QMessageBox.warning(self, "Export", f"Export nach {file_path} fehlgeschlagen: {error}")
+        else:
+            self.statusBar().showMessage(f"Exportiert: {file_path}", 5000)
+
+    def section_record(self, section):
+        return {"page": self.page_index, "id": section["id"], "name": section["name"], "rect": list(section["rect"]),
+                "color": self.section_colors[section["name"]].getRgb(), "ocr_data": section["ocr_data"],
+                "chart": section["keys"].chart if section["keys"] is not None else None}
+
+    def save_project(self):
+        """Save the session as project. From then on every change is autosaved into it."""
+        if self.project is not None:
+            self.autosave()
+            return
+        if self.page_source is None:
+            return
+        path, _ = QFileDialog.getSaveFileName(self, "Save Project", "", f"Projekte (*{PROJECT_EXTENSION})")
+        if not path:
+            return
+        if not path.endswith(PROJECT_EXTENSION):
+            path += PROJECT_EXTENSION
+        try:
+            self.project = Project.create(path, self.page_source)
+        except OSError as e:
+            QMessageBox.warning(self, "Projekt", f"Projekt {path} konnte nicht angelegt werden: {e}")
+            return
+        self.import_project_pages(self.page_source)
+        if len(self.page_detections):
+            self.project.save_page_detections(self.page_index, self.page_detections)
+        self.saved_song, self.saved_sections = None, {}
+        self.autosave()
+        self.autosave_timer.start(AUTOSAVE_INTERVAL_MS)
+
+    def import_project_pages(self, source):
+        page_count = source.page_count
+        self.project.import_pages(source, on_page=lambda index: self.project_progress.emit(index + 1, page_count))
+
+    def open_project(self, path):
+        """Continue a saved project: only the shown page is read, with its sections and detections."""
+        try:
+            project = Project.open(path)
+            state = project.load(page=0)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "Projekt", f"Projekt {path} konnte nicht geöffnet werden: {e}")
+            return
+        source, original = project.pages, None
+        if not project.complete and os.path.exists(project.meta["source"]):
+            # The app was closed before all pages were stored, the rest is stored now
+            original = PageSource(project.meta["source"], project.meta["preview_dpi"], project.meta["ocr_dpi"])
+            source = source if source.page_count else original
+        elif not source.page_count:
+            QMessageBox.warning(self, "Projekt", f"Projekt {path} enthält keine Seiten und {project.meta['source']} "
+                                                 f"existiert nicht mehr.")
+            return
+        if self.project is not None:
+            self.project.close()
+        self.project = project
+        if original is not None:
+            self.import_project_pages(original)
+
+        self.on_source_selected(source)
+        self.page_detections = project.page_detections(self.page_index, self.level_skew)
+        if state.key:
+            self.key_of_song_entered(state.key)
+        if state.song_name:
+            self.song_name = state.song_name
+            self.song_name_input.setText(state.song_name)
+        for section in state.sections:
+            self.add_section(section["name"], section["rect"], section["ocr_data"], QColor(*section["color"]),
+                             section_id=section["id"], chart=section["chart"])
+        self.section_ids = itertools.count(state.next_id)
+        self.saved_song = (state.song_name, state.key)
+        self.saved_sections = {section["id"]: (section["rect"], section["ocr_data"]) for section in state.sections}
+        self.update_section_data_overview()
+        self.autosave_timer.start(AUTOSAVE_INTERVAL_MS)
+
+    def autosave(self):
+        """Queue what changed since the last autosave for the project, its writer thread appends it."""
+        if self.project is None:
+            return
+        song = (self.song_name, self.key_of_song)
+        if song != self.saved_song:
+            self.project.save_song(*song)
+            self.saved_song = song
         for section in self.sections:
-            data["data"][section["name"]] = section["ocr_data"]
+            saved = self.saved_sections.get(section["id"])
+            if saved is None or saved[0] != section["rect"] or saved[1] != section["ocr_data"]:
+                self.project.save_section(self.section_record(section))
+                self.saved_sections[section["id"]] = (section["rect"], section["ocr_data"])
+        for section_id in set(self.saved_sections) - {section["id"] for section in self.sections}:
+            self.project.delete_section(self.page_index, section_id)
+            del self.saved_sections[section_id]
 
-        file_path, _ = QFileDialog.getSaveFileName(self, "Save JSON", "", "JSON Files (*.json)")
-        if file_path:
-            with open(file_path, 'w') as f:
-                json.dump(data, f, indent=4)
+    def on_project_progress(self, stored, page_count):
+        self.statusBar().showMessage(f"Projekt: {stored}/{page_count} Seiten gespeichert", 3000)
 
     def eventFilter(self, source, event):
         if (event.type() == event.KeyPress and 
@@ -209,8 +661,18 @@ class MainWindow(QMainWindow):
             event.key() == Qt.Key_Return):
             self.set_song_name()
             return True  # Indicate that the event has been handled
+        if (event.type() == event.KeyPress and
+            source is self.sections_list and
+            event.key() == Qt.Key_Delete and
+            self.sections_list.currentItem() is not None):
+            self.delete_section(self.sections_list.currentItem().data(Qt.UserRole))
+            return True
         return super().eventFilter(source, event)
     def closeEvent(self, event):
-        for thread in self.ocr_threads:
-            thread.wait()
+        if self.ocr_pool is not None:
+            self.ocr_pool.shutdown(wait=False)      # Queued sections are not needed any more
+        self.export_executor.shutdown()     # Waits for a running export
+        if self.project is not None:
+            self.autosave()
+            self.project.close()
         super().closeEvent(event)
\ No newline at end of file
@@ -1,61 +1,27 @@
-import json
 import re
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
+
+import numpy as np
+
+from src.chord_theory import PackedChords, chord_mask, get_nashville_table, note_to_pitch_class, parse_chord
+from src.detections import Detections
+from src.instrumentation import count, span
+
+SECTION_HEADER = re.compile(
+    r"^(intro|verse|pre[- ]?chorus|chorus|bridge|outro|tag|interlude|instrumental|ending|"
+    r"strophe|vers|refrain|zwischenspiel|schluss)\b[\s\d.:x()]*$",
+    re.IGNORECASE)
 
 def is_chord(text: str) -> bool:
-    """Check if the text is likely a chord."""
-    basic_chords = {"C", "D", "E", "F", "G", "A", "B", "H"}
-    text = text.upper()
-    if len(text) > 1: 
-        return len(text) <= 4 and any(char in text for char in ["7", "6", "9", "m", "M", "maj", "dim", "aug", "sus", "add", "°", "ø", "b", "#", "/"])
-    return text in basic_chords
+    """Check if the whole text is a chord, see `parse_chord` for the grammar."""
+    return parse_chord(text) is not None
 
 def convert_chord_to_nashV(chord: str, key: str) -> str:
     """
     Convert a chord to its Nashville number system equivalent based on the key.
     This handles extended chords like F#m7, Cmaj7, B7 by focusing on the base chord.
     """
-    # Load Nashville system from a JSON file or define it as a dict here
-    nashville_system = json.load(open("assets/nashville_system.json"))     # HERE PATH MAYBE FOR EXE SHOULD BE CHANGED
-
-    # Ensure the key exists in the Nashville system
-    if key not in nashville_system:
-        return None
-        #raise ValueError(f"Key {key} not recognized in the Nashville system.")
-    
-    # Get the chords for the key
-    chords_for_key = nashville_system[key]
-
-    # Strip extensions from the chord (e.g., F#m7 -> F#m)
-    base_chord = re.match(r"([A-G]#?m?)(.*)", chord)
-    
-    if not base_chord:
-        return None
-        #raise ValueError(f"Chord {chord} is invalid.")
-    
-    base_chord_name = base_chord.group(1)  # Extract the base chord (e.g., F#m)
-    chord_extension = base_chord.group(2)  # Extract the extension (e.g., 7, maj7)
-    # Find the chord in the key's Nashville system
-    for nash_num, nash_chord in chords_for_key.items():
-        # Match major and minor chords
-        if (base_chord_name.endswith("m") and nash_chord.startswith(base_chord_name[:-1])):
-            return f'-{nash_num}'
-        if nash_chord == base_chord_name :
-            return f'{nash_num}'
-    
-    # If the chord is not found, return an error or a default value
-    return None
-    #raise ValueError(f"Chord {chord} not recognized in the key of {key}.")
-def process_position(x:float, start_x:float, avg_width:float, length_of_lyrics:int) -> int:
-    relativ_x = x - start_x
-    if relativ_x > 0:   
-        pos  = int((relativ_x/avg_width) * length_of_lyrics)
-        return pos
-    else:
-        print('DEBUG ERROR: relativ_x is negative')
-        return None
-
-from typing import List, Tuple
+    return get_nashville_table().convert(chord, key)
 
 def cluster_to_lines(ocr_result: List[Tuple], y_threshold: int = 10) -> List[List[int]]:
     """
@@ -68,106 +34,210 @@ def cluster_to_lines(ocr_result: List[Tuple], y_threshold: int = 10) -> List[Lis
     Returns:
         List[List[int]]: A list of lists where each sublist contains the indices of the OCR results in the same line.
     """
-    lines = []
-    current_line = []
-    current_y = None
+    return Detections.from_ocr_result(ocr_result).lines(y_threshold)
 
-    # Sort OCR results by the top-left `y` coordinate to ensure proper processing
-    sorted_results = sorted(enumerate(ocr_result[0]), key=lambda item: item[1][0][0][1])  # Sort by bbox top-left y
 
-    for i, line in sorted_results:
-        bbox, (text, confidence) = line
-        avg_y = sum([point[1] for point in bbox]) / 4  # Average y-coordinate of the bounding box
-
-        if current_y is None or abs(avg_y - current_y) < y_threshold:  # Same line
-            current_line.append(i)
-            current_y = avg_y
-        else:  # New line
-            lines.append(current_line)
-            current_line = [i]
-            current_y = avg_y
+def classify_lines(detections: Detections, y_threshold: int = 10) -> List[Dict]:
+    """
+    Cluster the detections into lines and label every line as chord line (all tokens are chords) or lyric line.
+    The chords are kept as written, they only become Nashville numbers for a key in `SectionKeys`.
+    """
+    order, starts = detections.line_order(y_threshold)
+    if not len(order):
+        return []
+    texts = detections.texts
+    chords = chord_mask(texts)
+    chord_lines = np.logical_and.reduceat(chords[order], starts)
+    count("tokens", len(texts))
+    count("lines", len(starts))
+    count("chords", int(np.diff(np.append(starts, len(order)))[chord_lines].sum()))
+
+    geometry = detections.center_x.tolist(), detections.start_x.tolist(), detections.widths.tolist()
+    return [_classify_line(texts, geometry, line_nrs.tolist(), line_nrs.tolist(), is_chord_line)
+            for line_nrs, is_chord_line in zip(np.split(order, starts[1:]), chord_lines)]
+
+
+def _classify_line(texts: List[str], geometry: tuple, line_nrs: List[int], keys: list, is_chord_line: bool) -> Dict:
+    """One line of `classify_lines`, its tokens keyed by `keys`."""
+    center_x, start_x, widths = geometry
+    if is_chord_line:
+        line_data = {k: {'avg_x': center_x[nr], 'chord': texts[nr].replace('?', '').replace('_', '')}
+                     for nr, k in zip(line_nrs, keys)}
+        return {'type': 'chords', 'data': line_data}
+    line_data = {k: {'start_x': start_x[nr], 'avg_width': widths[nr], 'text': texts[nr]} for nr, k in zip(line_nrs, keys)}
+    return {'type': 'lyrics', 'data': line_data}
+
+
+class IncrementalClassifier:
+    """
+    `classify_lines` for a section whose rect is edited: the lines are keyed by the page ids of their
+    detections (see `PageDetections`), lines that are unchanged since the last call are reused and only
+    new or changed lines are classified. The tokens of the lines are keyed by page id as well.
+    """
 
-    # Add the last line
-    if current_line:
-        lines.append(current_line)
+    def __init__(self):
+        self.reused = 0         # Lines taken over from the last call, for the debug output
+        self._lines = {}
+
+    def classify(self, detections: Detections, ids: np.ndarray, y_threshold: int = 10) -> List[Dict]:
+        order, starts = detections.line_order(y_threshold)
+        if not len(order):
+            self._lines = {}
+            return []
+        texts, ids = detections.texts, ids.tolist()
+        geometry = None
+        lines, result = {}, []
+        for line_nrs in np.split(order, starts[1:]):
+            line_nrs = line_nrs.tolist()
+            line_key = tuple(sorted(ids[nr] for nr in line_nrs))
+            line = self._lines.get(line_key)
+            if line is None:
+                if geometry is None:
+                    geometry = (detections.center_x.tolist(), detections.start_x.tolist(), detections.widths.tolist())
+                line = _classify_line(texts, geometry, line_nrs, [ids[nr] for nr in line_nrs],
+                                      all(is_chord(texts[nr]) for nr in line_nrs))
+            lines[line_key] = line
+            result.append(line)
+        self.reused = len(self._lines.keys() & lines.keys())
+        self._lines = lines     # Only the lines of the current rect are kept
+        return result
+
+
+class SectionKeys:
+    """
+    A section in all 12 keys. `chart` is the key independent result of `align_chords_to_lyrics` (chords as
+    written), the Nashville numbers of its chords are looked up for every key at once when the section is
+    analyzed, so changing the key of the song only picks another row and never needs OCR or classification.
+    Transposed chord names are built the same way, for all keys at once, the first time they are asked for.
+    """
 
-    return lines
+    def __init__(self, chart: List[Dict]):
+        self.chart = chart
+        self._chords = PackedChords.from_texts([chord for line in chart for chord in line["chords"].values()])
+        self.nashville = get_nashville_table().convert_all_keys(self._chords)   # (12, n), rows by key pitch class
+        self._transposed = {}
+
+    def nashville_data(self, key: Optional[str]) -> List[Dict]:
+        """The section in the P2PChords format for `key`: chords as Nashville numbers, unknown chords left out."""
+        key_pc = note_to_pitch_class(key.strip()) if key else None
+        numbers = iter(self.nashville[key_pc] if key_pc is not None else [None] * len(self._chords))
+        verse_data = []
+        for line in self.chart:
+            chords = [(position, number) for position, number in zip(line["chords"], numbers) if number is not None]
+            if not line["lyrics"]:      # Chord line without lyrics, its chords are numbered in order
+                chords = list(enumerate(number for _, number in chords))
+            verse_data.append({"lyrics": line["lyrics"], "chords": dict(chords)})
+        return verse_data
+
+    def transposed(self, key: str, to_key: str) -> List[Dict]:
+        """The chart of a song in `key` with the chord names transposed to `to_key`."""
+        if key not in self._transposed:
+            self._transposed[key] = get_nashville_table().transpose_all_keys(self._chords, key)
+        to_pc = note_to_pitch_class(to_key.strip()) if to_key else None
+        if to_pc is None or not len(self._chords):
+            return self.chart
+        names = iter(self._transposed[key][to_pc])
+        return [{"lyrics": line["lyrics"], "chords": {position: next(names) or chord
+                                                      for position, chord in line["chords"].items()}}
+                for line in self.chart]
 
 
 def process_ocr_result(ocr_result: list, key:str, name_of_part:str) -> tuple[str,str]:
-    verse_data = []
-    #current_line = {"lyrics": "", "chords": {}}
-    _chord = None
-    avg_x_pos_of_chord = None
-    
+    """Parse a raw PaddleOCR style result, see `process_detections`."""
+    return process_detections(Detections.from_ocr_result(ocr_result), key, name_of_part)
 
-    line_numbers = cluster_to_lines(ocr_result)
 
-    ### Maybe add a VERSE/CHORUS/BRIDGE/OUTRO/INTRO detection here
+def is_section_header(text: str) -> bool:
+    """Whether a line reads like a section header (VERSE 1, CHORUS, BRIDGE, ...)."""
+    return SECTION_HEADER.match(text.strip()) is not None
 
+
+def _char_position(x: float, tokens: List[Tuple[float, float, int, int]], t: int) -> Tuple[int, int]:
+    """
+    Character offset of x in the lyric line, starting the search at token `t`.
+    `tokens` are (start_x, width, offset in the lyric string, length) sorted by x.
+    Returns (position, token index to continue from), so a sorted sweep over x never looks back.
+    """
+    while t < len(tokens) and x >= tokens[t][0] + tokens[t][1]:
+        t += 1
+    if t == len(tokens):       # Right of the last word
+        start_x, width, offset, length = tokens[-1]
+        return offset + length, t
+    start_x, width, offset, length = tokens[t]
+    if x < start_x:             # In front of a word (or in a gap): the chord belongs to that word
+        return offset, t
+    char_width = width / length     # Each token has its own character width, fonts and scans vary
+    return offset + min(length - 1, int((x - start_x) / char_width)), t
+
+
+def align_chords_to_lyrics(lines: List[Dict]) -> List[Dict]:
+    """
+    Pair every chord line with the lyric line below it and map each chord's x-center to a character
+    offset of the lyrics. One sweep over the lines (top to bottom) and, inside a pair, over the chords
+    and words (left to right), so the cost is linear in the number of tokens.
+
+    Returns:
+        [{"lyrics": str, "chords": {position: chord}}] with the chords as written, see `SectionKeys` for
+        the Nashville numbers. A chord line without lyrics below it becomes a line with empty lyrics and
+        the chords numbered in order.
+    """
+    verse_data = []
+    pending_chords = None
+
+    def flush_chords_only(chord_data):
+        chords = sorted(chord_data.values(), key=lambda chord: chord['avg_x'])
+        verse_data.append({"lyrics": "", "chords": {i: chord['chord'] for i, chord in enumerate(chords)}})
+
+    for line in lines:
+        if line['type'] == 'chords':
+            if pending_chords is not None:
+                flush_chords_only(pending_chords)
+            pending_chords = line['data']
+            continue
+
+        words = sorted(line['data'].values(), key=lambda word: word['start_x'])
+        lyrics = " ".join(word['text'] for word in words)
+        if is_section_header(lyrics):
+            # Chords above a header belong to no lyrics, not to the first line below it
+            if pending_chords is not None:
+                flush_chords_only(pending_chords)
+                pending_chords = None
+            continue
+
+        tokens, offset = [], 0
+        for word in words:
+            if word['text']:
+                tokens.append((word['start_x'], word['avg_width'], offset, len(word['text'])))
+            offset += len(word['text']) + 1
+
+        chords = {}
+        if pending_chords is not None and tokens:
+            t = 0
+            for chord in sorted(pending_chords.values(), key=lambda chord: chord['avg_x']):
+                position, t = _char_position(chord['avg_x'], tokens, t)
+                while position in chords:       # Two chords over the same letter, keep both in order
+                    position += 1
+                chords[position] = chord['chord']
+        pending_chords = None
+        verse_data.append({"lyrics": lyrics, "chords": chords})
+
+    if pending_chords is not None:
+        flush_chords_only(pending_chords)
+    return verse_data
+
+
+def chart_detections(detections: Detections) -> List[Dict]:
+    """The key independent chart of a section, see `align_chords_to_lyrics`."""
     # For each line, check if it is a chord line or a lyric line
-    for i, line_nrs in enumerate(line_numbers): 
-        line_data = {}  
-        if all ([is_chord(ocr_result[0][nr][1][0]) for nr in line_nrs]):      # Is chordline
-            #print(f"Line {i} is a chord: {line_nrs} with data {[ocr_result[0][_][1][0] for _ in line_nrs ]}")
-            for nr in line_nrs:
-                bbox, (text, confidence) = ocr_result[0][nr]
-                avg_x_pos_of_chord = sum(bbox[_][0] for _ in range(4)) / 4
-                _chord = convert_chord_to_nashV(text.replace('?', '').replace('_', ''), key)
-                line_data[nr] = {'avg_x': avg_x_pos_of_chord, 'chord':_chord}
-            line_numbers[i] = {'type': 'chords' ,'data':line_data}
-            
-        else:
-            #print(f"Line {i} is a lyric: {line_nrs} with data {[ocr_result[0][_][1][0] for _ in line_nrs ]}")
-            for nr in line_nrs:
-                bbox, (text, confidence) = ocr_result[0][nr]                                       # Is lyricline
-                avg_width = sum([abs(bbox[1][0] - bbox[0][0]), abs(bbox[3][0] - bbox[2][0])]) / 2
-                start_x = min(bbox[_][0] for _ in range(4))   # könnte auch einfach bbox[0][0] oder bbox[2][0] sein
-                line_data[nr] = {'start_x': start_x, 'avg_width': avg_width, 'text': text, }
-                
-            line_numbers[i] = {'type': 'lyrics' ,'data':line_data}
-    
-    
-    ### Group into Lyrics and Chords pairs
-
-    ### get Position of Chords relative to Lyrics
-
-    return (name_of_part, verse_data)
-
-
-
-
-
-    #for i, item in enumerate(ocr_result):
-    #    bbox, text, _prob = item    # I think _ is prob, but not sure
-    #    print(text)
-    #    x = bbox[0][0]   # Komplett falsch
-    #    if text == "VERSE" or text == "CHORUS" or text == "BRIDGE" or text == "OUTRO" or text == "INTRO":
-    #        continue   ## Kann man vielleicht noch erweitern, um auch "PRE-CHORUS" oder "PRE-CHORUS 1" zu erkennen
-    #    
-    #    if is_chord(text):
-    #        avg_x_pos_of_chord = sum(bbox[_][0] for _ in range(4)) / 4
-    #        _chord = convert_chord_to_nashV(text.replace('?', '').replace('_', ''), key)
-#
-    #        
-    #    else:
-    #        avg_width = sum([abs(bbox[1][0] - bbox[0][0]), abs(bbox[3][0] - bbox[2][0])]) / 2
-    #        start_x = min(bbox[_][0] for _ in range(4))   # könnte auch einfach bbox[0][0] oder bbox[2][0] sein
-    #        if current_line["lyrics"]:
-    #            if avg_x_pos_of_chord:
-    #                processed_position = process_position(avg_x_pos_of_chord, start_x, avg_width, len(current_line["lyrics"]))
-    #                current_line["chords"][processed_position] = _chord
-    #            verse_data.append(current_line)
-    #            current_line = {"lyrics": "", "chords": {}}
-    #            avg_x_pos_of_chord = None
-    #        current_line["lyrics"] += text + " "
-    #    
-    #
-    #if current_line["lyrics"]:
-    #    verse_data.append(current_line)
-    #
-    #for line in verse_data:
-    #    line["lyrics"] = line["lyrics"].strip()
-    #
-    #return (name_of_part, verse_data)
+    with span("classify"):
+        lines = classify_lines(detections)
+
+    # Pair chord lines with the lyrics below and get the position of the chords in the lyrics
+    with span("align"):
+        return align_chords_to_lyrics(lines)
+
 
+def process_detections(detections: Detections, key:str, name_of_part:str) -> tuple[str,str]:
+    chart = chart_detections(detections)
+    with span("convert"):
+        return (name_of_part, SectionKeys(chart).nashville_data(key))
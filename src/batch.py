@@ -0,0 +1,135 @@
+"""
+Headless batch labeling: OCR every page of every PDF/image in a folder and write the P2PChords json.
+Nothing in here may import PyQt5, so it runs on workers without a display.
+"""
+import contextlib
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Iterator, List, Optional, Tuple
+
+from src.analyze_process import SectionKeys
+from src.chord_theory import estimate_key, note_to_pitch_class
+from src.export import SongbookWriter, build_song_json, write_song_json
+from src.layout import parse_page, parse_whole_page
+from src.ocr import PADDLE_CONFIG
+from src.ocr_cache import OCRCache
+from src.ocr_pool import OCRPool
+from src.page_source import PageSource
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+PDF_EXTENSIONS = ('.pdf',)
+
+# "Amazing Grace - G.pdf", "amazing_grace_(Bb).pdf", "Song [F#].png"
+_KEY_IN_FILENAME = re.compile(r"^(.*?)[\s_\-]*[\(\[]?([A-H][#b]?)[\)\]]?$")
+
+
+def key_from_filename(file_path: str) -> Tuple[str, Optional[str]]:
+    """Split a file name into (song name, key). The key is the trailing note name of the stem, if any."""
+    stem = os.path.splitext(os.path.basename(file_path))[0].strip()
+    match = _KEY_IN_FILENAME.match(stem)
+    if match and match.group(1) and note_to_pitch_class(match.group(2)) is not None:
+        return match.group(1).strip(" _-"), match.group(2)
+    return stem, None
+
+
+def iter_input_files(input_dir: str) -> Iterator[str]:
+    for name in sorted(os.listdir(input_dir)):
+        if name.lower().endswith(IMAGE_EXTENSIONS + PDF_EXTENSIONS):
+            yield os.path.join(input_dir, name)
+
+
+def _write_song(output_dir: str, file_path: str, song_name: str, key: Optional[str], futures: List[Future],
+                songbook: Optional[SongbookWriter] = None) -> int:
+    """Write the song once all its pages are done. Raises if a page failed, a song with pages missing is useless."""
+    errors = [f"page {page_nr}: {future.exception()}" for page_nr, future in enumerate(futures, start=1)
+              if future.exception() is not None]
+    if errors:
+        raise RuntimeError(", ".join(errors))
+    sections = [(proposal.name, SectionKeys(proposal.chart)) for future in futures for proposal in future.result()]
+    if key is None:
+        key = estimate_key(chord for _, keys in sections for line in keys.chart for chord in line["chords"].values())
+        print(f"{file_path}: estimated key {key or 'unknown (no chords)'}")
+    song = build_song_json(song_name, key, [(name, keys.nashville_data(key)) for name, keys in sections])
+    write_song_json(os.path.join(output_dir, os.path.splitext(os.path.basename(file_path))[0] + '.json'), song)
+    if songbook is not None:
+        songbook.write(song)
+    return len(futures)
+
+
+def run_batch(input_dir: str, output_dir: str, key: Optional[str] = None, key_from_name: bool = False,
+              workers: int = None, use_cache: bool = True, engine_config: dict = PADDLE_CONFIG,
+              detect_sections: bool = True, preprocess: dict = None, songbook: Optional[str] = None) -> List[str]:
+    """
+    Submit every page of every file to an OCRPool and write each song once all its pages are done.
+    Each page is OCR'd once and split at its section headers (VERSE 1, CHORUS, ...). Pages without
+    headers, or all pages if `detect_sections` is off, become one section named "Page <n>".
+    Songs without a key (neither `key` nor one in the file name) get the key estimated from their chords.
+    With `songbook` (a .jsonl or .msgpack path) every song is also appended to that one file as soon as
+    it is written. A file that cannot be read or has a page failing in OCR is skipped, the others go on.
+
+    Returns:
+        The files that were skipped.
+    """
+    parse = parse_page if detect_sections else parse_whole_page
+    os.makedirs(output_dir, exist_ok=True)
+
+    total_pages = songs = 0
+    failed = []
+    in_flight = deque()     # (file_path, song_name, key, futures) in submission order
+    cache = OCRCache() if use_cache else None
+    with OCRPool(workers=workers, cache=cache, engine_config=engine_config, preprocess=preprocess) as pool, \
+            (SongbookWriter(songbook) if songbook else contextlib.nullcontext()) as book:
+        start = time.perf_counter()
+
+        def write_finished(block: bool):
+            nonlocal total_pages, songs
+            while in_flight and (block or all(future.done() for future in in_flight[0][3])):
+                file_path, song_name, song_key, futures = in_flight.popleft()
+                try:
+                    pages = _write_song(output_dir, file_path, song_name, song_key, futures, book)
+                except Exception as e:
+                    print(f"Skipping {file_path}: {e}", file=sys.stderr)
+                    failed.append(file_path)
+                    continue
+                total_pages += pages
+                songs += 1
+                print(f"{file_path}: {pages} pages ({total_pages / (time.perf_counter() - start):.2f} pages/sec)")
+
+        for file_path in iter_input_files(input_dir):
+            song_name, file_key = key_from_filename(file_path)
+            song_key = file_key if key_from_name and file_key else key
+            futures = []
+            try:
+                # One page rasterized at a time, a broken PDF can fail on any of them
+                for page_nr, page in enumerate(PageSource(file_path), start=1):
+                    with pool.share_page(page) as shared:
+                        futures.append(pool.submit(shared, song_key, f"Page {page_nr}", parse=parse))
+            except Exception as e:
+                print(f"Skipping {file_path}: {e!r}", file=sys.stderr)
+                failed.append(file_path)
+                for future in futures:
+                    future.cancel()
+                continue
+            in_flight.append((file_path, song_name, song_key, futures))
+            write_finished(block=False)
+        write_finished(block=True)
+
+        elapsed = time.perf_counter() - start
+    if book is not None:
+        print(f"Songbook: {book.songs} songs in {songbook}")
+    if total_pages:
+        print(f"Done: {total_pages} pages in {elapsed:.1f}s, {total_pages / elapsed:.2f} pages/sec "
+              f"with {pool.workers} workers")
+    if failed:
+        print(f"Failed: {len(failed)} of {len(failed) + songs} files, see above", file=sys.stderr)
+    if cache is not None:
+        print(f"OCR cache: {cache.stats()}")
+    if pool.counters["ocr.tokens"]:
+        print(f"Two-tier OCR: {pool.counters['ocr.escalated']} of {pool.counters['ocr.tokens']} tokens escalated "
+              f"({pool.counters['ocr.escalated'] / pool.counters['ocr.tokens']:.1%}), fast pass "
+              f"{pool.stage_seconds['ocr.fast']:.1f}s, accurate pass {pool.stage_seconds['ocr.accurate']:.1f}s")
+    return failed
@@ -0,0 +1,969 @@
+"""
+Ad-hoc micro benchmarks. Run with `python -m src.benchmark [benchmark ...]` from the repository root.
+The end-to-end suite with per-stage timings, json reports and regression checks is src/benchmark_suite.py.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import time
+
+import numpy as np
+
+from src.analyze_process import (SectionKeys, align_chords_to_lyrics, classify_lines, cluster_to_lines, is_chord,
+                                 process_ocr_result)
+from src.chord_theory import (NASHVILLE_SYSTEM_PATH, MAJOR_SCALE, Chord, NashvilleTable, PackedChords, TRIADS,
+                               chord_mask, estimate_key, get_nashville_table, note_to_pitch_class, parse_chord)
+from src.detections import Detections
+from src.layout import propose_sections
+
+GOLDEN_FIXTURES = [("examples/1.ocr.json", "examples/1.expected.json")]
+LABELED_FIXTURES = ["examples/1.labels.json"]
+GOLDEN_SKEW_ANGLES = (-2.0, -0.5, 0.5, 1.0, 2.0)     # Degrees the golden pages are also rotated by
+SAMPLE_CHORDS = ["C", "G", "Am", "F", "Em7", "D/F#", "Cmaj7", "Bb", "F#m", "Hm", "Dsus4", "E7", "Bdim", "Db"]
+SYNTHETIC_CHORDS = ["C", "G", "Am", "F", "Em7", "D/F#", "F#m", "Hm", "E7", "C#"]     # All pass is_chord
+
+
+def _legacy_convert_chord_to_nashV(chord: str, key: str) -> str:
+    """The old per-chord conversion (re-reads the json for every chord), kept as baseline."""
+    nashville_system = json.load(open(NASHVILLE_SYSTEM_PATH))
+    if key not in nashville_system:
+        return None
+    base_chord = re.match(r"([A-G]#?m?)(.*)", chord)
+    if not base_chord:
+        return None
+    base_chord_name = base_chord.group(1)
+    for nash_num, nash_chord in nashville_system[key].items():
+        if (base_chord_name.endswith("m") and nash_chord.startswith(base_chord_name[:-1])):
+            return f'-{nash_num}'
+        if nash_chord == base_chord_name:
+            return f'{nash_num}'
+    return None
+
+
+def _legacy_is_chord(text: str) -> bool:
+    """The old length/marker heuristic, kept as baseline."""
+    text = text.upper()
+    if len(text) > 1:
+        return len(text) <= 4 and any(char in text for char in ["7", "6", "9", "m", "M", "maj", "dim", "aug", "sus",
+                                                                  "add", "°", "ø", "b", "#", "/"])
+    return text in {"C", "D", "E", "F", "G", "A", "B", "H"}
+
+
+# Spellings the chord grammar has to accept, with the record they have to parse to
+CORPUS_ROOTS = {"C": 0, "c": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11, "H": 11}
+CORPUS_ACCIDENTALS = {"": 0, "#": 1, "b": -1, "♯": 1, "♭": -1}
+CORPUS_QUALITIES = {"": "maj", "m": "min", "min": "min", "mi": "min", "-": "min", "dim": "dim", "°": "dim",
+                    "aug": "aug", "+": "aug", "ø": "hdim"}
+CORPUS_EXTENSIONS = ["", "7", "6", "9", "11", "13", "maj7", "M7", "Δ7", "sus4", "sus2", "sus", "add9", "7sus4",
+                     "7b9", "7#9", "7(#11)", "6/9", "5", "maj9#11", "alt"]
+CORPUS_BASSES = {"": None, "/E": 4, "/F#": 6, "/Bb": 10, "/H": 11, "/C♯": 1}
+# Lyric/header tokens that must not parse, many of them start with a root letter
+NON_CHORDS = ["a", "am", "be", "Be", "Bach", "Dad", "Cab", "Bbb", "Ebbe", "Am I", "Do", "Go", "Each", "Halleluja",
+              "Gott", "Chorus", "VERSE 1", "C7x", "Cmajj7", "G/b", "G/", "/G", "N.C.", "Amen", "Eh", "H2O", "Fine"]
+
+
+def chord_corpus(n: int, seed: int = 0) -> list:
+    """Random (text, expected Chord) pairs combined from the spelling tables above."""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(n):
+        root, accidental, quality = (rng.choice(list(CORPUS_ROOTS)), rng.choice(list(CORPUS_ACCIDENTALS)),
+                                     rng.choice(list(CORPUS_QUALITIES)))
+        extensions, bass = rng.choice(CORPUS_EXTENSIONS), rng.choice(list(CORPUS_BASSES))
+        if "/" in extensions and bass:      # "C6/9/E" is no chord
+            bass = ""
+        text = root + accidental + quality + extensions + bass
+        expected = Chord((CORPUS_ROOTS[root] + CORPUS_ACCIDENTALS[accidental]) % 12, CORPUS_QUALITIES[quality],
+                         extensions, CORPUS_BASSES[bass])
+        corpus.append((text, expected))
+    return corpus
+
+
+def check_chord_grammar(n: int = 20000, seed: int = 0) -> bool:
+    """
+    Properties of the chord grammar on a generated corpus: every generated chord parses to the record it was
+    built from, no chord followed by a lyric word parses, the Nashville number ignores extensions and bass,
+    none of the lyric tokens parses, and `chord_mask` agrees with `parse_chord` on all of them.
+    """
+    table = NashvilleTable.from_file()
+    failures = []
+    corpus = chord_corpus(n, seed)
+    for text, expected in corpus:
+        if parse_chord(text) != expected:
+            failures.append(f"{text!r}: {parse_chord(text)} != {expected}")
+        elif parse_chord(text + "ing") is not None or parse_chord(text + " me") is not None:
+            failures.append(f"{text!r} + word parses")
+        elif table.convert(text, "C") != table.matrix[0, expected.root, TRIADS.index(expected.head[1])]:
+            failures.append(f"{text!r}: Nashville number {table.convert(text, 'C')} != {expected.head}")
+    failures += [f"{text!r} parses" for text in NON_CHORDS if is_chord(text)]
+    texts = [text + suffix for text, _ in corpus for suffix in ("", "ing", " me")] + NON_CHORDS
+    mask = chord_mask(texts)
+    failures += [f"{text!r}: chord_mask {chord}" for text, chord in zip(texts, mask.tolist())
+                 if chord != is_chord(text)]
+    for failure in failures[:20]:
+        print(f"  {failure}")
+    print(f"chord grammar, {n} generated chords and {len(NON_CHORDS)} lyric tokens: "
+          f"{'ok' if not failures else f'{len(failures)} FAILURES'}")
+    return not failures
+
+
+def bench_chords(n: int = 1_000_000, n_unseen: int = 200_000, seed: int = 0):
+    """
+    Token classification throughput on a page-like mix of lyric words and chords. `parse_chord` caches per
+    spelling and a page repeats its few spellings, so the page mix runs mostly from the cache. The unseen mix
+    (every token a new spelling) and the uncached parse show what a cache miss costs. `chord_mask`, which
+    `classify_lines` uses, has no cache, the 1 M tokens/s goal is checked on it.
+    """
+    rng = random.Random(seed)
+    words = ["walking", "around", "these", "walls", "I", "thought", "by", "now", "they'd", "fall", "But", "you",
+             "have", "never", "failed", "me", "yet", "Gott", "Amen", "VERSE 1"]
+    chords = [text for text, _ in chord_corpus(2000, seed)]
+    tokens = [rng.choice(chords) if rng.random() < 0.4 else rng.choice(words) for _ in range(n)]
+    new_chords = iter(text for text, _ in chord_corpus(n_unseen, seed + 1))
+    unseen = [next(new_chords) if rng.random() < 0.4 else f"{rng.choice(words)}{nr}" for nr in range(n_unseen)]
+    parse_uncached = parse_chord.__wrapped__
+
+    legacy = _time_per_item(lambda: [_legacy_is_chord(text) for text in tokens], n)
+    parse_chord.cache_clear()
+    grammar = _time_per_item(lambda: [is_chord(text) for text in tokens], n)
+    parse_chord.cache_clear()
+    missed = _time_per_item(lambda: [is_chord(text) for text in unseen], n_unseen)
+    uncached = _time_per_item(lambda: [parse_uncached(text) for text in tokens], n)
+    mask = _time_per_item(lambda: chord_mask(tokens), n)
+    mask_unseen = _time_per_item(lambda: chord_mask(unseen), n_unseen)
+    print(f"chord classification, {n} tokens (40% chords, {len(chords)} spellings), {n_unseen} unseen tokens:")
+    print(f"  legacy heuristic:         {legacy * 1e9:7.0f} ns/token  {1 / legacy / 1e6:5.2f} M tokens/s")
+    print(f"  is_chord (grammar):       {grammar * 1e9:7.0f} ns/token  {1 / grammar / 1e6:5.2f} M tokens/s")
+    print(f"  is_chord, unseen tokens:  {missed * 1e9:7.0f} ns/token  {1 / missed / 1e6:5.2f} M tokens/s")
+    print(f"  parse_chord, no cache:    {uncached * 1e9:7.0f} ns/token  {1 / uncached / 1e6:5.2f} M tokens/s")
+    print(f"  chord_mask:               {mask * 1e9:7.0f} ns/token  {1 / mask / 1e6:5.2f} M tokens/s")
+    print(f"  chord_mask, unseen:       {mask_unseen * 1e9:7.0f} ns/token  {1 / mask_unseen / 1e6:5.2f} M tokens/s")
+    print(f"  1 M tokens/s without a cache: {'met' if max(mask, mask_unseen) <= 1e-6 else 'MISSED'}")
+
+
+def _time_per_item(func, n: int) -> float:
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) / n
+
+
+def bench_nashville(n: int = 20000, line_length: int = 8, seed: int = 0):
+    """Per-chord cost of the legacy conversion vs. the precompiled table."""
+    rng = random.Random(seed)
+    keys = ["C", "D", "E", "F", "G", "A", "B"]
+    lines = [([rng.choice(SAMPLE_CHORDS) for _ in range(line_length)], rng.choice(keys))
+             for _ in range(n // line_length)]
+    total = len(lines) * line_length
+
+    legacy = _time_per_item(lambda: [_legacy_convert_chord_to_nashV(c, key) for chords, key in lines for c in chords],
+                            total)
+    table = NashvilleTable.from_file()
+    single = _time_per_item(lambda: [table.convert(c, key) for chords, key in lines for c in chords], total)
+    batched = _time_per_item(lambda: [table.convert_many(chords, key) for chords, key in lines], total)
+
+    print(f"nashville conversion, {total} chords:")
+    print(f"  legacy (json per chord): {legacy * 1e6:8.2f} us/chord")
+    print(f"  table.convert:           {single * 1e6:8.2f} us/chord")
+    print(f"  table.convert_many:      {batched * 1e6:8.2f} us/chord  ({legacy / batched:.0f}x)")
+
+
+def _legacy_cluster_to_lines(ocr_result: list, y_threshold: int = 10) -> list:
+    """The old per-tuple line clustering, kept as reference."""
+    lines, current_line, current_y = [], [], None
+    for i, line in sorted(enumerate(ocr_result[0]), key=lambda item: item[1][0][0][1]):
+        bbox, (text, confidence) = line
+        avg_y = sum([point[1] for point in bbox]) / 4
+        if current_y is None or abs(avg_y - current_y) < y_threshold:
+            current_line.append(i)
+        else:
+            lines.append(current_line)
+            current_line = [i]
+        current_y = avg_y
+    if current_line:
+        lines.append(current_line)
+    return lines
+
+
+def synthetic_ocr_result(n_lines: int, tokens_per_line: int = 8, seed: int = 0) -> list:
+    """A fake page in PaddleOCR layout: a section header every 10 lines, alternating chord and lyric lines
+    in between, all with jittered boxes."""
+    rng = random.Random(seed)
+    page = []
+    for line_nr in range(n_lines):
+        y = 40 * line_nr + rng.uniform(-3, 3)
+        x = rng.uniform(0, 20)
+        if line_nr % 10 == 0:
+            page.append([[[x, y], [x + 100, y], [x + 100, y + 20], [x, y + 20]], (f"VERSE {line_nr // 10 + 1}", 0.99)])
+            continue
+        for _ in range(tokens_per_line):
+            text = rng.choice(SYNTHETIC_CHORDS) if line_nr % 2 == 0 else rng.choice(["walking", "around", "these", "walls"])
+            w, h = 12 * len(text), 20
+            dy = rng.uniform(-2, 2)
+            page.append([[[x, y + dy], [x + w, y + dy], [x + w, y + dy + h], [x, y + dy + h]], (text, rng.random())])
+            x += w + rng.uniform(10, 60)
+    rng.shuffle(page)
+    return [page]
+
+
+def _rotate_ocr_result(ocr_result: list, degrees: float) -> list:
+    """A PaddleOCR style result with every box rotated about the origin, like a skewed scan of the page."""
+    sin, cos = np.sin(np.deg2rad(degrees)), np.cos(np.deg2rad(degrees))
+    return [[[[[x * cos - y * sin, x * sin + y * cos] for x, y in bbox], result] for bbox, result in ocr_result[0]]]
+
+
+def check_golden() -> bool:
+    """
+    Compare line classification and alignment on the recorded OCR fixtures with the expected output, and the
+    line clustering of the fixtures rotated by GOLDEN_SKEW_ANGLES with the old per-tuple code.
+    """
+    ok = True
+    for ocr_path, expected_path in GOLDEN_FIXTURES:
+        with open(ocr_path) as f:
+            ocr_result = json.load(f)
+        with open(expected_path) as f:
+            expected = json.load(f)
+        lines = classify_lines(Detections.from_ocr_result(ocr_result))
+        verse_data = SectionKeys(align_chords_to_lyrics(lines)).nashville_data(expected["key"])
+        matches = (json.loads(json.dumps(lines)) == expected["lines"]
+                   and json.loads(json.dumps(verse_data)) == expected["verse_data"])
+        print(f"golden {ocr_path}: {'ok' if matches else 'MISMATCH'}")
+        skewed = [degrees for degrees in GOLDEN_SKEW_ANGLES
+                  if cluster_to_lines(_rotate_ocr_result(ocr_result, degrees))
+                  != _legacy_cluster_to_lines(_rotate_ocr_result(ocr_result, degrees))]
+        print(f"golden {ocr_path} skewed by {', '.join(map(str, GOLDEN_SKEW_ANGLES))} deg: "
+              f"{'ok' if not skewed else f'MISMATCH at {skewed}'}")
+        ok &= matches and not skewed
+    return ok
+
+
+def check_keys() -> bool:
+    """
+    Every key of nashville_system.json against the major scale: the json spells the scale degrees, the
+    Nashville table, `convert_all_keys` and `transpose_all_keys` give degree d to the root a scale step
+    above the key, and only to it.
+    """
+    table = NashvilleTable.from_file()
+    with open(NASHVILLE_SYSTEM_PATH) as f:
+        nashville_system = json.load(f)
+    scale_chords = PackedChords.from_texts(["C", "Dm", "Em", "F", "G", "Am", "Bdim"])
+    transposed = table.transpose_all_keys(scale_chords, "C")
+    failures = []
+    for key, degrees in nashville_system.items():
+        key_pc = note_to_pitch_class(key)
+        roots = [(key_pc + interval) % 12 for interval in MAJOR_SCALE]
+        written = [parse_chord(degrees[str(degree)]).root for degree in range(1, 8)]
+        if written != roots:
+            failures.append(f"{key}: json scale {written} != {roots}")
+        if sorted(np.flatnonzero(table.degrees[key_pc])) != sorted(roots):
+            failures.append(f"{key}: degrees on {np.flatnonzero(table.degrees[key_pc]).tolist()} != {roots}")
+        for degree, root in enumerate(roots, 1):
+            if table.degrees[key_pc, root] != degree or table.matrix[key_pc, root, TRIADS.index("min")] != f"-{degree}":
+                failures.append(f"{key}: degree {degree} not on pitch class {root}")
+            if note_to_pitch_class(table.spellings[key_pc, root]) != root:
+                failures.append(f"{key}: pitch class {root} spelled {table.spellings[key_pc, root]}")
+        names = transposed[key_pc].tolist()
+        if [parse_chord(name).root for name in names] != roots:
+            failures.append(f"{key}: C scale transposed to {names}")
+        for numbers in (table.convert_many(names, key),
+                        table.convert_all_keys(PackedChords.from_texts(names))[key_pc].tolist()):
+            if numbers != ["1", "-2", "-3", "4", "5", "-6", "7"]:
+                failures.append(f"{key}: {names} -> {numbers}")
+    for failure in failures[:20]:
+        print(f"  {failure}")
+    print(f"keys, {len(nashville_system)} scales: {'ok' if not failures else f'{len(failures)} FAILURES'}")
+    return not failures
+
+
+def bench_postprocess(n_lines: int = 100, tokens_per_line: int = 8, repeat: int = 20):
+    """Line clustering of a dense synthetic page, old per-tuple code vs. packed arrays."""
+    ocr_result = synthetic_ocr_result(n_lines, tokens_per_line)
+    assert _legacy_cluster_to_lines(ocr_result) == cluster_to_lines(ocr_result)
+
+    legacy = _time_per_item(lambda: [_legacy_cluster_to_lines(ocr_result) for _ in range(repeat)], repeat)
+    packed = _time_per_item(lambda: [cluster_to_lines(ocr_result) for _ in range(repeat)], repeat)
+    detections = Detections.from_ocr_result(ocr_result)
+    clustering = _time_per_item(lambda: [detections.line_order() for _ in range(repeat)], repeat)
+    classify = _time_per_item(lambda: [classify_lines(detections) for _ in range(repeat)], repeat)
+    layout = _time_per_item(lambda: [propose_sections(detections) for _ in range(repeat)], repeat)
+    end_to_end = _time_per_item(lambda: [process_ocr_result(ocr_result, "C", "Verse") for _ in range(repeat)], repeat)
+
+    print(f"post-processing, {len(detections)} tokens:")
+    print(f"  legacy cluster_to_lines:  {legacy * 1e3:8.3f} ms")
+    print(f"  cluster_to_lines (numpy): {packed * 1e3:8.3f} ms (incl. packing, {legacy / packed:.2f}x legacy)")
+    print(f"  Detections.line_order:    {clustering * 1e3:8.3f} ms")
+    print(f"  classify_lines:           {classify * 1e3:8.3f} ms")
+    print(f"  propose_sections:         {layout * 1e3:8.3f} ms")
+    print(f"  process_ocr_result:       {end_to_end * 1e3:8.3f} ms (packing to export)")
+
+
+def bench_alignment(sizes: tuple = (1000, 10000), tokens_per_line: int = 8):
+    """Chord/lyric alignment on synthetic pages, the time per token has to stay flat as pages grow."""
+    print("alignment:")
+    for n_lines in sizes:
+        lines = classify_lines(Detections.from_ocr_result(synthetic_ocr_result(n_lines, tokens_per_line)))
+        n_tokens = sum(len(line["data"]) for line in lines)
+        seconds = _time_per_item(lambda: align_chords_to_lyrics(lines), 1)
+        print(f"  {n_lines:6d} lines, {n_tokens:6d} tokens: {seconds * 1e3:8.2f} ms  "
+              f"({seconds / n_tokens * 1e6:.2f} us/token)")
+
+
+def _linear_query(store, rect):
+    """Region query by scanning all detections of the page, as before the y index, kept as baseline."""
+    x, y, w, h = rect
+    center_x = store.corners[:, :, 0].sum(axis=1) / 4
+    center_y = store.corners[:, :, 1].sum(axis=1) / 4
+    nrs = np.flatnonzero((center_x >= x) & (center_x < x + w) & (center_y >= y) & (center_y < y + h))
+    return store.ids[nrs], Detections(store.corners[nrs], [store.texts[nr] for nr in nrs], store.confidences[nrs])
+
+
+def bench_spatial_index(sizes: tuple = (100, 1000, 10000), n_queries: int = 2000, seed: int = 0):
+    """
+    Latency of the page detection queries a section drag/hover does, y index vs. a scan over the page, and
+    of merging the OCR of the whole page again (every detection a duplicate) into the store.
+    """
+    from src.ocr import records_from_paddle_layout
+    from src.page_detections import PageDetections
+
+    rng = random.Random(seed)
+    print("page detection queries (us per query, section sized rects of ~5 lines), merging the page again (ms):")
+    print(f"  {'detections':>10s} {'linear':>9s} {'query':>9s} {'intersect':>9s} {'band':>9s} {'nearest':>9s}"
+          f" {'+lines':>9s} {'merge':>9s}")
+    for size in sizes:
+        records = records_from_paddle_layout(synthetic_ocr_result(max(1, round(size / 7.3))))[:size]
+        store = PageDetections()
+        store.add((0, 0, 10 ** 6, 10 ** 6), records)
+        height = float(store.corners[:, :, 1].max())
+        rects = [(rng.uniform(0, 300), rng.uniform(0, height), rng.uniform(300, 900), 200) for _ in range(n_queries)]
+        assert all(np.array_equal(store.query(rect)[0], _linear_query(store, rect)[0]) for rect in rects[:50])
+        store.index()   # Built once after every OCR job, not per query
+
+        linear = _time_per_item(lambda: [_linear_query(store, rect) for rect in rects], n_queries)
+        query = _time_per_item(lambda: [store.query(rect) for rect in rects], n_queries)
+        intersecting = _time_per_item(lambda: [store.intersecting(rect) for rect in rects], n_queries)
+        band = _time_per_item(lambda: [store.band(y, y + h) for _, y, _, h in rects], n_queries)
+        nearest = _time_per_item(lambda: [store.nearest_line(y) for _, y, _, _ in rects], n_queries)
+        lines = _time_per_item(lambda: [store.query(rect)[1].lines() for rect in rects], n_queries)
+        merged = PageDetections.restore(store.covered, records)
+        start = time.perf_counter()
+        merged.add((0, 0, 10 ** 6, 10 ** 6), records)
+        merge = time.perf_counter() - start
+        assert len(merged) == len(store)
+        print(f"  {len(store):10d} {linear * 1e6:9.1f} {query * 1e6:9.1f} {intersecting * 1e6:9.1f} {band * 1e6:9.1f}"
+              f" {nearest * 1e6:9.1f} {lines * 1e6:9.1f} {merge * 1e3:9.1f}")
+
+
+def synthetic_song(nr: int, n_sections: int = 6, n_lines: int = 8, seed: int = 0) -> dict:
+    """A song shaped like the GUI/batch export: sections of lyric lines with chords at int positions."""
+    from src.export import build_song_json
+
+    rng = random.Random(seed * 1_000_003 + nr)
+    sections = []
+    for section_nr in range(n_sections):
+        lines = []
+        for _ in range(n_lines):
+            lyrics = " ".join(rng.choice(["walking", "around", "these", "walls", "I", "thought", "by", "now", "they'd", "fall"]) for _ in range(rng.randint(4, 9)))
+            positions = sorted(rng.sample(range(len(lyrics)), min(len(lyrics), rng.randint(1, 4))))
+            lines.append({"lyrics": lyrics, "chords": {position: rng.choice(["1", "4", "5", "-6", "2", "-3"])
+                                                       for position in positions}})
+        sections.append((f"VERSE {section_nr + 1}", lines))
+    return build_song_json(f"Song {nr}", "G", sections)
+
+
+PROGRESSIONS = [(1, 5, 6, 4), (1, 4, 5, 1), (6, 4, 1, 5), (2, 5, 1, 1), (1, 6, 4, 5), (4, 1, 5, 6), (1, 4, 6, 5),
+                (1, 1, 4, 1), (4, 5, 3, 6)]
+DEGREE_QUALITIES = {1: "", 2: "m", 3: "m", 4: "", 5: "", 6: "m", 7: "dim"}
+
+
+def synthetic_chart(key: str, n_lines: int = 16, seed: int = 0) -> list:
+    """
+    A key independent section chart (chords as written, see `SectionKeys`) in `key`, built from common
+    progressions with some extensions, slash chords and borrowed chords. Most charts end on the tonic.
+    """
+    table = get_nashville_table()
+    rng = random.Random(seed)
+    key_pc = note_to_pitch_class(key)
+    with open(NASHVILLE_SYSTEM_PATH) as f:
+        scale = {int(degree): chord for degree, chord in json.load(f)[key].items()}
+    roots = {degree: chord[:len(chord) - 3] if chord.endswith("dim") else chord for degree, chord in scale.items()}
+
+    def chord(degree):
+        if rng.random() < 0.05:     # Borrowed chord, e.g. bVII
+            return table.spellings[key_pc, (key_pc + 10) % 12]
+        name = roots[degree] + DEGREE_QUALITIES[degree] + rng.choice(["", "", "", "7", "sus4", "add9"])
+        return name + "/" + roots[(degree + 1) % 7 + 1] if rng.random() < 0.1 else name
+
+    progressions = [rng.choice(PROGRESSIONS) for _ in range(-(-n_lines // 2))]
+    degrees = [degree for progression in progressions for degree in progression]
+    if rng.random() < 0.7:
+        degrees.append(1)
+    chart = []
+    for nr in range(0, len(degrees), 2):
+        chart.append({"lyrics": "walking around these walls", "chords": {position: chord(degree) for position, degree
+                                                                         in zip((0, 14), degrees[nr:nr + 2])}})
+    return chart
+
+
+def bench_keys(n_sections: int = 100, n_songs: int = 500, seed: int = 0):
+    """
+    Nashville numbers of a section in all 12 keys: 12 `convert_many` calls against one `convert_all_keys`.
+    A key change of a song with `n_sections` sections: the old re-classification per section against picking
+    the rows of `SectionKeys`. Key estimation accuracy on synthetic charts in random keys.
+    """
+    from src.analyze_process import chart_detections
+
+    table = get_nashville_table()
+    keys = [key for key in table.key_names if key]
+    rng = random.Random(seed)
+    charts = [synthetic_chart(rng.choice(keys), seed=seed * 1_000_003 + nr) for nr in range(n_sections)]
+    chords = [[chord for line in chart for chord in line["chords"].values()] for chart in charts]
+    n_chords = sum(map(len, chords))
+
+    per_key = _time_per_item(lambda: [[table.convert_many(section, key) for key in keys] for section in chords],
+                             n_sections)
+    packed = [PackedChords.from_texts(section) for section in chords]
+    all_keys = _time_per_item(lambda: [table.convert_all_keys(section) for section in packed], n_sections)
+    sections = _time_per_item(lambda: [SectionKeys(chart) for chart in charts], n_sections)
+    print(f"nashville numbers in all 12 keys, {n_sections} sections, {n_chords / n_sections:.0f} chords each:")
+    print(f"  12x convert_many:           {per_key * 1e6:8.1f} us/section")
+    print(f"  convert_all_keys:           {all_keys * 1e6:8.1f} us/section  ({per_key / all_keys:.1f}x)")
+    print(f"  SectionKeys (parse + all):  {sections * 1e6:8.1f} us/section")
+
+    detections = Detections.from_ocr_result(synthetic_ocr_result(8))
+    section_keys = [SectionKeys(chart) for chart in charts]
+    reclassify = _time_per_item(lambda: [SectionKeys(chart_detections(detections)).nashville_data("A")
+                                         for _ in range(n_sections)], 1)
+    rerender = _time_per_item(lambda: [keys.nashville_data("A") for keys in section_keys], 1)
+    transposed = _time_per_item(lambda: [keys.transposed("G", "A") for keys in section_keys], 1)
+    print(f"key change of a song with {n_sections} sections:")
+    print(f"  classify + align again:     {reclassify * 1e3:8.2f} ms")
+    print(f"  SectionKeys.nashville_data: {rerender * 1e3:8.2f} ms")
+    print(f"  SectionKeys.transposed:     {transposed * 1e3:8.2f} ms")
+
+    correct = 0
+    for nr in range(n_songs):
+        key = rng.choice(keys)
+        song = [synthetic_chart(key, n_lines=rng.randint(4, 24), seed=seed * 7919 + nr) for _ in range(rng.randint(1, 4))]
+        correct += estimate_key(chord for chart in song for line in chart for chord in line["chords"].values()) == key
+    print(f"key estimation: {correct}/{n_songs} synthetic songs ({correct / n_songs:.1%})")
+
+
+def bench_export(n_songs: int = 1000):
+    """Export of `n_songs` songs: a json file per song as before, JSON Lines and msgpack songbooks."""
+    import tempfile
+
+    from src.export import write_song_json, write_songbook
+
+    songs = [synthetic_song(nr) for nr in range(n_songs)]
+    expected = json.loads(json.dumps(songs))    # What any of the formats has to read back as
+    try:
+        import msgpack
+    except ImportError:
+        msgpack = None
+
+    print(f"export of {n_songs} songs (6 sections of 8 lines each):")
+    with tempfile.TemporaryDirectory() as directory:
+        def json_files():
+            for nr, song in enumerate(songs):
+                write_song_json(os.path.join(directory, f"{nr}.json"), song)
+
+        formats = [("json files", json_files, None),
+                   ("jsonl", lambda: write_songbook(os.path.join(directory, "book.jsonl"), songs), "book.jsonl")]
+        if msgpack is not None:
+            formats.append(("msgpack", lambda: write_songbook(os.path.join(directory, "book.msgpack"), songs),
+                            "book.msgpack"))
+        else:
+            print("  (msgpack not installed, skipped)")
+
+        for name, export, book in formats:
+            seconds = min(_time_per_item(export, 1) for _ in range(3))
+            if book is None:
+                size = sum(os.path.getsize(os.path.join(directory, f"{nr}.json")) for nr in range(n_songs))
+            else:
+                size = os.path.getsize(os.path.join(directory, book))
+                with open(os.path.join(directory, book), "rb") as f:
+                    if book.endswith(".jsonl"):
+                        read_back = [json.loads(line) for line in f]
+                    else:
+                        read_back = list(msgpack.Unpacker(f, raw=False))
+                assert read_back == expected, f"{book} does not read back as the exported songs"
+            print(f"  {name:10s} {seconds * 1e3:8.1f} ms  {n_songs / seconds:8.0f} songs/s  {size / 1e6:6.2f} MB")
+
+
+def bench_project(n_pages: int = 200, sections_per_page: int = 5, page_shape: tuple = (2339, 1654, 3)):
+    """Reopening a project of `n_pages` A4 pages at OCR resolution, with sections and detections on every page."""
+    import tempfile
+    from types import SimpleNamespace
+
+    from src.ocr import records_from_paddle_layout
+    from src.project import Project
+
+    page = np.full(page_shape, 255, np.uint8)
+    preview = page[::2, ::2]
+    records = records_from_paddle_layout(synthetic_ocr_result(40))
+    verse = [{"lyrics": "Walking around these walls I thought by now they'd fall", "chords": {0: "1", 12: "4"}}] * 8
+    with tempfile.TemporaryDirectory() as directory:
+        source = SimpleNamespace(path="songbook.pdf", page_count=n_pages, preview_dpi=100, ocr_dpi=200, is_pdf=True)
+        project = Project.create(os.path.join(directory, "songbook.cslp"), source)
+        start = time.perf_counter()
+        for _ in range(n_pages):
+            project.pages.append(preview, page)
+        store_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for page_nr in range(n_pages):
+            project.add_detections(page_nr, (0, 0, page_shape[1], page_shape[0]), records)
+            for nr in range(sections_per_page):
+                project.save_section({"id": page_nr * sections_per_page + nr, "page": page_nr, "name": f"VERSE {nr}",
+                                      "rect": [0, nr * 200, 800, 200], "color": [255, 0, 0, 100], "ocr_data": verse})
+        queue_seconds = (time.perf_counter() - start) / (n_pages * (sections_per_page + 1))
+        project.close()
+        size = sum(os.path.getsize(os.path.join(project.directory, name)) for name in os.listdir(project.directory))
+
+        open_seconds = []
+        for _ in range(5):
+            start = time.perf_counter()
+            reopened = Project.open(project.directory)
+            state = reopened.load(page=0)
+            shown = reopened.pages.preview(0)
+            pixels = int(shown[::64, ::64].sum())     # Touch the page so its pixels are really read
+            store = reopened.page_detections(0)
+            open_seconds.append(time.perf_counter() - start)
+            reopened.close()
+    assert len(state.sections) == sections_per_page and state.next_id == n_pages * sections_per_page
+    assert len(store) == len(records) and pixels
+    print(f"project of {n_pages} pages ({size / 1e9:.2f} GB, {state.next_id} sections, "
+          f"{len(records)} detections per page):")
+    print(f"  storing pages:         {store_seconds / n_pages * 1e3:8.2f} ms/page (background thread)")
+    print(f"  autosave on GUI thread: {queue_seconds * 1e6:7.1f} us/record (queued, written by the project's thread)")
+    print(f"  reopen, first page:    {open_seconds[0] * 1e3:8.2f} ms right after writing, "
+          f"{min(open_seconds) * 1e3:.2f} ms at best")
+
+
+def _first_page_eager(pdf_path: str):
+    from pdf2image import convert_from_path
+
+    start = time.perf_counter()
+    first = convert_from_path(pdf_path)[0]
+    seconds = time.perf_counter() - start
+    assert first.width and first.height
+    return seconds
+
+
+def _first_page_lazy(pdf_path: str):
+    from src.page_source import PageSource
+
+    start = time.perf_counter()
+    first = PageSource(pdf_path).preview(0)
+    seconds = time.perf_counter() - start
+    assert first.size
+    return seconds
+
+
+def _measure_in_child(func, pdf_path: str, results):
+    try:
+        seconds = func(pdf_path)
+    except Exception as e:      # Reported by the parent, which would wait forever otherwise
+        results.put((None, repr(e)))
+        return
+    results.put((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))   # ru_maxrss is in KiB
+
+
+def bench_page_source(pdf_path: str):
+    """Time to first page and peak RSS of rasterizing everything (old upload) vs. the lazy PageSource."""
+    ctx = multiprocessing.get_context("spawn")
+    print(f"first page of {pdf_path}:")
+    for label, func in (("convert_from_path (all pages)", _first_page_eager),
+                        ("PageSource.preview(0)", _first_page_lazy)):
+        results = ctx.Queue()
+        process = ctx.Process(target=_measure_in_child, args=(func, pdf_path, results))   # Fresh process per peak RSS
+        process.start()
+        seconds, peak_mb = results.get()
+        process.join()
+        if seconds is None:
+            print(f"  {label:30s} failed: {peak_mb}")
+            continue
+        print(f"  {label:30s} {seconds * 1000:8.0f} ms  peak RSS {peak_mb:7.0f} MB")
+
+
+def bench_viewer(n_sections: int = 100, page_shape: tuple = (3508, 2480)):
+    """Frame time of adding one section: the old full-page repaint vs. overlay items in the PageViewer."""
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtGui import QBrush, QColor, QImage, QPainter, QPen, QPixmap
+    from PyQt5.QtWidgets import QApplication, QLabel
+
+    from src.widgets import PageViewer
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    rng = random.Random(0)
+    image = np.full((*page_shape, 3), 255, dtype=np.uint8)
+    rects = [(rng.randrange(0, page_shape[1] - 400), rng.randrange(0, page_shape[0] - 200), 400, 200)
+             for _ in range(n_sections)]
+    color = QColor(200, 50, 50, 100)
+
+    def legacy_add(label, sections):
+        # What repaint_image_with_sections did for every new section
+        img_copy = image.copy()
+        q_image = QImage(img_copy.data, page_shape[1], page_shape[0], 3 * page_shape[1], QImage.Format_RGB888)
+        pixmap = QPixmap.fromImage(q_image)
+        painter = QPainter(pixmap)
+        for x, y, w, h in sections:
+            painter.setBrush(QBrush(color))
+            painter.setPen(QPen(Qt.NoPen))
+            painter.drawRect(x, y, w, h)
+        painter.end()
+        label.setPixmap(pixmap)
+        label.repaint()
+
+    def frame_times(add):
+        times = []
+        for i in range(n_sections):
+            start = time.perf_counter()
+            add(i)
+            app.processEvents()
+            times.append(time.perf_counter() - start)
+        return times
+
+    label = QLabel()
+    label.resize(1000, 800)
+    label.show()
+    legacy = frame_times(lambda i: legacy_add(label, rects[:i + 1]))
+    label.close()
+
+    viewer = PageViewer()
+    viewer.resize(1000, 800)
+    viewer.show()
+    viewer.set_page(image)
+
+    def viewer_add(i):
+        viewer.add_section(i, rects[i], color)
+        viewer.viewport().repaint()
+
+    tiled = frame_times(viewer_add)
+    viewer.close()
+
+    print(f"adding a section to a {page_shape[1]}x{page_shape[0]} page:")
+    for label_text, times in (("legacy repaint", legacy), ("PageViewer", tiled)):
+        print(f"  {label_text:15s} first 10: {sum(times[:10]) / 10 * 1000:7.2f} ms/frame   "
+              f"last 10: {sum(times[-10:]) / 10 * 1000:7.2f} ms/frame")
+
+
+def _center_in(record, rect) -> bool:
+    x, y, w, h = rect
+    cx = sum(point[0] for point in record.bbox) / 4
+    cy = sum(point[1] for point in record.bbox) / 4
+    return x <= cx <= x + w and y <= cy <= y + h
+
+
+def evaluate_detections(records: list, labels: list) -> dict:
+    """
+    Accuracy against labeled tokens: a label counts as recognized if the detections centered inside
+    its rect read exactly the labeled text (joined left to right).
+    """
+    correct = chords = correct_chords = 0
+    for label in labels:
+        inside = sorted((r for r in records if _center_in(r, label["rect"])), key=lambda r: r.bbox[0][0])
+        ok = " ".join(r.text for r in inside) == label["text"]
+        correct += ok
+        if label["chord"]:
+            chords += 1
+            correct_chords += ok
+    return {"token_accuracy": correct / len(labels), "chord_accuracy": correct_chords / chords if chords else None}
+
+
+def bench_engines(engine_names: list, repeat: int = 3):
+    """Latency per region and accuracy on the labeled fixtures for every engine that can be loaded."""
+    import cv2
+
+    from src.ocr import DEFAULT_CONFIGS, create_engine
+
+    configs = [DEFAULT_CONFIGS.get(name) or {"engine": name} for name in engine_names]
+    for config in configs:
+        if config["engine"] == "fake":
+            config = dict(config, fixture=GOLDEN_FIXTURES[0][0])
+        try:
+            engine = create_engine(config)
+        except Exception as e:
+            print(f"{config['engine']}: not available ({e!r})")
+            continue
+        for label_path in LABELED_FIXTURES:
+            with open(label_path) as f:
+                fixture = json.load(f)
+            image = cv2.imread(fixture["image"])
+            engine.detect(image)    # Warm up
+            records = []
+            seconds = _time_per_item(lambda: records.extend(engine.detect(image) for _ in range(repeat)), repeat)
+            scores = evaluate_detections(records[-1], fixture["labels"])
+            print(f"{config['engine']:10s} {fixture['image']}: {seconds * 1000:8.1f} ms/region  "
+                  f"tokens {scores['token_accuracy']:.0%}  chords {scores['chord_accuracy']:.0%}")
+
+
+EXAMPLE_SECTION_BANDS = [(70, 150), (150, 229), (229, 298), (298, 385)]    # Chord + lyric line pairs of examples/1.png
+
+
+def bench_batching(engine_name: str = "paddleocr", sizes: tuple = (1, 10, 50)):
+    """
+    One engine call per section (what the per-section threads did) against one call for all pending
+    sections of a page (`detect_regions`). The page is examples/1.png stacked until it has enough sections.
+    """
+    import cv2
+
+    from src.ocr import DEFAULT_CONFIGS, detect_regions, create_engine
+
+    config = DEFAULT_CONFIGS.get(engine_name) or {"engine": engine_name}
+    if config["engine"] == "fake":
+        config = dict(config, fixture=GOLDEN_FIXTURES[0][0])
+    try:
+        engine = create_engine(config)
+    except Exception as e:
+        print(f"{config['engine']}: not available ({e!r})")
+        return
+    with open(LABELED_FIXTURES[0]) as f:
+        tile = cv2.imread(json.load(f)["image"])
+    tiles = -(-max(sizes) // len(EXAMPLE_SECTION_BANDS))
+    page = np.vstack([tile] * tiles)
+    bands = [(top + nr * tile.shape[0], bottom + nr * tile.shape[0])
+             for nr in range(tiles) for top, bottom in EXAMPLE_SECTION_BANDS]
+    engine.detect(page[:400])   # Warm up
+
+    print(f"{config['engine']}, sections of {page.shape[1]} px width:")
+    for n in sizes:
+        rects = [(0, top, page.shape[1], bottom - top) for top, bottom in bands[:n]]
+        start = time.perf_counter()
+        single = [engine.detect(page[y:y + h, x:x + w]) for x, y, w, h in rects]
+        single_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        batched = detect_regions(engine, page, rects)
+        batched_seconds = time.perf_counter() - start
+        print(f"  {n:3d} sections: per section {single_seconds * 1000:8.1f} ms ({single_seconds / n * 1000:6.1f} ms each, "
+              f"{sum(map(len, single))} boxes)  batched {batched_seconds * 1000:8.1f} ms "
+              f"({batched_seconds / n * 1000:6.1f} ms each, {sum(map(len, batched))} boxes)  "
+              f"x{single_seconds / batched_seconds:.2f}")
+
+
+def _sheet_variants(image):
+    """(name, image, 2x3 transform from the original) of scan problems, built from a clean sheet."""
+    import cv2
+
+    h, w = image.shape[:2]
+    variants = [("clean", image, np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64))]
+    rotation = cv2.getRotationMatrix2D((w / 2, h / 2), -2.0, 1.0)
+    variants.append(("skewed 2 deg", cv2.warpAffine(image, rotation, (w, h), borderValue=(255, 255, 255)), rotation))
+    photo = np.array([[3, 0, 0], [0, 3, 0]], dtype=np.float64)
+    variants.append(("3x photo", cv2.resize(image, None, fx=3, fy=3, interpolation=cv2.INTER_CUBIC), photo))
+    margins = np.array([[1, 0, 400], [0, 1, 600]], dtype=np.float64)
+    variants.append(("wide margins", cv2.copyMakeBorder(image, 600, 600, 400, 400, cv2.BORDER_CONSTANT,
+                                                        value=(255, 255, 255)), margins))
+    combined = cv2.getRotationMatrix2D((0, 0), 1.5, 3.0)
+    corners = np.array([[0, 0, 1], [w, 0, 1], [w, h, 1], [0, h, 1]], dtype=np.float64) @ combined.T
+    combined[:, 2] += (300, 600) - corners.min(axis=0)
+    size = np.ceil(corners.max(axis=0) - corners.min(axis=0) + (600, 1200)).astype(int)
+    variants.append(("3x, 1.5 deg, margins", cv2.warpAffine(image, combined, tuple(size),
+                                                            borderValue=(255, 255, 255)), combined))
+    return variants
+
+
+def _transform_rect(rect, matrix):
+    x, y, w, h = rect
+    corners = np.array([[x, y, 1], [x + w, y, 1], [x + w, y + h, 1], [x, y + h, 1]], dtype=np.float64) @ matrix.T
+    x0, y0 = corners.min(axis=0)
+    x1, y1 = corners.max(axis=0)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def bench_preprocess(engine_name: str = "paddleocr", repeat: int = 2):
+    """
+    OCR latency (preprocessing included, best of `repeat`), token/chord accuracy and the number of clustered
+    lines for every preprocessing step alone and the default pipeline, on scan problems made from the
+    labeled sheet.
+    """
+    import cv2
+
+    from src.ocr import DEFAULT_CONFIGS, create_engine
+    from src.preprocess import DEFAULT_PREPROCESS, STEPS, Preprocessor, detect_preprocessed, rotates_detections
+
+    config = DEFAULT_CONFIGS.get(engine_name) or {"engine": engine_name}
+    try:
+        engine = create_engine(config)
+    except Exception as e:
+        print(f"{config['engine']}: not available ({e!r})")
+        return
+    with open(LABELED_FIXTURES[0]) as f:
+        fixture = json.load(f)
+    with open(GOLDEN_FIXTURES[0][0]) as f:
+        reference_lines = len(Detections.from_ocr_result(json.load(f)).lines())
+    pipelines = [("none", [])] + [(step, [step]) for step in STEPS] + [("default", DEFAULT_PREPROCESS["steps"])]
+
+    image = cv2.imread(fixture["image"])
+    engine.detect(image)    # Warm up
+    print(f"{config['engine']}, {reference_lines} lines in the sheet")
+    for variant, variant_image, matrix in _sheet_variants(image):
+        labels = [dict(label, rect=_transform_rect(label["rect"], matrix)) for label in fixture["labels"]]
+        print(f"  {variant} ({variant_image.shape[1]}x{variant_image.shape[0]}):")
+        for name, steps in pipelines:
+            seconds = float("inf")
+            for _ in range(repeat):
+                preprocessor = Preprocessor({"steps": steps})   # Fresh, so its cache does not hide the steps
+                start = time.perf_counter()
+                records = detect_preprocessed(engine, variant_image, preprocessor)
+                seconds = min(seconds, time.perf_counter() - start)
+            scores = evaluate_detections(records, labels)
+            lines = Detections.from_records(records, rotates_detections({"steps": steps})).lines()
+            timings = ", ".join(f"{step} {t * 1000:.0f}" for step, t in preprocessor.timings.items())
+            print(f"    {name:22s} {seconds * 1000:7.0f} ms  tokens {scores['token_accuracy']:4.0%}  "
+                  f"chords {scores['chord_accuracy']:4.0%}  lines {len(lines):2d}"
+                  + (f"  ({timings} ms)" if timings else ""))
+
+
+def bench_two_tier(engine_name: str = "paddleocr", pages: tuple = ((1, 1), (2, 4))):
+    """
+    The two-tier engine (fast pass at half resolution without angle classification, unsure tokens re-read)
+    against the accurate pass on the whole image: share of escalated tokens, latency saved and accuracy. The
+    images are the labeled sheet stacked `tiles` times and scaled by `scale`, (2, 4) is about an A4 page
+    scanned at 300 DPI.
+    """
+    import cv2
+
+    from src.instrumentation import RECORDER
+    from src.ocr import DEFAULT_CONFIGS, create_engine
+
+    config = DEFAULT_CONFIGS.get(engine_name) or {"engine": engine_name}
+    two_tier_config = dict(DEFAULT_CONFIGS["two-tier"], fast=dict(config, use_angle_cls=False), accurate=config)
+    try:
+        accurate, two_tier = create_engine(config), create_engine(two_tier_config)
+    except Exception as e:
+        print(f"{config['engine']}: not available ({e!r})")
+        return
+    with open(LABELED_FIXTURES[0]) as f:
+        fixture = json.load(f)
+    sheet = cv2.imread(fixture["image"])
+    accurate.detect(sheet)      # Warm up
+    two_tier.detect(sheet)
+
+    print(f"{config['engine']}, accurate pass everywhere against two-tier "
+          f"(fast scale {two_tier.fast_scale}, min confidence {two_tier.min_confidence}):")
+    RECORDER.enable()
+    try:
+        for scale, tiles in pages:
+            image = np.vstack([sheet] * tiles)
+            if scale != 1:
+                image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+            labels = [dict(label, rect=[x * scale, (y + nr * sheet.shape[0]) * scale, w * scale, h * scale])
+                      for nr in range(tiles) for label in fixture["labels"] for x, y, w, h in [label["rect"]]]
+            start = time.perf_counter()
+            reference = accurate.detect(image)
+            accurate_seconds = time.perf_counter() - start
+            RECORDER.drain()
+            start = time.perf_counter()
+            records = two_tier.detect(image)
+            seconds = time.perf_counter() - start
+            tiers = dict(RECORDER.span_seconds)
+            _, counters = RECORDER.drain()
+            reference_scores, scores = evaluate_detections(reference, labels), evaluate_detections(records, labels)
+            print(f"  {image.shape[1]}x{image.shape[0]}: {counters.get('ocr.escalated', 0)} of "
+                  f"{counters.get('ocr.tokens', 0)} tokens escalated "
+                  f"({counters.get('ocr.escalated', 0) / max(counters.get('ocr.tokens', 0), 1):.0%})")
+            print(f"    accurate {accurate_seconds * 1000:7.0f} ms  tokens {reference_scores['token_accuracy']:4.0%}  "
+                  f"chords {reference_scores['chord_accuracy']:4.0%}")
+            print(f"    two-tier {seconds * 1000:7.0f} ms  tokens {scores['token_accuracy']:4.0%}  "
+                  f"chords {scores['chord_accuracy']:4.0%}  (fast {tiers.get('ocr.fast', 0) * 1000:.0f} ms, accurate "
+                  f"{tiers.get('ocr.accurate', 0) * 1000:.0f} ms)  saved {(accurate_seconds - seconds) * 1000:.0f} ms "
+                  f"({1 - seconds / accurate_seconds:.0%})")
+    finally:
+        RECORDER.enable(False)
+
+
+def _no_parse(records, key, name_of_part, level_skew=False):
+    return None
+
+
+def bench_dispatch(n_jobs: int = 20, page_shape: tuple = (3508, 2480, 3)):
+    """
+    Bytes pickled per job and job round trip through an OCRPool with an instant fake engine: the page
+    array in the job (the pickle baseline) against a shared page where the job only carries the rect.
+    """
+    import pickle
+
+    from src.ocr_pool import OCRPool
+
+    page = np.random.default_rng(0).integers(0, 255, page_shape, dtype=np.uint8)    # 300 DPI A4
+    config = {"engine": "fake", "fixture": GOLDEN_FIXTURES[0][0]}
+    with OCRPool(workers=1, engine_config=config) as pool:
+        while pool.ready_workers < 1:
+            time.sleep(0.05)
+        start = time.perf_counter()
+        shared = pool.share_page(page)
+        share_seconds = time.perf_counter() - start
+        for name, roi in [("pickled page", page), ("shared page", shared)]:
+            job = (0, roi if roi is page else shared.region(), [("Page", None)], "G", _no_parse)
+            job_bytes = len(pickle.dumps(job, protocol=pickle.HIGHEST_PROTOCOL))
+            pool.submit(roi, "G", "Page", parse=_no_parse).result()    # Warm up
+            seconds = _time_per_item(lambda: [pool.submit(roi, "G", "Page", parse=_no_parse).result()
+                                              for _ in range(n_jobs)], n_jobs)
+            start = time.perf_counter()
+            for future in [pool.submit(roi, "G", "Page", parse=_no_parse) for _ in range(n_jobs)]:
+                future.result()
+            burst = (time.perf_counter() - start) / n_jobs
+            print(f"{name:13s} {job_bytes:>12,d} bytes per job  round trip {seconds * 1000:7.2f} ms  "
+                  f"{burst * 1000:7.2f} ms per job in a burst of {n_jobs}")
+        shared.release()
+    print(f"(sharing copied the {page.nbytes / 1e6:.1f} MB page once, in {share_seconds * 1000:.1f} ms)")
+
+
+BENCHMARKS = ["golden", "chords", "nashville", "postprocess", "alignment", "spatial", "export", "project", "pages",
+              "keys", "engines", "viewer", "batching", "dispatch", "preprocess", "two-tier"]
+DEFAULT_BENCHMARKS = ["golden", "chords", "nashville", "postprocess", "alignment"]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="python -m src.benchmark")
+    # No `choices`: argparse checks the default of a nargs="*" positional against them and rejects it
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                        help=f"Some of {', '.join(BENCHMARKS)} (default: {' '.join(DEFAULT_BENCHMARKS)})")
+    parser.add_argument("--pdf", help="PDF for the 'pages' benchmark, required for it")
+    parser.add_argument("--engine", action="append",
+                        help="Engine for the 'engines' (can be repeated), 'preprocess', 'batching' and 'two-tier' "
+                             "benchmarks, a name of DEFAULT_CONFIGS or an engine like rapidocr-onnxruntime")
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks {', '.join(sorted(unknown))}")
+    if "pages" in args.benchmarks and not args.pdf:
+        parser.error("the 'pages' benchmark needs --pdf")
+    args.benchmarks = args.benchmarks or DEFAULT_BENCHMARKS
+
+    if "golden" in args.benchmarks and not (check_golden() & check_keys() & check_chord_grammar()):
+        sys.exit(1)
+    if "chords" in args.benchmarks:
+        bench_chords()
+    if "nashville" in args.benchmarks:
+        bench_nashville()
+    if "postprocess" in args.benchmarks:
+        bench_postprocess()
+    if "alignment" in args.benchmarks:
+        bench_alignment()
+    if "spatial" in args.benchmarks:
+        bench_spatial_index()
+    if "keys" in args.benchmarks:
+        bench_keys()
+    if "export" in args.benchmarks:
+        bench_export()
+    if "project" in args.benchmarks:
+        bench_project()
+    if "pages" in args.benchmarks:
+        bench_page_source(args.pdf)
+    if "viewer" in args.benchmarks:
+        bench_viewer()
+    if "engines" in args.benchmarks:
+        bench_engines(args.engine or ["fake", "paddleocr", "easyocr"])
+    if "dispatch" in args.benchmarks:
+        bench_dispatch()
+    if "preprocess" in args.benchmarks:
+        bench_preprocess(*(args.engine or [])[:1])
+    if "batching" in args.benchmarks:
+        bench_batching(*(args.engine or [])[:1])
+    if "two-tier" in args.benchmarks:
+        bench_two_tier(*(args.engine or [])[:1])
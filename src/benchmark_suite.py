@@ -0,0 +1,189 @@
+"""
+End-to-end benchmark suite: times every stage of the pipeline (rasterize, preprocess, OCR, cluster,
+classify, convert, align, export) on the recorded fixtures and on synthetic pages of growing size,
+writes a json report and fails if a stage got slower than in a baseline report.
+
+    python -m src.benchmark_suite [--live ENGINE] [--report PATH] [--baseline PATH] [--threshold 0.25]
+
+Without `--live` the OCR stage replays the recorded engine output, so the suite runs without any model.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from src.analyze_process import SectionKeys, align_chords_to_lyrics, classify_lines
+from src.benchmark import GOLDEN_FIXTURES, check_golden, synthetic_ocr_result
+from src.detections import Detections
+from src.export import build_song_json
+from src.ocr import records_from_paddle_layout
+
+STAGES = ["rasterize", "preprocess", "ocr", "cluster", "classify", "convert", "align", "export"]
+SCALING_STAGES = ["cluster", "classify", "convert", "align", "export"]
+SCALING_LINES = (125, 1250, 12500)      # About 1k, 10k and 100k tokens
+DEFAULT_REPORT = "benchmark_report.json"
+
+
+def best_seconds(func: Callable, repeat: int) -> float:
+    """Fastest of `repeat` runs with the garbage collector off, like timeit: slower runs only measure
+    interference from other processes or a collection triggered by an earlier stage."""
+    gc.collect()
+    gc.disable()
+    try:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+    finally:
+        gc.enable()
+    return best
+
+
+def time_postprocess(records: list, key: str, repeat: int) -> Dict[str, float]:
+    """Seconds of the stages after OCR for one page of detections."""
+    detections = Detections.from_records(records)
+    lines = classify_lines(detections)
+    chart = align_chords_to_lyrics(lines)
+    verse_data = SectionKeys(chart).nashville_data(key)
+    return {
+        "cluster": best_seconds(lambda: Detections.from_records(records).line_order(), repeat),
+        "classify": best_seconds(lambda: classify_lines(detections), repeat),
+        "convert": best_seconds(lambda: SectionKeys(chart).nashville_data(key), repeat),
+        "align": best_seconds(lambda: align_chords_to_lyrics(lines), repeat),
+        "export": best_seconds(lambda: json.dumps(build_song_json("Benchmark", key, [("VERSE 1", verse_data)]),
+                                                    indent=4), repeat),
+    }
+
+
+def run_fixtures(engine=None, repeat: int = 7) -> Dict[str, Dict[str, float]]:
+    """Stage timings per golden fixture. `engine` runs the OCR stage live, otherwise the recording is replayed."""
+    from src.page_source import PageSource
+    from src.preprocess import Preprocessor
+
+    results = {}
+    for ocr_path, expected_path in GOLDEN_FIXTURES:
+        with open(expected_path) as f:
+            key = json.load(f)["key"]
+        image_path = ocr_path.replace(".ocr.json", ".png")     # examples/1.ocr.json was recorded from examples/1.png
+        image = PageSource(image_path).page(0)
+
+        if engine is None:
+            def ocr():
+                with open(ocr_path) as f:
+                    return records_from_paddle_layout(json.load(f))
+        else:
+            def ocr():
+                return engine.detect(image)
+        records = ocr()
+
+        timings = {
+            "rasterize": best_seconds(lambda: PageSource(image_path).page(0), repeat),
+            "preprocess": best_seconds(lambda: Preprocessor()(image), repeat),
+            "ocr": best_seconds(ocr, 1 if engine is not None else repeat),
+        }
+        timings.update(time_postprocess(records, key, repeat))
+        results[ocr_path] = timings
+    return results
+
+
+def run_scaling(sizes: tuple = SCALING_LINES, repeat: int = 5) -> Dict[str, Dict[str, float]]:
+    """Stage timings on synthetic pages, keyed by their number of tokens."""
+    results = {}
+    for n_lines in sizes:
+        records = records_from_paddle_layout(synthetic_ocr_result(n_lines))
+        results[str(len(records))] = time_postprocess(records, "G", repeat)
+    return results
+
+
+def growth_exponents(scaling: Dict[str, Dict[str, float]]) -> Dict[str, float]:
+    """Slope of log(time) over log(tokens) between the smallest and largest page, 1.0 is linear."""
+    sizes = sorted(scaling, key=int)
+    small, large = sizes[0], sizes[-1]
+    ratio = np.log(int(large) / int(small))
+    return {stage: float(np.log(scaling[large][stage] / scaling[small][stage]) / ratio)
+            for stage in scaling[small]}
+
+
+def find_regressions(report: dict, baseline: dict, threshold: float, min_seconds: float) -> List[str]:
+    """Stages that are more than `threshold` slower than in `baseline`. Stages faster than `min_seconds` in
+    the baseline are timer noise and skipped."""
+    regressions = []
+    for group in ("fixtures", "scaling"):
+        for name, timings in report.get(group, {}).items():
+            for stage, seconds in timings.items():
+                before = baseline.get(group, {}).get(name, {}).get(stage)
+                if before is None or before < min_seconds:
+                    continue
+                if seconds > before * (1 + threshold):
+                    regressions.append(f"{group}/{name}/{stage}: {before * 1e3:.3f} ms -> {seconds * 1e3:.3f} ms "
+                                       f"(+{seconds / before - 1:.0%})")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m src.benchmark_suite")
+    parser.add_argument("--live", metavar="ENGINE", help="Run the OCR stage with this engine instead of the recording")
+    parser.add_argument("--report", default=DEFAULT_REPORT, help=f"Where to write the json report ({DEFAULT_REPORT})")
+    parser.add_argument("--baseline", help="Earlier report to compare against, regressions make the run fail")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed slowdown per stage (0.25 = 25%%)")
+    parser.add_argument("--min-ms", type=float, default=0.05, help="Ignore stages faster than this in the baseline")
+    parser.add_argument("--no-scaling", action="store_true", help="Skip the synthetic pages")
+    args = parser.parse_args(argv)
+
+    engine = None
+    if args.live:
+        from src.ocr import DEFAULT_CONFIGS, create_engine
+
+        engine = create_engine(DEFAULT_CONFIGS.get(args.live) or {"engine": args.live})
+        engine.detect(np.full((64, 256, 3), 255, np.uint8))     # Load and warm up outside the timings
+
+    golden_ok = check_golden()
+    report = {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                 "numpy": np.__version__, "machine": platform.machine(), "cpus": os.cpu_count(),
+                 "ocr": args.live or "recorded"},
+        "golden_ok": golden_ok,
+        "fixtures": run_fixtures(engine),
+    }
+    for name, timings in report["fixtures"].items():
+        print(f"{name}:")
+        for stage in STAGES:
+            print(f"  {stage:10s} {timings[stage] * 1e3:10.3f} ms")
+
+    if not args.no_scaling:
+        report["scaling"] = run_scaling()
+        report["growth"] = growth_exponents(report["scaling"])
+        print("synthetic pages (ms, growth exponent over the token count, 1.0 = linear):")
+        print("  " + " " * 10 + "".join(f"{n + ' tokens':>16s}" for n in report["scaling"]) + "    growth")
+        for stage in SCALING_STAGES:
+            print(f"  {stage:10s}" + "".join(f"{timings[stage] * 1e3:16.3f}" for timings in report["scaling"].values())
+                  + f"    {report['growth'][stage]:6.2f}")
+
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.report}")
+
+    failed = not golden_ok
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("ocr") != report["meta"]["ocr"]:
+            print(f"Note: baseline OCR mode is {baseline['meta'].get('ocr')}, this run is {report['meta']['ocr']}")
+        regressions = find_regressions(report, baseline, args.threshold, args.min_ms / 1e3)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if not regressions:
+            print(f"No stage more than {args.threshold:.0%} slower than {args.baseline}")
+        failed |= bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+import json
+import os
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+NASHVILLE_SYSTEM_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                     "assets", "nashville_system.json")
+
+# Pitch classes of the natural notes. "H" is the german spelling of B.
+NATURAL_PITCH_CLASSES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11, "H": 11}
+ACCIDENTALS = {"": 0, "#": 1, "b": -1}
+
+# Chord grammar: root, accidental, quality, extensions, slash bass. A lowercase "c" root is accepted because
+# OCR often reads the C glyph in lowercase, no other letter is folded ("a", "e", ... are words).
+# The extensions never give back a character the slash bass could use, so they are matched possessively (*+).
+_CHORD = re.compile(
+    r"(?P<root>[A-Hc][#b♯♭]?)"
+    r"(?P<quality>min|mi|m(?!aj)|-|dim|°|aug|\+|ø)?"
+    r"(?P<extensions>(?:6/9|(?:maj|Maj|ma|M|Δ|add|sus|[#b♯♭+-])?(?:1[13]|[245679])|maj|sus|alt|[()])*+)"
+    r"(?:/(?P<bass>[A-H][#b♯♭]?))?")
+# The grammar for every token of a newline joined text, so a whole page is classified in one regex pass
+_CHORD_TOKEN = re.compile("\n(?:" + re.sub(r"\(\?P<\w+>", "(?:", _CHORD.pattern) + ")(?=\n)")
+_QUALITIES = {None: "maj", "min": "min", "mi": "min", "m": "min", "-": "min",
+              "dim": "dim", "°": "dim", "aug": "aug", "+": "aug", "ø": "hdim"}
+_TRIADS = {"maj": "maj", "min": "min", "dim": "dim", "aug": "maj", "hdim": "dim"}    # Qualities of the Nashville table
+_ROOT_CHARS = frozenset("ABCDEFGHc")
+# Pitch class of every root/bass spelling the grammar accepts, so parsing does no arithmetic
+_SPELLED_PITCH_CLASSES = {note + accidental: (NATURAL_PITCH_CLASSES[note.upper()] + offset) % 12
+                          for note in "ABCDEFGHc"
+                          for accidental, offset in (("", 0), ("#", 1), ("♯", 1), ("b", -1), ("♭", -1))}
+
+
+class Chord(NamedTuple):
+    root: int                   # Pitch class 0-11
+    quality: str                # "maj", "min", "dim", "aug" or "hdim" (half diminished)
+    extensions: str             # Everything between quality and slash as written, e.g. "7", "maj7", "sus4", "add9"
+    bass: Optional[int] = None  # Pitch class of the slash bass
+
+    @property
+    def head(self) -> Tuple[int, str]:
+        """(root, "maj"/"min"/"dim"), the part the Nashville number depends on."""
+        return self.root, _TRIADS[self.quality]
+
+
+MAJOR_SCALE = (0, 2, 4, 5, 7, 9, 11)     # Semitones of the degrees 1-7 above the key
+_new_tuple = tuple.__new__
+TRIADS = ("maj", "min", "dim")      # The qualities of the Nashville table, `PackedChords.triads` index into it
+_TRIAD_NRS = {quality: TRIADS.index(triad) for quality, triad in _TRIADS.items()}    # Chord.quality -> TRIADS index
+# Weight of every degree when a chord fits the scale of a key, see `NashvilleTable.estimate_key`
+DEGREE_WEIGHTS = {1: 2.0, 2: 0.6, 3: 0.5, 4: 1.0, 5: 1.0, 6: 0.8, 7: 0.3}
+OFF_SCALE_WEIGHT = -0.5
+
+
+class PackedChords(NamedTuple):
+    """
+    Parsed chords as arrays, for converting or transposing many chords at once. Roots and basses are pitch
+    classes (intervals above C), so nothing in here depends on a key.
+    """
+    roots: np.ndarray           # (n,) pitch class of the root, -1 if the text is no chord
+    triads: np.ndarray          # (n,) index into TRIADS
+    basses: np.ndarray          # (n,) pitch class of the slash bass, -1 if there is none
+    suffixes: np.ndarray        # (n,) object array of quality and extensions as written, e.g. "m7", "maj7", "sus4"
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[str]) -> "PackedChords":
+        parsed = [(text, parse_chord(text)) for text in texts]
+        roots = np.array([chord.root if chord else -1 for _, chord in parsed], dtype=np.int64)
+        triads = np.array([TRIADS.index(chord.head[1]) if chord else 0 for _, chord in parsed], dtype=np.int64)
+        basses = np.array([chord.bass if chord and chord.bass is not None else -1 for _, chord in parsed],
+                          dtype=np.int64)
+        suffixes = np.empty(len(parsed), dtype=object)
+        suffixes[:] = [_suffix(text, chord) if chord else "" for text, chord in parsed]
+        return cls(roots, triads, basses, suffixes)
+
+    def __len__(self) -> int:
+        return len(self.roots)
+
+
+def _suffix(text: str, chord: Chord) -> str:
+    """What is written between the root and the slash bass."""
+    start = 2 if len(text) > 1 and text[1] in "#b♯♭" else 1
+    return text[start:text.rindex("/")] if chord.bass is not None else text[start:]
+
+
+def note_to_pitch_class(note: str) -> Optional[int]:
+    """Pitch class (0-11) of a note name like "C", "Bb", "A#", "E#" or "H"."""
+    if not note or note[0] not in NATURAL_PITCH_CLASSES:
+        return None
+    accidental = note[1:]
+    if accidental not in ACCIDENTALS:
+        return None
+    return (NATURAL_PITCH_CLASSES[note[0]] + ACCIDENTALS[accidental]) % 12
+
+
+@lru_cache(maxsize=65536)
+def parse_chord(text: str) -> Optional[Chord]:
+    """
+    Parse a whole token as chord in one pass of the compiled grammar, None if it is no chord.
+    F#m7 -> Chord(6, "min", "7"), Cmaj7 -> Chord(0, "maj", "maj7"), G/B -> Chord(7, "maj", "", 11).
+    """
+    if not text or text[0] not in _ROOT_CHARS:    # Most lyric tokens end here, without running the regex
+        return None
+    match = _CHORD.fullmatch(text)
+    if match is None:
+        return None
+    root, quality, extensions, bass = match.groups()
+    # tuple.__new__ skips the argument handling of the NamedTuple constructor
+    return _new_tuple(Chord, (_SPELLED_PITCH_CLASSES[root], _QUALITIES[quality], extensions,
+                              _SPELLED_PITCH_CLASSES.get(bass)))
+
+
+def chord_mask(texts: List[str]) -> np.ndarray:
+    """
+    `parse_chord(text) is not None` for every text, with one pass of the grammar over all texts instead of
+    a call per text. Costs the same for spellings `parse_chord` has not seen before.
+    """
+    joined = "\n" + "\n".join(texts) + "\n"
+    if joined.count("\n") != len(texts) + 1:     # Texts with line breaks of their own, or no texts
+        return np.fromiter((parse_chord(text) is not None for text in texts), dtype=bool, count=len(texts))
+    ends = np.cumsum(np.fromiter(map(len, texts), dtype=np.intp, count=len(texts)) + 1)
+    starts = np.fromiter((match.start() for match in _CHORD_TOKEN.finditer(joined)), dtype=np.intp)
+    mask = np.zeros(len(texts), dtype=bool)
+    mask[np.searchsorted(ends, starts, side="right")] = True
+    return mask
+
+
+def parse_chord_head(chord: str) -> Optional[Tuple[int, str]]:
+    """
+    Reduce a chord to (root pitch class, quality) where quality is "maj", "min" or "dim".
+    Extensions and bass are ignored, e.g. F#m7 -> (6, "min"), Cmaj7 -> (0, "maj").
+    """
+    parsed = parse_chord(chord)
+    return parsed.head if parsed else None
+
+
+class NashvilleTable:
+    """
+    Precomputed (key, root, quality) -> Nashville degree lookup built once from nashville_system.json.
+    Keys and chords are resolved by pitch class, so enharmonic spellings (Bb/A#, Db/C#, H/B) share entries.
+    The degree of a root comes from the major scale intervals, the json gives the chord qualities and spellings.
+    """
+
+    def __init__(self, nashville_system: Dict[str, Dict[str, str]]):
+        self.key_names = [None] * 12
+        self.matrix = np.full((12, 12, len(TRIADS)), None, dtype=object)
+        self.degrees = np.zeros((12, 12), dtype=np.int64)   # Scale degree of every root in every key, 0 if off the scale
+        self.spellings = np.empty((12, 12), dtype=object)   # How every pitch class is written in every key
+        for key, degrees in nashville_system.items():
+            key_pc = note_to_pitch_class(key)
+            if key_pc is None or self.key_names[key_pc] is not None:
+                continue
+            self.key_names[key_pc] = key
+            for nash_num, nash_chord in degrees.items():
+                chord = parse_chord(nash_chord)
+                if chord is None:
+                    continue
+                root_pc = (key_pc + MAJOR_SCALE[int(nash_num) - 1]) % 12
+                self.degrees[key_pc, root_pc] = int(nash_num)
+                # Minor chords are written as negative degrees of the root, whatever the diatonic quality
+                self.matrix[key_pc, root_pc, TRIADS.index("min")] = f"-{nash_num}"
+                if chord.head[1] != "min":
+                    self.matrix[key_pc, root_pc, TRIADS.index(chord.head[1])] = f"{nash_num}"
+                if chord.root == root_pc:
+                    self.spellings[key_pc, root_pc] = nash_chord[:len(nash_chord) - len(_suffix(nash_chord, chord))]
+        # Pitch classes off the scale are written like the key of that pitch class
+        for key_pc in range(12):
+            for pc in range(12):
+                if self.spellings[key_pc, pc] is None:
+                    self.spellings[key_pc, pc] = self.key_names[pc]
+        weights = np.array([OFF_SCALE_WEIGHT] + [DEGREE_WEIGHTS[degree] for degree in range(1, 8)])
+        self.key_weights = weights[self.degrees]
+        # The matrix as nested lists for the per chord lookups, indexing them is much cheaper than a numpy scalar
+        self._numbers = self.matrix.tolist()
+
+    @classmethod
+    def from_file(cls, path: str = NASHVILLE_SYSTEM_PATH) -> "NashvilleTable":
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def convert(self, chord: str, key: str) -> Optional[str]:
+        parsed = parse_chord(chord)
+        key_pc = note_to_pitch_class(key.strip()) if key else None
+        if parsed is None or key_pc is None:
+            return None
+        return self._numbers[key_pc][parsed.root][_TRIAD_NRS[parsed.quality]]
+
+    def convert_many(self, chords: Iterable[str], key: str) -> List[Optional[str]]:
+        """
+        Convert a whole chord line to Nashville numbers in one call. Unknown chords/keys become None. The key
+        is resolved once for the line, for many chords in many keys use `convert_all_keys`.
+        """
+        key_pc = note_to_pitch_class(key.strip()) if key else None
+        if key_pc is None:
+            return [None for _ in chords]
+        numbers = self._numbers[key_pc]
+        return [numbers[chord.root][_TRIAD_NRS[chord.quality]] if chord is not None else None
+                for chord in map(parse_chord, chords)]
+
+    def convert_all_keys(self, chords: PackedChords) -> np.ndarray:
+        """
+        (12, n) object array: the Nashville number of every chord read in every key (rows by pitch class of
+        the key, see `key_names`), None where `convert_many` gives None. One lookup for all keys.
+        """
+        numbers = self.matrix[:, np.maximum(chords.roots, 0), chords.triads]
+        numbers[:, chords.roots < 0] = None
+        return numbers
+
+    def transpose_all_keys(self, chords: PackedChords, key: str) -> np.ndarray:
+        """
+        (12, n) object array: the chords of a song in `key` transposed into every key (rows by pitch class of
+        the target key), spelled like the scale of the target key in the json. None for texts that are no chords.
+        """
+        key_pc = note_to_pitch_class(key.strip()) if key else None
+        if key_pc is None:
+            return np.full((12, len(chords)), None, dtype=object)
+        targets = np.arange(12)[:, None]
+        shifts = targets - key_pc
+        names = self.spellings[targets, (chords.roots + shifts) % 12] + chords.suffixes
+        basses = "/" + self.spellings[targets, (chords.basses + shifts) % 12]
+        names = np.where(chords.basses >= 0, names + basses, names)
+        names[:, chords.roots < 0] = None
+        return names
+
+    def estimate_key(self, chords: PackedChords) -> Optional[str]:
+        """
+        The key whose scale fits the histogram of the chord roots best: every chord scores the weight of its
+        degree in the key (the tonic most, roots off the scale count against it). Songs mostly start and even
+        more often end on the tonic, so the first chord counts twice and the last three times. None if there
+        are no chords.
+        """
+        roots = chords.roots[chords.roots >= 0]
+        if not len(roots):
+            return None
+        histogram = np.bincount(roots, minlength=12).astype(np.float64)
+        np.add.at(histogram, roots[[0, -1, -1]], 1)
+        return self.key_names[int(np.argmax(self.key_weights @ histogram))]
+
+
+def estimate_key(chords: Iterable[str]) -> Optional[str]:
+    """Key of a song from its chord texts, see `NashvilleTable.estimate_key`."""
+    return get_nashville_table().estimate_key(PackedChords.from_texts(chords))
+
+
+@lru_cache(maxsize=None)
+def get_nashville_table() -> NashvilleTable:
+    """The shared table, loaded from disk on first use only."""
+    return NashvilleTable.from_file()
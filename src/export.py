@@ -0,0 +1,102 @@
+"""
+P2PChords export. A song is written as indented json (.json) or as msgpack (.msgpack), a songbook of many
+songs is streamed one song at a time as JSON Lines (.jsonl) or as a stream of msgpack maps (.msgpack),
+so writing it never holds more than one serialized song in memory.
+
+msgpack is optional and only imported when a msgpack file is written. The msgpack files carry the same
+structure as the json: the chord positions are written as string keys like json.dump writes them.
+"""
+import json
+from typing import Iterable, Optional, Tuple
+
+from src.instrumentation import span
+
+MSGPACK_EXTENSIONS = (".msgpack", ".mpk")
+
+
+def build_song_json(song_name: Optional[str], key: Optional[str], sections: Iterable[Tuple[str, list]]) -> dict:
+    """Build the P2PChords export structure from (section name, ocr data) pairs."""
+    data = {
+        "header": {
+            "name": song_name or "Untitled",
+            "key": key or "Unknown",
+            "authors": []
+        },
+        "data": {}
+    }
+    for name, ocr_data in sections:
+        data["data"][name] = ocr_data
+    return data
+
+
+def write_song_json(file_path: str, song: dict):
+    with span("export"), open(file_path, 'w') as f:
+        json.dump(song, f, indent=4)
+
+
+def _msgpack_packer():
+    import msgpack
+
+    return msgpack.Packer(use_bin_type=True)
+
+
+def _json_keys(value):
+    """`value` with every dict key as string, the way json.dump writes the int chord positions."""
+    if isinstance(value, dict):
+        return {key if isinstance(key, str) else str(key): _json_keys(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_keys(item) for item in value]
+    return value
+
+
+def write_song_msgpack(file_path: str, song: dict):
+    packer = _msgpack_packer()
+    with span("export"), open(file_path, 'wb') as f:
+        f.write(packer.pack(_json_keys(song)))
+
+
+def write_song(file_path: str, song: dict):
+    """Write one song, msgpack for a .msgpack/.mpk file and json otherwise."""
+    if file_path.lower().endswith(MSGPACK_EXTENSIONS):
+        write_song_msgpack(file_path, song)
+    else:
+        write_song_json(file_path, song)
+
+
+class SongbookWriter:
+    """
+    Streams songs into one songbook file as they are written: one compact json object per line for
+    .jsonl, consecutive msgpack maps (read them back with msgpack.Unpacker) for .msgpack/.mpk.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.songs = 0
+        binary = file_path.lower().endswith(MSGPACK_EXTENSIONS)
+        self._pack = _msgpack_packer().pack if binary else None
+        self._file = open(file_path, 'wb' if binary else 'w', encoding=None if binary else 'utf-8')
+
+    def write(self, song: dict):
+        with span("export"):
+            if self._pack is not None:
+                self._file.write(self._pack(_json_keys(song)))
+            else:
+                self._file.write(json.dumps(song, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self.songs += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> "SongbookWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_songbook(file_path: str, songs: Iterable[dict]) -> int:
+    """Stream `songs` into a .jsonl or .msgpack songbook, returns the number of songs written."""
+    with SongbookWriter(file_path) as writer:
+        for song in songs:
+            writer.write(song)
+    return writer.songs
@@ -0,0 +1,173 @@
+"""
+Timing spans and counters for the labeling pipeline, exportable as Chrome trace json (chrome://tracing,
+Perfetto) or as a Prometheus text file. Spans cost one global check while recording is off.
+
+OCR worker processes record into their own recorder and hand their events back with every result,
+so a trace of the GUI or a batch run contains the inference of all workers.
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from typing import Dict, List, Tuple
+
+Event = Tuple[str, float, float, int, int, dict]     # (name, start, duration, pid, tid, args), seconds
+
+
+class Recorder:
+    """
+    Args:
+        max_events: Spans kept for the trace, the oldest are dropped first. The per-span totals used for
+            the Prometheus export are kept regardless.
+    """
+
+    def __init__(self, max_events: int = 200_000):
+        self.enabled = False
+        self.events = deque(maxlen=max_events)
+        self.counters = Counter()
+        self.span_seconds = defaultdict(float)
+        self.span_counts = Counter()
+        self._lock = threading.Lock()
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    @contextlib.contextmanager
+    def _span(self, name: str, args: dict):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.perf_counter() - start, args=args)
+
+    def span(self, name: str, **args):
+        """`with span("classify"): ...` records the wall time of the block."""
+        if not self.enabled:
+            return _NO_SPAN
+        return self._span(name, args)
+
+    def add_span(self, name: str, start: float, duration: float, pid: int = None, tid: int = None,
+                 args: dict = None):
+        event = (name, start, duration, pid or os.getpid(), tid or threading.get_ident(), args or {})
+        with self._lock:
+            self.events.append(event)
+            self.span_seconds[name] += duration
+            self.span_counts[name] += 1
+
+    def count(self, name: str, value: int = 1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += value
+
+    def drain(self) -> Tuple[List[Event], Dict[str, int]]:
+        """Take all events and counters recorded so far, used by the OCR workers after every job."""
+        with self._lock:
+            events, counters = list(self.events), dict(self.counters)
+            self.events.clear()
+            self.counters.clear()
+            self.span_seconds.clear()
+            self.span_counts.clear()
+        return events, counters
+
+    def merge(self, events: List[Event], counters: Dict[str, int]):
+        if not self.enabled:
+            return
+        for name, start, duration, pid, tid, args in events:
+            self.add_span(name, start, duration, pid, tid, args)
+        with self._lock:
+            self.counters.update(counters)
+
+    def write_chrome_trace(self, path: str):
+        with self._lock:
+            events, counters = list(self.events), dict(self.counters)
+        trace = [{"name": name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": pid, "tid": tid,
+                  "args": args} for name, start, duration, pid, tid, args in events]
+        end = max((start + duration for _, start, duration, _, _, _ in events), default=time.perf_counter())
+        trace += [{"name": name, "ph": "C", "ts": end * 1e6, "pid": os.getpid(), "args": {name: value}}
+                  for name, value in counters.items()]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+    def write_prometheus(self, path: str, prefix: str = "chordsheet"):
+        with self._lock:
+            seconds, counts, counters = dict(self.span_seconds), dict(self.span_counts), dict(self.counters)
+        lines = [f"# TYPE {prefix}_span_seconds summary"]
+        for name in sorted(seconds):
+            lines.append(f'{prefix}_span_seconds_sum{{span="{name}"}} {seconds[name]:.6f}')
+            lines.append(f'{prefix}_span_seconds_count{{span="{name}"}} {counts[name]}')
+        for name in sorted(counters):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {counters[name]}")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+_NO_SPAN = contextlib.nullcontext()
+
+RECORDER = Recorder()
+span = RECORDER.span
+count = RECORDER.count
+
+
+@contextlib.contextmanager
+def recording(trace: str = None, metrics: str = None, sample_profile: str = None):
+    """Record spans while the block runs if a trace or metrics file is wanted and write the files after it."""
+    if trace or metrics:
+        RECORDER.enable()
+    profiler = SamplingProfiler(sample_profile).start() if sample_profile else None
+    try:
+        yield RECORDER
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        if trace:
+            RECORDER.write_chrome_trace(trace)
+        if metrics:
+            RECORDER.write_prometheus(metrics)
+        RECORDER.enable(False)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread every `interval` seconds and writes the counts as collapsed stacks
+    (`frame;frame;frame count` per line), the input format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, path: str, interval: float = 0.005, thread_id: int = None):
+        self.path = path
+        self.interval = interval
+        self.thread_id = thread_id or threading.main_thread().ident
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self) -> "SamplingProfiler":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        with open(self.path, "w") as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
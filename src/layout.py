@@ -0,0 +1,90 @@
+"""
+Page layout pass: find the section headers (VERSE 1, CHORUS, BRIDGE, ...) in the detections of a whole
+page and propose one named region per section, so a page needs one OCR call instead of one per section.
+"""
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from src.analyze_process import chart_detections, is_section_header
+from src.detections import Detections
+
+
+class SectionProposal(NamedTuple):
+    name: str
+    rect: Tuple[int, int, int, int]     # (x, y, w, h) in pixels of the OCR'd page
+    chart: list                         # Key independent section, as returned by `chart_detections`
+
+
+def find_headers(detections: Detections, y_threshold: int = 10) -> List[Tuple[str, List[int]]]:
+    """(header text, detection indices of the header line) for every line that reads like a section header."""
+    headers = []
+    for line in detections.lines(y_threshold):
+        line = sorted(line, key=lambda nr: detections.start_x[nr])
+        text = " ".join(detections.texts[nr] for nr in line)
+        if is_section_header(text):
+            headers.append((" ".join(text.upper().replace(":", " ").split()), line))
+    return headers
+
+
+def propose_sections(detections: Detections, fallback_name: str = "Page", y_threshold: int = 10) -> List[SectionProposal]:
+    """
+    Split a page at its section headers. A section reaches from its header down to the next header,
+    everything above the first header (title, author, ...) is ignored. Without any header the whole
+    page is returned as a single section named `fallback_name`.
+    """
+    if not len(detections):
+        return []
+    headers = find_headers(detections, y_threshold)
+    if not headers:
+        return [SectionProposal(fallback_name, _bounding_rect(detections, range(len(detections))),
+                                chart_detections(detections))]
+
+    top_y = detections.corners[:, :, 1].min(axis=1)
+    header_tops = [top_y[line].min() for _, line in headers] + [np.inf]
+    header_nrs = {nr for _, line in headers for nr in line}
+
+    proposals = []
+    seen = {}
+    for (name, line), start, end in zip(headers, header_tops, header_tops[1:]):
+        in_section = (detections.center_y > start) & (detections.center_y < end)
+        body = [nr for nr in np.flatnonzero(in_section) if nr not in header_nrs]
+
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1:      # Repeated chorus etc., the export is keyed by section name
+            name = f"{name} ({seen[name]})"
+
+        sub = detections.subset(body)
+        proposals.append(SectionProposal(name, _bounding_rect(detections, line + body),
+                                         chart_detections(sub) if body else []))
+    return proposals
+
+
+def _bounding_rect(detections: Detections, indices) -> Tuple[int, int, int, int]:
+    corners = detections.corners[list(indices)]
+    x0, y0 = corners[:, :, 0].min(), corners[:, :, 1].min()
+    x1, y1 = corners[:, :, 0].max(), corners[:, :, 1].max()
+    return int(x0), int(y0), int(np.ceil(x1 - x0)), int(np.ceil(y1 - y0))
+
+
+def parse_page(records: list, key: str, name_of_page: str, level_skew: bool = False) -> List[SectionProposal]:
+    """
+    OCRPool parser for whole pages: detections of one page -> section proposals. The proposals do not depend
+    on `key`, see `SectionKeys`.
+    """
+    return propose_sections(Detections.from_records(records, level_skew), fallback_name=name_of_page)
+
+
+def parse_page_keep_records(records: list, key: str, name_of_page: str,
+                            level_skew: bool = False) -> Tuple[list, List[SectionProposal]]:
+    """`parse_page` that also returns the detections, for the GUI's page detection store."""
+    return records, parse_page(records, key, name_of_page, level_skew)
+
+
+def parse_whole_page(records: list, key: str, name_of_page: str, level_skew: bool = False) -> List[SectionProposal]:
+    """OCRPool parser for pages without header detection: the page is one section."""
+    detections = Detections.from_records(records, level_skew)
+    if not len(detections):
+        return []
+    return [SectionProposal(name_of_page, _bounding_rect(detections, range(len(detections))),
+                            chart_detections(detections))]
@@ -1,28 +1,271 @@
+"""
+OCR engines behind one interface. Every engine returns the same normalized `Detection` records,
+whatever layout the underlying library uses.
+"""
+import json
+import time
+from typing import Dict, List, NamedTuple, Tuple, Type
 
-from PyQt5.QtCore import QThread, pyqtSignal
-import cv2
 import numpy as np
 
-from src.analyze_process import process_ocr_result
+from src.chord_theory import chord_mask
+from src.detections import Detections
+from src.instrumentation import count, span
 
 
-class OCRWorker(QThread):
-    finished = pyqtSignal(str, tuple)
+class Detection(NamedTuple):
+    bbox: Tuple[Tuple[float, float], ...]   # Four corners: top-left, top-right, bottom-right, bottom-left
+    text: str
+    confidence: float
 
-    def __init__(self, image, region, reader, key, name_of_part):
-        super().__init__()
-        self.image = image
-        self.region = region
-        
-        self.reader = reader
-        self.key = key
-        self.name_of_part = name_of_part
 
-    def run(self):
-        x, y, w, h = self.region
-        roi = self.image[y:y+h, x:x+w]
+def records_from_paddle_layout(ocr_result: list) -> List[Detection]:
+    """Convert PaddleOCR's `[page][i] = (bbox, (text, confidence))` of a single page."""
+    page = ocr_result[0] if ocr_result else None
+    return [Detection(tuple((float(x), float(y)) for x, y in bbox), text, float(confidence))
+            for bbox, (text, confidence) in page or []]
 
-        result = self.readeer.ocr(roi)
-        final_json = process_ocr_result(result, self.key, self.name_of_part)
-        
-        self.finished.emit(str(self.region), tuple(final_json))
+
+def records_to_paddle_layout(records: List[Detection]) -> list:
+    return [[[[list(point) for point in record.bbox], (record.text, record.confidence)] for record in records]]
+
+
+class OCREngine:
+    """
+    Base class of the engines. `config` is a plain dict (engine name plus settings), so it can be
+    sent to worker processes and is used as part of the OCR cache key.
+    """
+    name = None
+
+    def __init__(self, config: dict):
+        self.config = config
+
+    def detect(self, image: np.ndarray) -> List[Detection]:
+        raise NotImplementedError
+
+    def recognize(self, crops: List[np.ndarray]) -> List[Tuple[str, float]]:
+        """
+        (text, confidence) of every crop, each read as one token. Engines that can run recognition without
+        text detection override this, here the crop goes through `detect` and its boxes are joined.
+        """
+        results = []
+        for crop in crops:
+            records = sorted(self.detect(crop), key=lambda record: min(x for x, _ in record.bbox))
+            results.append((" ".join(record.text for record in records),
+                            min((record.confidence for record in records), default=0.0)))
+        return results
+
+
+class PaddleEngine(OCREngine):
+    name = "paddleocr"
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        from paddleocr import PaddleOCR
+
+        self.use_angle_cls = config.get("use_angle_cls", True)
+        self.reader = PaddleOCR(use_angle_cls=self.use_angle_cls, lang=config.get("lang", "en"), show_log=False)
+
+    def detect(self, image: np.ndarray) -> List[Detection]:
+        return records_from_paddle_layout(self.reader.ocr(image, cls=self.use_angle_cls))
+
+    def recognize(self, crops: List[np.ndarray]) -> List[Tuple[str, float]]:
+        # Without detection PaddleOCR returns [[(text, confidence)]]
+        results = [self.reader.ocr(crop, det=False, cls=self.use_angle_cls) for crop in crops]
+        return [(result[0][0][0], float(result[0][0][1])) if result and result[0] else ("", 0.0)
+                for result in results]
+
+
+class EasyOCREngine(OCREngine):
+    name = "easyocr"
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        import easyocr
+
+        self.reader = easyocr.Reader(config.get("langs", ["de", "en"]), gpu=config.get("gpu", False), verbose=False)
+
+    def detect(self, image: np.ndarray) -> List[Detection]:
+        # easyocr returns (bbox, text, confidence) with integer numpy corners
+        return [Detection(tuple((float(x), float(y)) for x, y in bbox), text, float(confidence))
+                for bbox, text, confidence in self.reader.readtext(image)]
+
+    def recognize(self, crops: List[np.ndarray]) -> List[Tuple[str, float]]:
+        results = []
+        for crop in crops:
+            parts = self.reader.recognize(crop)     # The whole crop as one box
+            results.append((" ".join(text for _, text, _ in parts),
+                            min((float(confidence) for _, _, confidence in parts), default=0.0)))
+        return results
+
+
+class RapidOCREngine(OCREngine):
+    """The PP-OCR models on onnxruntime (rapidocr-onnxruntime), ships its models in the wheel."""
+    name = "rapidocr-onnxruntime"
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        from rapidocr_onnxruntime import RapidOCR
+
+        self.use_angle_cls = config.get("use_angle_cls", True)
+        self.reader = RapidOCR()
+
+    def detect(self, image: np.ndarray) -> List[Detection]:
+        result, _ = self.reader(image, use_cls=self.use_angle_cls)
+        return [Detection(tuple((float(x), float(y)) for x, y in bbox), text, float(confidence))
+                for bbox, text, confidence in result or []]
+
+    def recognize(self, crops: List[np.ndarray]) -> List[Tuple[str, float]]:
+        results = []
+        for crop in crops:
+            result, _ = self.reader(crop, use_det=False, use_cls=self.use_angle_cls)
+            results.append((result[0][0], float(result[0][1])) if result else ("", 0.0))
+        return results
+
+
+class FakeEngine(OCREngine):
+    """
+    Deterministic stand-in for tests and benchmarks: returns the detections recorded in `fixture`
+    (a json file in PaddleOCR layout) for every image, optionally after sleeping `latency` seconds.
+    """
+    name = "fake"
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        with open(config["fixture"]) as f:
+            self.records = records_from_paddle_layout(json.load(f))
+        self.latency = config.get("latency", 0.0)
+
+    def detect(self, image: np.ndarray) -> List[Detection]:
+        if self.latency:
+            time.sleep(self.latency)
+        return list(self.records)
+
+
+def escalation_candidates(records: List[Detection], min_confidence: float, max_word: int = 15,
+                          y_threshold: float = 10) -> List[int]:
+    """
+    Numbers of the records a fast OCR pass is unsure about: the ones below `min_confidence`, the ones with a
+    word longer than `max_word` characters (spaces get lost at low resolution, "Walkingaroundthesewalls") and
+    the ones that do not parse as a chord on a line where most tokens are chords (a misread chord, e.g. "G?").
+    """
+    unsure = {nr for nr, record in enumerate(records)
+              if record.confidence < min_confidence or max(map(len, record.text.split()), default=0) > max_word}
+    if records:
+        chords = chord_mask([record.text for record in records]).tolist()
+        for line in Detections.from_records(records).lines(y_threshold):
+            if 2 * sum(chords[nr] for nr in line) > len(line):
+                unsure.update(nr for nr in line if not chords[nr])
+    return sorted(unsure)
+
+
+def crop_record(image: np.ndarray, record: Detection, padding: float) -> np.ndarray:
+    """The axis aligned box of `record` in `image`, grown by `padding` times the box height on every side."""
+    xs, ys = [x for x, _ in record.bbox], [y for _, y in record.bbox]
+    pad = padding * (max(ys) - min(ys))
+    x0, y0 = max(0, int(min(xs) - pad)), max(0, int(min(ys) - pad))
+    x1, y1 = min(image.shape[1], int(np.ceil(max(xs) + pad))), min(image.shape[0], int(np.ceil(max(ys) + pad)))
+    return image[y0:y1, x0:x1]
+
+
+class TwoTierEngine(OCREngine):
+    """
+    A fast pass over the whole image (the `fast` engine config, run on the image scaled by `fast_scale`),
+    then only the tokens it is unsure about (see `escalation_candidates`) are cropped from the full resolution
+    image and read again by the `accurate` engine. The crops skip text detection, the fast pass already
+    found the boxes. Counts the tokens and escalated tokens ("ocr.tokens", "ocr.escalated") and times the
+    tiers ("ocr.fast", "ocr.accurate") through src.instrumentation.
+    """
+    name = "two-tier"
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.fast = create_engine(config["fast"])
+        self.accurate = self.fast if config["accurate"] == config["fast"] else create_engine(config["accurate"])
+        self.fast_scale = config.get("fast_scale", 0.5)
+        self.min_confidence = config.get("min_confidence", 0.9)
+        self.max_word = config.get("max_word", 15)
+        self.crop_padding = config.get("crop_padding", 0.25)
+
+    def detect(self, image: np.ndarray) -> List[Detection]:
+        with span("ocr.fast"):
+            records = self.fast_pass(image)
+        escalate = escalation_candidates(records, self.min_confidence, self.max_word)
+        count("ocr.tokens", len(records))
+        count("ocr.escalated", len(escalate))
+        if escalate:
+            with span("ocr.accurate", tokens=len(escalate)):
+                crops = [crop_record(image, records[nr], self.crop_padding) for nr in escalate]
+                for nr, (text, confidence) in zip(escalate, self.accurate.recognize(crops)):
+                    if text.strip():    # Nothing read, the fast result is better than none
+                        records[nr] = records[nr]._replace(text=text.strip(), confidence=confidence)
+        return records
+
+    def fast_pass(self, image: np.ndarray) -> List[Detection]:
+        """The fast engine on the scaled image, with the boxes in coordinates of `image`."""
+        if self.fast_scale >= 1:
+            return self.fast.detect(image)
+        import cv2
+
+        scaled = cv2.resize(image, None, fx=self.fast_scale, fy=self.fast_scale, interpolation=cv2.INTER_AREA)
+        return [record._replace(bbox=tuple((x / self.fast_scale, y / self.fast_scale) for x, y in record.bbox))
+                for record in self.fast.detect(scaled)]
+
+
+ENGINES: Dict[str, Type[OCREngine]] = {engine.name: engine for engine in (PaddleEngine, EasyOCREngine, RapidOCREngine,
+                                                                          FakeEngine, TwoTierEngine)}
+
+PADDLE_CONFIG = {"engine": "paddleocr", "lang": "en", "use_angle_cls": True}
+EASYOCR_CONFIG = {"engine": "easyocr", "langs": ["de", "en"]}
+# Fast pass at half resolution without angle classification, unsure tokens re-read at full resolution with it.
+# Any engine config works for either tier, e.g. EASYOCR_CONFIG as the accurate one.
+TWO_TIER_CONFIG = {"engine": "two-tier", "fast": dict(PADDLE_CONFIG, use_angle_cls=False), "accurate": PADDLE_CONFIG,
+                   "fast_scale": 0.5, "min_confidence": 0.9, "max_word": 15, "crop_padding": 0.25}
+DEFAULT_CONFIGS = {"paddleocr": PADDLE_CONFIG, "easyocr": EASYOCR_CONFIG, "two-tier": TWO_TIER_CONFIG}
+
+
+def create_engine(config: dict = PADDLE_CONFIG) -> OCREngine:
+    """Build (and load) the engine named in `config["engine"]`."""
+    try:
+        engine_class = ENGINES[config["engine"]]
+    except KeyError:
+        raise ValueError(f"Unknown OCR engine {config.get('engine')!r}, available: {', '.join(ENGINES)}")
+    return engine_class(config)
+
+
+Rect = Tuple[int, int, int, int]
+
+
+def union_rect(rects: List[Rect]) -> Rect:
+    x0 = min(x for x, _, _, _ in rects)
+    y0 = min(y for _, y, _, _ in rects)
+    x1 = max(x + w for x, _, w, _ in rects)
+    y1 = max(y + h for _, y, _, h in rects)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def split_records(records: List[Detection], rects: List[Rect]) -> List[List[Detection]]:
+    """
+    Route detections to the regions their center lies in, translated to region coordinates.
+    A rect of None takes all detections unchanged.
+    """
+    centers = [(sum(x for x, _ in r.bbox) / 4, sum(y for _, y in r.bbox) / 4) for r in records]
+    parts = []
+    for rect in rects:
+        if rect is None:
+            parts.append(list(records))
+            continue
+        x, y, w, h = rect
+        parts.append([Detection(tuple((px - x, py - y) for px, py in record.bbox), record.text, record.confidence)
+                      for record, (cx, cy) in zip(records, centers) if x <= cx < x + w and y <= cy < y + h])
+    return parts
+
+
+def detect_regions(engine: OCREngine, image: np.ndarray, rects: List[Rect]) -> List[List[Detection]]:
+    """
+    OCR several regions of one image with a single engine call: text detection runs once over the
+    union of the regions and recognition batches all text boxes, instead of one call per region.
+    """
+    x0, y0, w, h = union_rect(rects)
+    records = engine.detect(image[y0:y0 + h, x0:x0 + w])
+    return split_records(records, [(x - x0, y - y0, rw, rh) for x, y, rw, rh in rects])
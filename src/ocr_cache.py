@@ -0,0 +1,135 @@
+"""
+Content addressed cache for raw OCR detections. The key is a hash over the region pixels and the engine
+configuration, so re-running the parser or changing the key of a song never needs inference again.
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from importlib import metadata
+from typing import Any, Optional
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "chordsheet-labeler", "ocr")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+CACHE_FORMAT = 2    # Bump whenever the layout of the cached values changes
+
+
+def _with_version(engine_config: dict) -> dict:
+    """The config plus the installed engine version, also for the engines nested in it (the two-tier engine)."""
+    config = {name: _with_version(value) if isinstance(value, dict) and "engine" in value else value
+              for name, value in engine_config.items()}
+    try:
+        config["version"] = metadata.version(config.get("engine", ""))
+    except metadata.PackageNotFoundError:
+        config["version"] = None
+    return config
+
+
+def engine_fingerprint(engine_config: dict) -> str:
+    """Engine settings plus the installed engine version, e.g. {"engine": "paddleocr", "lang": "en", ...}."""
+    return json.dumps(_with_version(dict(engine_config, cache_format=CACHE_FORMAT)), sort_keys=True)
+
+
+def region_key(roi: np.ndarray, fingerprint: str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    h.update(fingerprint.encode())
+    h.update(f"{roi.shape}{roi.dtype}".encode())
+    h.update(np.ascontiguousarray(roi).data)
+    return h.hexdigest()
+
+
+class OCRCache:
+    """
+    Raw OCR results on disk (bounded to `max_bytes`, least recently used files are evicted first)
+    with an in-memory LRU of `memory_items` entries in front of it.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES,
+                 memory_items: int = 256):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Disk index: key -> size, ordered from least to most recently used
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".pkl"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        self._disk = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self._disk_bytes = sum(self._disk.values())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".pkl")
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            on_disk = key in self._disk
+
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as f:
+                    value = pickle.load(f)
+                os.utime(self._path(key))
+            except (OSError, pickle.UnpicklingError, EOFError):
+                value = None
+            if value is not None:
+                with self._lock:
+                    self._disk.move_to_end(key)
+                    self._remember(key, value)
+                    self.hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: Any):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))    # Atomic, other processes never see half written files
+
+        with self._lock:
+            self._remember(key, value)
+            self._disk_bytes += len(data) - self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            self._evict()
+
+    def _remember(self, key: str, value: Any):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        while self._disk_bytes > self.max_bytes and len(self._disk) > 1:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._memory.pop(key, None)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                    "entries": len(self._disk), "bytes": self._disk_bytes}
@@ -0,0 +1,470 @@
+"""
+Pool of long lived OCR worker processes. Every worker loads its model once at startup and then
+gets (image region, key, section names) jobs one at a time, so inference runs on all cores
+instead of being serialized behind one shared model. Pages that get several jobs can be put into
+shared memory once (`share_page`), their jobs then only carry the region rect. Several sections of
+one page can be submitted as one job (`submit_regions`), the worker then OCRs all of them with a
+single engine call (see `src.ocr.detect_regions`).
+
+Jobs wait in a priority heap in this process and are only handed to the workers when one is free,
+so a job submitted with a better priority overtakes the backlog and cancelled jobs never get OCR'd.
+A worker that dies (killed for memory, a crash in the engine) fails the job it was working on and is
+replaced, the pool only gives up once no worker is left.
+"""
+import heapq
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import Future, InvalidStateError
+from typing import Callable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from src.analyze_process import process_detections
+from src.detections import Detections
+from src.ocr import PADDLE_CONFIG, Detection, Rect, create_engine, split_records, union_rect
+from src.ocr_cache import OCRCache, engine_fingerprint, region_key
+from src.instrumentation import RECORDER, span
+from src.preprocess import Preprocessor, detect_preprocessed, rotates_detections
+from src.shared_pages import PageRegion, PageRegionReader, SharedPage, SharedPageStore
+
+
+def parse_section(records: List[Detection], key: str, name_of_part: str,
+                  level_skew: bool = False) -> Optional[Tuple[str, list]]:
+    """Parse the detections of one region. Returns None if nothing was detected."""
+    if not records:
+        return None
+    return process_detections(Detections.from_records(records, level_skew), key, name_of_part)
+
+
+def keep_records(records: List[Detection], key: str, name_of_part: str, level_skew: bool = False) -> List[Detection]:
+    """Parser for callers that analyze the detections themselves, e.g. from a `PageDetections`."""
+    return records
+
+
+def _worker_main(jobs, results, engine_factory: Callable, engine_config: dict, threads_per_worker: int,
+                 preprocess: Optional[dict]):
+    if threads_per_worker:
+        # One inference thread per process, the parallelism comes from the processes
+        for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            os.environ[var] = str(threads_per_worker)
+
+    # Always on in the workers: the events of every job go back with its result, see OCRPool._handle_result
+    RECORDER.enable()
+    pages = PageRegionReader()
+    level_skew = rotates_detections(preprocess)
+    engine, error = None, None
+    try:
+        engine = engine_factory(engine_config)
+        preprocessor = Preprocessor(preprocess) if preprocess is not None else None
+    except Exception as e:
+        error = f"OCR model could not be loaded: {e!r}"
+    results.send((None, error is None, error or os.getpid(), None))     # Worker ready
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        # regions: [(name of part, rect in roi or None for the whole roi)]
+        job_id, roi, regions, key, parse = job
+        if engine is None:
+            results.send((job_id, False, error, None))
+            continue
+        try:
+            with span("ocr.job", regions=len(regions)):
+                if isinstance(roi, PageRegion):
+                    roi = pages.view(roi)
+                if preprocessor:
+                    records = detect_preprocessed(engine, roi, preprocessor)
+                else:
+                    with span("ocr.detect"):
+                        records = engine.detect(roi)
+                parts = split_records(records, [rect for _, rect in regions])
+                with span("parse"):
+                    payload = [(records, parse(records, key, name_of_part, level_skew))
+                               for (name_of_part, _), records in zip(regions, parts)]
+            results.send((job_id, True, payload, RECORDER.drain()))
+        except Exception as e:
+            results.send((job_id, False, repr(e), RECORDER.drain()))
+
+
+class OCRPool:
+    """
+    Args:
+        workers: Number of worker processes, defaults to the number of cores.
+        max_pending: Maximum number of waiting jobs. `submit` blocks once that many are waiting, unless called
+            with `block=False`. Cancelled jobs leave the queue right away and do not count.
+        engine_factory: Picklable function that builds the OCR engine from `engine_config` inside a worker.
+        engine_config: Engine settings, also part of the cache key.
+        threads_per_worker: Inference threads per worker process.
+        cache: Optional OCRCache for the detections. Cache hits never reach the workers.
+        on_worker_ready: Called from the collector thread with (ok, pid or error) once a worker loaded its model,
+            also with (False, error) if a worker dies before that. Replacements for crashed workers report again.
+        preprocess: Preprocessing config (see src/preprocess.py) applied to every region before OCR, None for
+            no preprocessing. Also part of the cache key.
+    """
+
+    def __init__(self, workers: int = None, max_pending: int = None, engine_factory: Callable = create_engine,
+                 engine_config: dict = PADDLE_CONFIG, threads_per_worker: int = 1, cache: OCRCache = None,
+                 on_worker_ready: Callable[[bool, object], None] = None, preprocess: dict = None):
+        self._ctx = multiprocessing.get_context("spawn")
+        self.workers = workers or os.cpu_count() or 1
+        self.ready_workers = 0
+        self.failed_workers = 0
+        self.on_worker_ready = on_worker_ready
+        self.cache = cache
+        self.pages = SharedPageStore()
+        self.counters = Counter()       # Summed counters of all jobs, e.g. "ocr.escalated" of the two-tier engine
+        self.stage_seconds = defaultdict(float)     # Summed seconds per stage of all jobs, as in `future.timings`
+        self.level_skew = rotates_detections(preprocess)     # Passed on to `parse`, see Detections.level_skew
+        self._fingerprint = engine_fingerprint(engine_config if preprocess is None
+                                               else dict(engine_config, preprocess=preprocess))
+
+        self.max_pending = max_pending or 2 * self.workers
+        self._worker_args = (engine_factory, engine_config, threads_per_worker, preprocess)
+        self._waiting = []      # Heap of (priority, job id, job, entries, shared page or None, submit time)
+        self._futures = {}      # Dispatched job id -> ([(future, cache key)] per region, shared page, submit time)
+        self._running = {}      # Worker slot -> id of the job it works on
+        self._idle = []         # Worker slots without a job, the dispatcher hands the next job to one of them
+        self._ready_slots = set()   # Worker slots whose process loaded its model
+        self._reported_slots = set()    # Worker slots whose process got through loading, with or without a model
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._job_ids = itertools.count()
+        self._closed = False
+        self._broken = False    # All workers died, no more jobs are taken
+
+        # Every worker has its own job queue and result pipe, so the job of a worker that dies is known and a
+        # worker killed while sending cannot block the others
+        self._processes = [None] * self.workers
+        self._job_queues = [None] * self.workers
+        self._result_pipes = [None] * self.workers
+        for slot in range(self.workers):
+            self._start_worker(slot)
+
+        self._stopped, self._stop = multiprocessing.Pipe(duplex=False)
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def _start_worker(self, slot: int):
+        jobs = self._ctx.Queue()
+        results, worker_end = self._ctx.Pipe(duplex=False)
+        process = self._ctx.Process(target=_worker_main, args=(jobs, worker_end, *self._worker_args), daemon=True)
+        process.start()
+        worker_end.close()      # Only the worker holds it now, reading gives EOF once the worker is gone
+        self._processes[slot], self._job_queues[slot], self._result_pipes[slot] = process, jobs, results
+        self._idle.append(slot)
+
+    def share_page(self, image: np.ndarray) -> SharedPage:
+        """Copy a page into shared memory, it can then be passed to `submit` and `submit_regions` for free."""
+        return self.pages.add(image)
+
+    def submit(self, roi: Union[np.ndarray, SharedPage], key: str, name_of_part: str,
+               parse: Callable = parse_section, priority: int = 0, block: bool = True) -> Future:
+        """
+        Queue a region (or a shared page) for OCR. The future resolves to `parse(detections, key, name_of_part,
+        level_skew)`, by default the parsed section (or None). `parse` runs in the worker and must be a picklable
+        module level function, `level_skew` tells it whether the preprocessing deskewed (see `Detections`).
+        Jobs with a lower `priority` run first. `future.cancel()` drops a job that has not started yet. Once
+        done, `future.timings` holds the seconds spent per stage ("queue", "ocr.detect", "parse", ..., "total";
+        only "cache" for cache hits). With `block=False` the job is queued even if `max_pending` jobs are
+        waiting, for callers that must not wait (the GUI thread).
+        """
+        if isinstance(roi, SharedPage):
+            return self._submit(roi.array, [(name_of_part, None)], key, parse, priority, block,
+                                roi, roi.region())[0]
+        return self._submit(roi, [(name_of_part, None)], key, parse, priority, block)[0]
+
+    def submit_regions(self, image: Union[np.ndarray, SharedPage], regions: List[Tuple[str, Rect]], key: str,
+                       parse: Callable = parse_section, priority: int = 0, block: bool = True) -> List[Future]:
+        """
+        Queue several (name of part, (x, y, w, h)) regions of one image as a single job. The worker runs the
+        engine once over the union of the regions and routes the detections back, one future per region
+        resolving like `submit`. Regions found in the cache are left out of the job. The job is dropped
+        only if the futures of all its regions were cancelled.
+        """
+        x0, y0, w, h = union_rect([rect for _, rect in regions])
+        # Only the union is sent to the worker (or, for shared pages, its rect), the rects are made relative to it
+        relative = [(name, (x - x0, y - y0, rw, rh)) for name, (x, y, rw, rh) in regions]
+        if isinstance(image, SharedPage):
+            return self._submit(image.array[y0:y0 + h, x0:x0 + w], relative, key, parse, priority, block,
+                                image, image.region((x0, y0, w, h)))
+        return self._submit(image[y0:y0 + h, x0:x0 + w], relative, key, parse, priority, block)
+
+    def _submit(self, roi: np.ndarray, regions: list, key: str, parse: Callable, priority: int, block: bool,
+                page: SharedPage = None, page_region: PageRegion = None) -> List[Future]:
+        if self._closed:
+            raise RuntimeError("OCRPool is shut down")
+        if self._broken:
+            raise RuntimeError("OCRPool has no workers left")
+        submitted = time.perf_counter()
+        futures = [Future() for _ in regions]
+
+        pending, entries = [], []
+        for future, (name_of_part, rect) in zip(futures, regions):
+            cache_key = None
+            if self.cache is not None:
+                x, y, w, h = rect if rect is not None else (0, 0, roi.shape[1], roi.shape[0])
+                cache_key = region_key(roi[y:y + h, x:x + w], self._fingerprint)
+                records = self.cache.get(cache_key)
+                if records is not None:
+                    parsed = parse(records, key, name_of_part, self.level_skew)
+                    future.timings = {"cache": time.perf_counter() - submitted}
+                    future.set_result(parsed)
+                    continue
+            pending.append((name_of_part, rect))
+            entries.append((future, cache_key))
+
+        if pending:
+            job_id = next(self._job_ids)
+            if page is not None:
+                self.pages.acquire(page)    # Released once the job is done or dropped
+            job = (job_id, roi if page is None else page_region, pending, key, parse)
+            with self._changed:
+                while block and len(self._waiting) >= self.max_pending and not self._closed:
+                    self._changed.wait()
+                queued = not self._broken
+                if queued:
+                    heapq.heappush(self._waiting, (priority, job_id, job, entries, page, submitted))
+                    self._changed.notify_all()
+            if queued:
+                # Outside the lock: the callback runs right away for a future cancelled in the meantime
+                for future, _ in entries:
+                    future.add_done_callback(lambda future, job_id=job_id:
+                                             future.cancelled() and self._drop_cancelled(job_id))
+                return futures
+            # The last worker died while this job was being submitted
+            if page is not None:
+                self.pages.release(page)
+            for future, _ in entries:
+                future.set_exception(RuntimeError("OCRPool has no workers left"))
+        return futures
+
+    def _drop_cancelled(self, job_id: int):
+        """Take a waiting job out of the heap once the futures of all its regions are cancelled."""
+        with self._changed:
+            for nr, (_, waiting_id, _, entries, page, _) in enumerate(self._waiting):
+                if waiting_id == job_id:
+                    break
+            else:
+                return      # Handed to a worker or dropped already
+            if not all(future.cancelled() for future, _ in entries):
+                return
+            del self._waiting[nr]
+            heapq.heapify(self._waiting)
+            self._changed.notify_all()
+        if page is not None:
+            self.pages.release(page)
+
+    @property
+    def waiting(self) -> int:
+        """Jobs not yet handed to a worker."""
+        with self._lock:
+            return len(self._waiting)
+
+    def _dispatch(self):
+        while True:
+            with self._changed:
+                while not (self._waiting and self._idle) and not (self._closed and not self._waiting):
+                    self._changed.wait()
+                if not self._waiting:
+                    break
+                _, job_id, job, entries, page, submitted = heapq.heappop(self._waiting)
+                self._changed.notify_all()
+                # Running from here on, `future.cancel()` fails and the detections of the job are delivered
+                running = [future.set_running_or_notify_cancel() for future, _ in entries]
+                if not any(running):
+                    if page is not None:
+                        self.pages.release(page)
+                    continue
+                slot = self._idle.pop()
+                self._running[slot] = job_id
+                self._futures[job_id] = (entries, page, submitted)
+                jobs = self._job_queues[slot]
+            jobs.put(job)
+        with self._lock:
+            job_queues = [jobs for jobs in self._job_queues if jobs is not None]
+        for jobs in job_queues:
+            jobs.put(None)
+
+    def _collect(self):
+        """Results of the workers, and their exit: a worker exiting before `shutdown` died."""
+        while True:
+            with self._lock:
+                pipes = {pipe: slot for slot, pipe in enumerate(self._result_pipes) if pipe is not None}
+                sentinels = {process.sentinel: slot for slot, process in enumerate(self._processes)
+                             if process is not None}
+            ready = multiprocessing.connection.wait([self._stopped, *pipes, *sentinels])
+            if self._stopped in ready:
+                # `shutdown` has joined the workers, take what they sent last
+                for slot in set(pipes.values()):
+                    self._receive(slot)
+                    self._worker_exited(slot)
+                break
+            for pipe in ready:
+                if pipe in pipes:
+                    self._receive(pipes[pipe], block=False)
+            for sentinel in ready:
+                if sentinel in sentinels:
+                    self._receive(sentinels[sentinel])
+                    self._worker_exited(sentinels[sentinel])
+
+    def _receive(self, slot: int, block: bool = True):
+        """Handle one message of the worker in `slot`, or (`block`) all it sent before exiting."""
+        pipe = self._result_pipes[slot]
+        while pipe.poll():
+            try:
+                item = pipe.recv()
+            except (EOFError, OSError):     # Gone, possibly in the middle of a message
+                return
+            self._handle_result(slot, *item)
+            if not block:
+                return
+
+    def _worker_exited(self, slot: int):
+        """
+        Fail the job of the worker in `slot` and, unless the pool is shutting down, start a new worker in its
+        place. A worker that died while loading its model is not replaced (it would most likely die again),
+        once no worker is left the waiting jobs are failed as well.
+        """
+        with self._changed:
+            process = self._processes[slot]
+            process.join()
+            self._job_queues[slot].cancel_join_thread()     # Nobody reads it any more
+            self._result_pipes[slot].close()
+            reported = slot in self._reported_slots
+            self._ready_slots.discard(slot)
+            self._reported_slots.discard(slot)
+            self.ready_workers = len(self._ready_slots)
+            if slot in self._idle:
+                self._idle.remove(slot)
+            job_id = self._running.pop(slot, None)
+            entries, page, _ = self._futures.pop(job_id, ([], None, None))
+            closed = self._closed
+            if reported and not closed:
+                self._start_worker(slot)
+            else:
+                self._processes[slot] = self._job_queues[slot] = self._result_pipes[slot] = None
+            dropped = []
+            if not closed and all(process is None for process in self._processes):
+                self._broken = True
+                dropped, self._waiting = self._waiting, []
+            self._changed.notify_all()
+        if closed:
+            error = "OCRPool was shut down before the job finished"
+        else:
+            error = f"OCR worker {process.pid} died (exit code {process.exitcode})"
+        if not reported and not closed:
+            self.failed_workers += 1
+            if self.on_worker_ready is not None:
+                self.on_worker_ready(False, error)
+        failed = [(entries, page)] + [(entries, page) for _, _, _, entries, page, _ in dropped]
+        for nr, (entries, page) in enumerate(failed):
+            if page is not None:
+                self.pages.release(page)
+            for future, _ in entries:
+                try:
+                    future.set_exception(RuntimeError(error if nr == 0 else f"No OCR worker left, {error}"))
+                except InvalidStateError:   # Cancelled while the worker was busy with it
+                    pass
+
+    def _handle_result(self, slot: int, job_id, ok: bool, payload, trace):
+        if job_id is None:
+            with self._lock:
+                self._reported_slots.add(slot)
+                if ok:
+                    self._ready_slots.add(slot)
+                    self.ready_workers = len(self._ready_slots)
+                else:
+                    self.failed_workers += 1
+            if self.on_worker_ready is not None:
+                self.on_worker_ready(ok, payload)
+            return
+        with self._changed:
+            entries, page, submitted = self._futures.pop(job_id, ([], None, None))
+            if self._running.get(slot) == job_id:
+                del self._running[slot]
+                self._idle.append(slot)
+                self._changed.notify_all()
+        if page is not None:
+            self.pages.release(page)
+        timings = self._job_timings(submitted, trace) if entries else {}
+        if trace is not None:
+            self.counters.update(trace[1])
+        for stage, seconds in timings.items():
+            self.stage_seconds[stage] += seconds
+        for nr, (future, cache_key) in enumerate(entries):
+            future.timings = timings
+            try:
+                if ok:
+                    records, parsed = payload[nr]
+                    if cache_key is not None:
+                        self.cache.put(cache_key, records)
+                    future.set_result(parsed)
+                else:
+                    future.set_exception(RuntimeError(payload))
+            except InvalidStateError:   # Cancelled while the worker was busy with it
+                pass
+
+    @staticmethod
+    def _job_timings(submitted: float, trace) -> dict:
+        """Seconds per stage of a finished job from the events its worker sent along."""
+        timings = {"total": time.perf_counter() - submitted}
+        if trace is None:
+            return timings
+        events, counters = trace
+        for name, start, duration, pid, tid, args in events:
+            if name == "ocr.job":
+                timings["queue"] = start - submitted    # perf_counter is system wide on the supported platforms
+                if RECORDER.enabled:
+                    RECORDER.add_span("ocr.queue", submitted, start - submitted)
+            else:
+                timings[name] = timings.get(name, 0.0) + duration
+        RECORDER.merge(events, counters)
+        return timings
+
+    def shutdown(self, wait: bool = True):
+        """Let the workers finish the waiting jobs (or drop them if not `wait`), then stop them."""
+        with self._changed:
+            if self._closed:
+                return
+            self._closed = True
+            dropped = [] if wait else self._waiting
+            if not wait:
+                self._waiting = []
+            self._changed.notify_all()
+        for _, _, _, entries, _, _ in dropped:
+            for future, _ in entries:
+                future.cancel()
+        if wait:
+            self._dispatcher.join()
+        with self._lock:
+            workers = [(process, jobs) for process, jobs in zip(self._processes, self._job_queues)
+                       if process is not None]
+        if not wait:
+            for process, jobs in workers:
+                process.terminate()
+                jobs.cancel_join_thread()
+        for process, _ in workers:
+            process.join()
+
+        self._stop.send(None)
+        self._collector.join()
+        with self._lock:
+            pending, self._futures = self._futures, {}
+        for future, _ in itertools.chain.from_iterable(entries for entries, _, _ in pending.values()):
+            if not future.cancelled():
+                future.set_exception(RuntimeError("OCRPool was shut down before the job finished"))
+        self.pages.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -0,0 +1,218 @@
+"""
+All detections of one page, collected from every OCR job that ran on it, in page pixels (OCR resolution).
+Sections are analyzed from here instead of from their own OCR result: when a section rect is moved or
+resized only the strips no job has covered yet need OCR, the detections of the rest are reused.
+
+Region queries go through a sorted-interval index over the y axis (centers and box tops, built once per
+change of the detections), so a query costs O(log n + k) for k detections in the band instead of a scan
+over the whole page. Merging new detections looks up their possible duplicates the same way.
+"""
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from src.detections import Detections
+from src.ocr import Detection, Rect
+
+STRIP_PADDING = 24      # Pixels a strip reaches into the covered area, so a word cut by the old edge is read whole
+MIN_STRIP = 8           # Strips thinner than this cannot hold readable text and are not OCR'd
+DUPLICATE_OVERLAP = 0.5     # Boxes overlapping by this share of the smaller one are the same word
+
+
+def subtract_rect(rect: Rect, other: Rect) -> List[Rect]:
+    """Parts of `rect` outside of `other`: up to four strips (above, below, left, right)."""
+    x, y, w, h = rect
+    ox, oy, ow, oh = other
+    x1, y1, ox1, oy1 = x + w, y + h, ox + ow, oy + oh
+    if ox >= x1 or ox1 <= x or oy >= y1 or oy1 <= y:
+        return [rect]
+    parts = []
+    if oy > y:
+        parts.append((x, y, w, oy - y))
+    if oy1 < y1:
+        parts.append((x, oy1, w, y1 - oy1))
+    top, bottom = max(y, oy), min(y1, oy1)
+    if ox > x:
+        parts.append((x, top, ox - x, bottom - top))
+    if ox1 < x1:
+        parts.append((ox1, top, x1 - ox1, bottom - top))
+    return parts
+
+
+def _boxes(corners: np.ndarray) -> np.ndarray:
+    """(n, 4) axis aligned (x0, y0, x1, y1) boxes of (n, 4, 2) corners."""
+    return np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+
+
+class _YIndex(NamedTuple):
+    by_center: np.ndarray       # Detection numbers sorted by center y
+    center_y: np.ndarray        # The sorted center y values
+    center_x: np.ndarray        # Center x, by detection number
+    by_top: np.ndarray          # Detection numbers sorted by the top of their box
+    top: np.ndarray             # The sorted box tops
+    boxes: np.ndarray           # (n, 4) axis aligned boxes, by detection number
+    max_height: float           # Tallest box, bounds how far above a rect an intersecting box can start
+
+
+class PageDetections:
+    """
+    Attributes:
+        ids: (n,) stable id of every detection, new detections get new ids, so a line can be recognized
+            by the ids of its detections.
+        covered: Rects that have been OCR'd.
+
+    The queries return `(ids, Detections)` with the detections in storage order, so `Detections.line_order`
+    and `classify_lines` run directly on the result.
+    """
+
+    def __init__(self, level_skew: bool = False):
+        self.level_skew = level_skew    # Handed to the Detections of the queries, see Detections.level_skew
+        self.corners = np.empty((0, 4, 2), dtype=np.float64)
+        self.texts: List[str] = []
+        self.confidences = np.empty(0, dtype=np.float64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.covered: List[Rect] = []
+        self._next_id = 0
+        self._index = None
+
+    @classmethod
+    def restore(cls, covered: List[Rect], records: List[Detection], level_skew: bool = False) -> "PageDetections":
+        """A store holding `records` (in page pixels, as returned by `records`) with `covered` OCR'd."""
+        store = cls(level_skew)
+        store.add((0, 0, 0, 0), records)
+        store.covered = list(covered)
+        return store
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def records(self) -> List[Detection]:
+        """All detections in page pixels."""
+        return [Detection(tuple(map(tuple, corners.tolist())), text, float(confidence))
+                for corners, text, confidence in zip(self.corners, self.texts, self.confidences)]
+
+    def missing(self, rect: Rect) -> List[Rect]:
+        """
+        Strips of `rect` that still need OCR, each grown by STRIP_PADDING into the covered area (but not
+        beyond `rect`). Returns `[rect]` if nothing of it is covered and `[]` if all of it is.
+        """
+        parts = [rect]
+        for covered in self.covered:
+            parts = [part for piece in parts for part in subtract_rect(piece, covered)]
+            if not parts:
+                return []
+        parts = [part for part in parts if min(part[2], part[3]) >= MIN_STRIP]
+        if parts == [rect]:
+            return parts
+        x, y, w, h = rect
+        strips = []
+        for px, py, pw, ph in parts:
+            x0, y0 = max(x, px - STRIP_PADDING), max(y, py - STRIP_PADDING)
+            x1, y1 = min(x + w, px + pw + STRIP_PADDING), min(y + h, py + ph + STRIP_PADDING)
+            strips.append((x0, y0, x1 - x0, y1 - y0))
+        return strips
+
+    def add(self, rect: Rect, records: List[Detection]):
+        """
+        Merge the detections of an OCR'd `rect` of the page, given relative to the rect like the results of
+        `OCRPool.submit_regions`. A new detection overlapping stored ones replaces them if its box is at least
+        as large, otherwise it was cut by the edge of `rect` and the stored ones are kept.
+        """
+        self.covered.append(tuple(int(v) for v in rect))
+        if not records:
+            return
+        new = Detections.from_records(records)
+        new = Detections(new.corners + np.array(rect[:2], dtype=np.float64), new.texts, new.confidences)
+        index = self.index()
+        new_boxes, old_boxes = _boxes(new.corners), index.boxes
+        new_areas = np.prod(new_boxes[:, 2:] - new_boxes[:, :2], axis=1)
+        old_areas = np.prod(old_boxes[:, 2:] - old_boxes[:, :2], axis=1)
+
+        # Candidate pairs from the y index like `intersecting`: the stored boxes starting in the band of each new box
+        lo = np.searchsorted(index.top, new_boxes[:, 1] - index.max_height, side="left")
+        hi = np.searchsorted(index.top, new_boxes[:, 3], side="left")
+        counts = hi - lo
+        pair_new = np.repeat(np.arange(len(new_boxes)), counts)
+        pair_old = index.by_top[np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())]
+
+        # Overlap of every pair relative to the smaller box
+        low = np.maximum(new_boxes[pair_new, :2], old_boxes[pair_old, :2])
+        high = np.minimum(new_boxes[pair_new, 2:], old_boxes[pair_old, 2:])
+        overlap = np.prod(np.clip(high - low, 0, None), axis=1)
+        smaller = np.maximum(np.minimum(new_areas[pair_new], old_areas[pair_old]), 1e-9)
+        duplicates = overlap / smaller >= DUPLICATE_OVERLAP
+        pair_new, pair_old = pair_new[duplicates], pair_old[duplicates]
+
+        largest_duplicate = np.zeros(len(new_boxes))
+        np.maximum.at(largest_duplicate, pair_new, old_areas[pair_old])
+        keep_new = new_areas >= largest_duplicate
+        drop_old = np.zeros(len(old_boxes), dtype=bool)
+        drop_old[pair_old[keep_new[pair_new]]] = True
+
+        keep_old = ~drop_old
+        ids = np.arange(self._next_id, self._next_id + int(keep_new.sum()), dtype=np.int64)
+        self._next_id += len(ids)
+        self.corners = np.concatenate([self.corners[keep_old], new.corners[keep_new]])
+        self.texts = ([text for text, keep in zip(self.texts, keep_old) if keep]
+                      + [text for text, keep in zip(new.texts, keep_new) if keep])
+        self.confidences = np.concatenate([self.confidences[keep_old], new.confidences[keep_new]])
+        self.ids = np.concatenate([self.ids[keep_old], ids])
+        self._index = None
+
+    def index(self) -> _YIndex:
+        if self._index is None:
+            center_x = self.corners[:, :, 0].sum(axis=1) / 4
+            center_y = self.corners[:, :, 1].sum(axis=1) / 4
+            boxes = _boxes(self.corners)
+            by_center = np.argsort(center_y, kind="stable")
+            by_top = np.argsort(boxes[:, 1], kind="stable")
+            heights = boxes[:, 3] - boxes[:, 1]
+            self._index = _YIndex(by_center, center_y[by_center], center_x, by_top, boxes[by_top, 1], boxes,
+                                  float(heights.max(initial=0)))
+        return self._index
+
+    def _result(self, nrs: np.ndarray) -> Tuple[np.ndarray, Detections]:
+        nrs = np.sort(nrs)
+        return self.ids[nrs], Detections(self.corners[nrs], [self.texts[nr] for nr in nrs], self.confidences[nrs],
+                                         self.level_skew)
+
+    def _center_band(self, y0: float, y1: float) -> np.ndarray:
+        index = self.index()
+        lo, hi = np.searchsorted(index.center_y, [y0, y1], side="left")
+        return index.by_center[lo:hi]
+
+    def query(self, rect: Rect) -> Tuple[np.ndarray, Detections]:
+        """Detections whose center lies in `rect`, the same rule as `split_records`."""
+        x, y, w, h = rect
+        nrs = self._center_band(y, y + h)
+        center_x = self.index().center_x[nrs]
+        return self._result(nrs[(center_x >= x) & (center_x < x + w)])
+
+    def band(self, y0: float, y1: float) -> Tuple[np.ndarray, Detections]:
+        """Detections whose center y lies in [y0, y1), over the whole width of the page."""
+        return self._result(self._center_band(y0, y1))
+
+    def intersecting(self, rect: Rect) -> Tuple[np.ndarray, Detections]:
+        """Detections whose box overlaps `rect` at all."""
+        x, y, w, h = rect
+        index = self.index()
+        lo, hi = np.searchsorted(index.top, [y - index.max_height, y + h], side="left")
+        nrs = index.by_top[lo:hi]
+        x0, y0, x1, y1 = index.boxes[nrs].T
+        return self._result(nrs[(x0 < x + w) & (x1 > x) & (y0 < y + h) & (y1 > y)])
+
+    def nearest_line(self, y: float, y_threshold: float = 10) -> Tuple[np.ndarray, Detections]:
+        """The line (clustered like `Detections.line_order`) with the detection whose center is closest to `y`."""
+        index = self.index()
+        if not len(index.center_y):
+            return self._result(np.empty(0, dtype=np.intp))
+        k = int(np.searchsorted(index.center_y, y))
+        nearest = min((nr for nr in (k - 1, k) if 0 <= nr < len(index.center_y)),
+                      key=lambda nr: abs(index.center_y[nr] - y))
+        center = index.center_y[nearest]
+        ids, detections = self.band(center - 2 * index.max_height, center + 2 * index.max_height)
+        nearest_id = self.ids[index.by_center[nearest]]
+        for line in detections.lines(y_threshold):
+            if nearest_id in ids[line]:
+                return ids[line], detections.subset(line)
+        return self._result(np.empty(0, dtype=np.intp))
@@ -0,0 +1,118 @@
+"""
+Lazy page access for PDFs and images. PDF pages are rasterized one at a time and only when asked for,
+a low DPI render is used for the on-screen preview and sections are re-rasterized at OCR resolution
+from just their bounding box.
+"""
+import subprocess
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
+import numpy as np
+
+PREVIEW_DPI = 100
+OCR_DPI = 200       # Default of pdf2image, which the OCR parsing thresholds are tuned to
+
+
+def rasterize_pdf_page(path: str, page_nr: int, dpi: int, crop: Tuple[int, int, int, int] = None) -> np.ndarray:
+    """
+    Rasterize a single page (1-based) with pdftoppm and return it as BGR array.
+    `crop` is (x, y, w, h) in pixels at the given dpi, only that part of the page is rendered.
+    """
+    import cv2      # Deferred, OpenCV takes noticeable time to import and is not needed before the first page
+
+    cmd = ["pdftoppm", "-f", str(page_nr), "-l", str(page_nr), "-r", str(dpi)]
+    if crop is not None:
+        x, y, w, h = crop
+        cmd += ["-x", str(x), "-y", str(y), "-W", str(w), "-H", str(h)]
+    cmd.append(path)
+    output = subprocess.run(cmd, capture_output=True, check=True).stdout
+    image = cv2.imdecode(np.frombuffer(output, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not rasterize page {page_nr} of {path}")
+    return image
+
+
+class PageSource:
+    """
+    Args:
+        path: PDF or image file.
+        preview_dpi: Resolution of the on-screen preview. Section rects are given in preview pixels.
+        ocr_dpi: Resolution used for OCR.
+        cache_size: Number of rendered pages kept in memory.
+    """
+
+    def __init__(self, path: str, preview_dpi: int = PREVIEW_DPI, ocr_dpi: int = OCR_DPI, cache_size: int = 4):
+        self.path = path
+        self.is_pdf = path.lower().endswith('.pdf')
+        self.preview_dpi = preview_dpi
+        self.ocr_dpi = ocr_dpi
+        self.cache_size = cache_size
+
+        self._page_count = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def page_count(self) -> int:
+        if self._page_count is None:
+            if self.is_pdf:
+                from pdf2image import pdfinfo_from_path
+
+                self._page_count = pdfinfo_from_path(self.path)["Pages"]
+            else:
+                self._page_count = 1
+        return self._page_count
+
+    @property
+    def scale(self) -> float:
+        """Factor from preview pixels to OCR pixels. Images are shown at their native resolution."""
+        return self.ocr_dpi / self.preview_dpi if self.is_pdf else 1.0
+
+    def render(self, index: int, dpi: int) -> np.ndarray:
+        """Page `index` (0-based) as BGR array, rendered at `dpi` (ignored for images)."""
+        cache_key = (index, dpi if self.is_pdf else None)
+        with self._lock:
+            if cache_key in self._cache:
+                self._cache.move_to_end(cache_key)
+                return self._cache[cache_key]
+
+        if self.is_pdf:
+            image = rasterize_pdf_page(self.path, index + 1, dpi)
+        else:
+            if index != 0:
+                raise IndexError(index)
+            import cv2
+
+            image = cv2.imread(self.path)
+            if image is None:
+                raise ValueError(f"Could not read image {self.path}")
+
+        with self._lock:
+            self._cache[cache_key] = image
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return image
+
+    def preview(self, index: int) -> np.ndarray:
+        return self.render(index, self.preview_dpi)
+
+    def page(self, index: int) -> np.ndarray:
+        return self.render(index, self.ocr_dpi)
+
+    def render_region(self, index: int, rect: Tuple[int, int, int, int]) -> np.ndarray:
+        """Rasterize only the (x, y, w, h) preview rect of a page, at OCR resolution."""
+        x, y, w, h = rect
+        if not self.is_pdf:
+            return self.render(index, None)[y:y+h, x:x+w]
+        scale = self.scale
+        crop = (int(x * scale), int(y * scale), max(1, int(w * scale)), max(1, int(h * scale)))
+        return rasterize_pdf_page(self.path, index + 1, self.ocr_dpi, crop)
+
+    def __iter__(self):
+        """All pages at OCR resolution, one after another. Pages are not kept in the cache."""
+        for index in range(self.page_count):
+            if self.is_pdf:
+                yield rasterize_pdf_page(self.path, index + 1, self.ocr_dpi)
+            else:
+                yield self.render(index, None)
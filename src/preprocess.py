@@ -0,0 +1,200 @@
+"""
+Image preprocessing before OCR: crop the margins, deskew, binarize and scale the page so the text has
+a fixed height. Every step returns the affine transform it applied, the detections of the engine are
+mapped back through them, so callers keep getting coordinates of the image they passed in.
+"""
+import hashlib
+import time
+from collections import OrderedDict, defaultdict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from src.instrumentation import span
+from src.ocr import Detection, OCREngine
+
+DEFAULT_PREPROCESS = {
+    "steps": ["crop_margins", "deskew", "normalize_text_height"],
+    "margin": 16,           # Pixels kept around the content by crop_margins
+    "max_angle": 5.0,       # Degrees searched by deskew
+    "text_height": 20,      # Median glyph height in pixels after normalize_text_height, as in examples/1.png
+}
+
+
+class Preprocessed(NamedTuple):
+    image: np.ndarray
+    matrix: np.ndarray      # 2x3 affine transform from input to preprocessed pixel coordinates
+
+
+def _identity() -> np.ndarray:
+    return np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)
+
+
+def _compose(second: np.ndarray, first: np.ndarray) -> np.ndarray:
+    """Affine transform applying `first`, then `second`."""
+    return (np.vstack([second, [0, 0, 1]]) @ np.vstack([first, [0, 0, 1]]))[:2]
+
+
+def _ink(image: np.ndarray) -> np.ndarray:
+    """Text pixels as 255 on 0, via Otsu on the grayscale image."""
+    import cv2
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    return ink
+
+
+def crop_margins(image: np.ndarray, config: dict) -> Tuple[np.ndarray, np.ndarray]:
+    import cv2
+
+    ink = cv2.morphologyEx(_ink(image), cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))    # Drop scanner dust
+    points = cv2.findNonZero(ink)
+    if points is None:
+        return image, _identity()
+    x, y, w, h = cv2.boundingRect(points)
+    margin = config["margin"]
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x1, y1 = min(image.shape[1], x + w + margin), min(image.shape[0], y + h + margin)
+    return image[y0:y1, x0:x1], np.array([[1, 0, -x0], [0, 1, -y0]], dtype=np.float64)
+
+
+def _skew_score(ink: np.ndarray, angle: float) -> float:
+    import cv2
+
+    h, w = ink.shape
+    rotation = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    rows = cv2.warpAffine(ink, rotation, (w, h), flags=cv2.INTER_NEAREST).sum(axis=1, dtype=np.float64)
+    return float(np.square(np.diff(rows)).sum())    # Sharp line/gap transitions when the lines are level
+
+
+def estimate_skew(image: np.ndarray, max_angle: float = 5.0) -> float:
+    """Angle in degrees (counter clockwise) that levels the text lines, by projection profile search."""
+    import cv2
+
+    ink = _ink(image)
+    scale = min(1.0, 1000 / max(ink.shape))
+    if scale < 1.0:
+        ink = cv2.resize(ink, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    best = 0.0
+    for step, radius in ((0.5, max_angle), (0.1, 0.5)):   # Coarse, then fine around the coarse optimum
+        angles = np.arange(best - radius, best + radius + step / 2, step)
+        best = float(max(angles, key=lambda angle: _skew_score(ink, angle)))
+    return round(best, 2)
+
+
+def deskew(image: np.ndarray, config: dict) -> Tuple[np.ndarray, np.ndarray]:
+    import cv2
+
+    angle = estimate_skew(image, config["max_angle"])
+    if abs(angle) < 0.1:
+        return image, _identity()
+    h, w = image.shape[:2]
+    rotation = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    # Grow the canvas so no corner of the page is cut off
+    cos, sin = abs(rotation[0, 0]), abs(rotation[0, 1])
+    new_w, new_h = int(np.ceil(w * cos + h * sin)), int(np.ceil(w * sin + h * cos))
+    rotation[0, 2] += (new_w - w) / 2
+    rotation[1, 2] += (new_h - h) / 2
+    rotated = cv2.warpAffine(image, rotation, (new_w, new_h), flags=cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+    return rotated, rotation
+
+
+def binarize(image: np.ndarray, config: dict) -> Tuple[np.ndarray, np.ndarray]:
+    import cv2
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+    return cv2.cvtColor(binary, cv2.COLOR_GRAY2BGR), _identity()     # The engines expect 3 channels
+
+
+def estimate_text_height(image: np.ndarray) -> float:
+    """Median height of the glyph sized connected components, None if there are none."""
+    import cv2
+
+    _, _, stats, _ = cv2.connectedComponentsWithStats(_ink(image), connectivity=8)
+    heights, widths = stats[1:, cv2.CC_STAT_HEIGHT], stats[1:, cv2.CC_STAT_WIDTH]
+    glyphs = heights[(heights >= 4) & (widths >= 2) & (widths < 4 * heights) & (heights < image.shape[0] / 4)]
+    return float(np.median(glyphs)) if len(glyphs) else None
+
+
+def normalize_text_height(image: np.ndarray, config: dict) -> Tuple[np.ndarray, np.ndarray]:
+    import cv2
+
+    height = estimate_text_height(image)
+    if not height:
+        return image, _identity()
+    scale = float(np.clip(config["text_height"] / height, 0.25, 4.0))
+    if 0.9 <= scale <= 1.1:     # Close enough, resampling would only blur
+        return image, _identity()
+    resized = cv2.resize(image, None, fx=scale, fy=scale,
+                         interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+    return resized, np.array([[scale, 0, 0], [0, scale, 0]], dtype=np.float64)
+
+
+STEPS: Dict[str, Callable] = {step.__name__: step for step in (crop_margins, deskew, binarize, normalize_text_height)}
+
+
+class Preprocessor:
+    """
+    Runs the configured steps in order. The output of every step is cached per input image (by a hash of
+    its pixels), so OCR'ing more regions of the same page or changing only a later step does not redo
+    the earlier ones. `timings` sums up the seconds spent per step, cache hits excluded.
+    """
+
+    def __init__(self, config: dict = None, cache_items: int = 8):
+        self.config = dict(DEFAULT_PREPROCESS, **(config or {}))
+        unknown = set(self.config["steps"]) - set(STEPS)
+        if unknown:
+            raise ValueError(f"Unknown preprocessing steps {sorted(unknown)}, available: {', '.join(STEPS)}")
+        self.cache_items = cache_items
+        self.timings = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._cache = OrderedDict()
+
+    def __call__(self, image: np.ndarray) -> Preprocessed:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{image.shape}{image.dtype}".encode())
+        h.update(np.ascontiguousarray(image).data)
+        matrix = _identity()
+        for step in self.config["steps"]:
+            h.update(step.encode())
+            key = h.hexdigest()
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                image, step_matrix = self._cache[key]
+            else:
+                start = time.perf_counter()
+                image, step_matrix = STEPS[step](image, self.config)
+                self.timings[step] += time.perf_counter() - start
+                self.calls[step] += 1
+                self._cache[key] = (image, step_matrix)
+                while len(self._cache) > self.cache_items:
+                    self._cache.popitem(last=False)
+            matrix = _compose(step_matrix, matrix)
+        return Preprocessed(image, matrix)
+
+
+def rotates_detections(config: Optional[dict]) -> bool:
+    """Whether detections OCR'd with the preprocessing `config` (None for none) come back rotated, see
+    `Detections.level_skew`."""
+    return config is not None and "deskew" in dict(DEFAULT_PREPROCESS, **config)["steps"]
+
+
+def map_records(records: List[Detection], matrix: np.ndarray) -> List[Detection]:
+    """Apply a 2x3 affine transform to the corners of the detections."""
+    return [Detection(tuple((float(matrix[0, 0] * x + matrix[0, 1] * y + matrix[0, 2]),
+                             float(matrix[1, 0] * x + matrix[1, 1] * y + matrix[1, 2])) for x, y in record.bbox),
+                      record.text, record.confidence)
+            for record in records]
+
+
+def detect_preprocessed(engine: OCREngine, image: np.ndarray, preprocessor: Preprocessor) -> List[Detection]:
+    """`engine.detect` on the preprocessed image, with the detections in coordinates of `image`."""
+    import cv2
+
+    with span("preprocess"):
+        preprocessed = preprocessor(image)
+    with span("ocr.detect"):
+        records = engine.detect(preprocessed.image)
+    return map_records(records, cv2.invertAffineTransform(preprocessed.matrix))
@@ -0,0 +1,313 @@
+"""
+Labeling projects: a session on disk, so a songbook of hundreds of pages can be closed and reopened without
+rasterizing or OCR'ing anything again. A project is a directory:
+
+    project.json        Format, source file, DPIs and page count of the source
+    pages.bin           Raw BGR pixels of every page at preview and at OCR resolution, appended page by page
+    pages.jsonl         Offset and shape of both renders of a page in pages.bin, one line per page
+    sections.jsonl      Song, section and deletion records, the last record of a section wins
+    detections/<n>.jsonl    Raw OCR detections of every OCR'd rect of page n, replayed into PageDetections
+
+The files are only ever appended to, and an index line is written after the data it points at, so a crash
+loses the last records at most. Opening a project reads what the shown page needs: its pages.bin range is
+memory mapped, of sections.jsonl only the lines of its sections are parsed (every section line starts with
+its page and id) and only its detections file is read. sections.jsonl is compacted when opening if it is
+mostly outdated records.
+"""
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from src.ocr import Detection, Rect
+from src.page_detections import PageDetections
+
+PROJECT_FORMAT = 1
+PROJECT_EXTENSION = ".cslp"
+PROJECT_FILE = "project.json"
+COMPACT_MIN_RECORDS = 200       # sections.jsonl is compacted when opening once it has this many outdated records
+_SECTION_LINE = re.compile(rb'\{"page": (\d+), "id": (\d+), "type": "(section|delete)"')
+
+
+def _read_lines(path: str) -> Iterator[bytes]:
+    """Lines of an append-only file. A last line without newline was cut off by a crash and is skipped."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        for line in f:
+            if line.endswith(b"\n"):
+                yield line
+
+
+def _cut_partial_line(path: str):
+    """Drop a last line cut off by a crash, before anything is appended behind it."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        end = position = f.seek(0, os.SEEK_END)
+        while position > 0:
+            start = max(0, position - 65536)
+            f.seek(start)
+            chunk = f.read(position - start)
+            if position == end and chunk.endswith(b"\n"):
+                return
+            newline = chunk.rfind(b"\n")
+            if newline >= 0:
+                f.truncate(start + newline + 1)
+                return
+            position = start
+        f.truncate(0)
+
+
+def _records_from_json(records: list) -> List[Detection]:
+    return [Detection(tuple(tuple(corner) for corner in bbox), text, confidence) for bbox, text, confidence in records]
+
+
+def _chords_with_int_positions(ocr_data: Optional[list]) -> Optional[list]:
+    """json turns the int chord positions into strings, back to what align_chords_to_lyrics returns."""
+    if not ocr_data:
+        return ocr_data
+    return [dict(line, chords={int(position): chord for position, chord in line["chords"].items()})
+            for line in ocr_data]
+
+
+class ProjectPages:
+    """
+    The page store of a project, with the interface of PageSource. Pages are appended while a source is
+    imported, `preview` and `page` return read-only memory maps of pages.bin.
+    """
+    is_pdf = False      # Regions are read from the stored page, never rasterized again
+
+    def __init__(self, directory: str, preview_dpi: int, ocr_dpi: int, native: bool):
+        self.path = directory
+        self.preview_dpi = preview_dpi
+        self.ocr_dpi = ocr_dpi
+        self.native = native    # Image source: preview and page are the same array, like PageSource shows it
+        self._data_path = os.path.join(directory, "pages.bin")
+        self._index_path = os.path.join(directory, "pages.jsonl")
+        _cut_partial_line(self._index_path)
+        self._pages: List[dict] = [json.loads(line) for line in _read_lines(self._index_path)]
+        self._lock = threading.Lock()
+
+    @property
+    def page_count(self) -> int:
+        return len(self._pages)
+
+    @property
+    def scale(self) -> float:
+        return 1.0 if self.native else self.ocr_dpi / self.preview_dpi
+
+    def _map(self, index: int, render: str) -> np.ndarray:
+        offset, shape = self._pages[index][render]
+        return np.memmap(self._data_path, dtype=np.uint8, mode="r", offset=offset, shape=tuple(shape))
+
+    def preview(self, index: int) -> np.ndarray:
+        return self._map(index, "preview")
+
+    def page(self, index: int) -> np.ndarray:
+        return self._map(index, "page")
+
+    def render_region(self, index: int, rect: Rect) -> np.ndarray:
+        """The (x, y, w, h) preview rect of a page, at OCR resolution."""
+        x, y, w, h = rect
+        scale = self.scale
+        return self.page(index)[int(y * scale):int((y + h) * scale), int(x * scale):int((x + w) * scale)]
+
+    def __iter__(self):
+        for index in range(self.page_count):
+            yield self.page(index)
+
+    @staticmethod
+    def _write_array(f, image: np.ndarray) -> Tuple[int, List[int]]:
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        offset = f.tell()
+        f.write(image.data)
+        return offset, list(image.shape)
+
+    def append(self, preview: np.ndarray, page: np.ndarray):
+        with self._lock:
+            with open(self._data_path, "ab") as f:
+                entry = {"page": self._write_array(f, page)}
+                entry["preview"] = entry["page"] if preview is page else self._write_array(f, preview)
+            with open(self._index_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self._pages.append(entry)
+
+
+class ProjectState(NamedTuple):
+    song_name: Optional[str]
+    key: Optional[str]
+    sections: List[dict]    # {"page", "id", "name", "rect", "color", "ocr_data", "chart"} in the order they were added
+    next_id: int            # Lowest section id not used on any page
+
+
+class Project:
+    """
+    An open project. The save methods only queue the record, a single writer thread serializes and appends
+    them in order, so autosaving costs the GUI thread nothing but building the record.
+    """
+
+    def __init__(self, directory: str, meta: dict):
+        self.directory = directory
+        self.meta = meta
+        self.pages = ProjectPages(directory, meta["preview_dpi"], meta["ocr_dpi"], meta["native"])
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._written = set()     # Files appended to since opening, their last line has been checked
+        self._import = None
+
+    @classmethod
+    def create(cls, directory: str, source) -> "Project":
+        """New project for a PageSource. The pages are not stored yet, see `import_pages`."""
+        os.makedirs(os.path.join(directory, "detections"))
+        meta = {"format": PROJECT_FORMAT, "source": os.path.abspath(source.path), "page_count": source.page_count,
+                "preview_dpi": source.preview_dpi, "ocr_dpi": source.ocr_dpi, "native": not source.is_pdf}
+        with open(os.path.join(directory, PROJECT_FILE), "w") as f:
+            json.dump(meta, f, indent=4)
+        return cls(directory, meta)
+
+    @classmethod
+    def open(cls, path: str) -> "Project":
+        """Open the project directory `path` (or its project.json)."""
+        directory = os.path.dirname(path) if os.path.basename(path) == PROJECT_FILE else path
+        with open(os.path.join(directory, PROJECT_FILE)) as f:
+            meta = json.load(f)
+        if meta.get("format") != PROJECT_FORMAT:
+            raise ValueError(f"{directory} has project format {meta.get('format')}, expected {PROJECT_FORMAT}")
+        return cls(directory, meta)
+
+    @property
+    def complete(self) -> bool:
+        """All pages of the source are stored."""
+        return self.pages.page_count >= self.meta["page_count"]
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _append(self, name: str, record: dict):
+        self._writer.submit(self._write, name, record).add_done_callback(self._report_error)
+
+    def _write(self, name: str, record: dict):
+        # Detections are NamedTuples and become lists like any tuple, numpy scalars of the engines become floats
+        line = json.dumps(record, ensure_ascii=False, default=float)
+        if name not in self._written:
+            _cut_partial_line(self._path(name))
+            self._written.add(name)
+        with open(self._path(name), "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def _report_error(self, future):
+        if future.exception() is not None:
+            print(f"Saving to project {self.directory} failed: {future.exception()}")
+
+    def import_pages(self, source, on_page=None) -> threading.Thread:
+        """
+        Store the pages of `source` that are not in the project yet, in a background thread. An import that
+        was cut short by closing the app continues where it stopped. `on_page(index)` is called from that
+        thread after every stored page.
+        """
+        import cv2
+
+        def run():
+            for index in range(self.pages.page_count, source.page_count):
+                if self._import is None:
+                    return      # Project closed
+                page = source.page(index)
+                if source.is_pdf:
+                    size = (round(page.shape[1] / source.scale), round(page.shape[0] / source.scale))
+                    preview = cv2.resize(page, size, interpolation=cv2.INTER_AREA)
+                else:
+                    preview = page
+                self.pages.append(preview, page)
+                if on_page is not None:
+                    on_page(index)
+
+        self._import = threading.Thread(target=run, daemon=True)
+        self._import.start()
+        return self._import
+
+    def save_song(self, song_name: Optional[str], key: Optional[str]):
+        self._append("sections.jsonl", {"type": "song", "name": song_name, "key": key})
+
+    def save_section(self, section: dict):
+        """`section` as in ProjectState.sections."""
+        # Page and id first, so loading a page can skip the lines of other pages without parsing them
+        self._append("sections.jsonl", {"page": section["page"], "id": section["id"], "type": "section", **section})
+
+    def delete_section(self, page: int, section_id: int):
+        self._append("sections.jsonl", {"page": page, "id": section_id, "type": "delete"})
+
+    def add_detections(self, page: int, rect: Rect, records: List[Detection]):
+        """Detections of one OCR'd rect, relative to it, as passed to PageDetections.add."""
+        self._append(os.path.join("detections", f"{page}.jsonl"), {"rect": list(rect), "records": list(records)})
+
+    def save_page_detections(self, page: int, store: PageDetections):
+        """All detections of a page at once, replacing everything saved for it before."""
+        self._append(os.path.join("detections", f"{page}.jsonl"),
+                     {"covered": [list(rect) for rect in store.covered], "records": store.records()})
+
+    def _read_sections(self, page: Optional[int]) -> Tuple[ProjectState, int]:
+        """State with the sections of `page` (of all pages if None) and the number of outdated records."""
+        song_name = key = None
+        sections: Dict[int, dict] = {}
+        last_records: Dict[int, bytes] = {}     # Section id -> type of its last record
+        n_records = 0
+        for line in _read_lines(self._path("sections.jsonl")):
+            n_records += 1
+            match = _SECTION_LINE.match(line)
+            if match is None:
+                record = json.loads(line)
+                song_name, key = record["name"], record["key"]
+                continue
+            section_page, section_id, record_type = int(match[1]), int(match[2]), match[3]
+            last_records[section_id] = record_type
+            if page is not None and section_page != page:
+                continue
+            sections.pop(section_id, None)
+            if record_type == b"section":
+                record = json.loads(line)
+                del record["type"]
+                record["rect"] = tuple(record["rect"])
+                record["ocr_data"] = _chords_with_int_positions(record["ocr_data"])
+                record["chart"] = _chords_with_int_positions(record.get("chart"))     # Projects before charts had none
+                sections[section_id] = record
+        live = sum(record_type == b"section" for record_type in last_records.values())
+        state = ProjectState(song_name, key, sorted(sections.values(), key=lambda section: section["id"]),
+                             max(last_records, default=-1) + 1)
+        return state, n_records - live - (song_name is not None or key is not None)
+
+    def load(self, page: Optional[int] = None) -> ProjectState:
+        """Song and the sections of `page`, or of all pages if it is None."""
+        state, outdated = self._read_sections(page)
+        if outdated >= COMPACT_MIN_RECORDS:
+            self._compact(state if page is None else self._read_sections(None)[0])
+        return state
+
+    def _compact(self, state: ProjectState):
+        path = self._path("sections.jsonl")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"type": "song", "name": state.song_name, "key": state.key}) + "\n")
+            for section in state.sections:
+                f.write(json.dumps({"page": section["page"], "id": section["id"], "type": "section", **section},
+                                   ensure_ascii=False) + "\n")
+        os.replace(path + ".tmp", path)
+
+    def page_detections(self, page: int, level_skew: bool = False) -> PageDetections:
+        """The detections of one page, replayed from its detections file. `level_skew`: see `PageDetections`."""
+        store = PageDetections(level_skew)
+        for line in _read_lines(self._path(os.path.join("detections", f"{page}.jsonl"))):
+            record = json.loads(line)
+            records = _records_from_json(record["records"])
+            if "covered" in record:
+                store = PageDetections.restore([tuple(rect) for rect in record["covered"]], records, level_skew)
+            else:
+                store.add(tuple(record["rect"]), records)
+        return store
+
+    def close(self):
+        """Wait until every queued record is written."""
+        self._import = None
+        self._writer.shutdown()
@@ -0,0 +1,131 @@
+"""
+Pages in shared memory for the OCR workers. A page is copied into shared memory once, jobs only carry a
+`PageRegion` (segment name, page shape and the region rect) and the worker slices a view out of the
+mapped segment, so a 25 MB page is not pickled again for every job.
+"""
+import itertools
+import threading
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from typing import NamedTuple, Tuple
+
+import numpy as np
+
+
+class PageRegion(NamedTuple):
+    segment: str
+    shape: Tuple[int, ...]
+    dtype: str
+    rect: Tuple[int, int, int, int]     # (x, y, w, h) in page pixels
+
+
+class SharedPage:
+    """
+    Handle of a page in a SharedPageStore. Release it (or leave its `with` block) once no more jobs are
+    submitted for the page, running jobs keep it alive on their own.
+    """
+
+    def __init__(self, store: "SharedPageStore", page_id: int, segment: shared_memory.SharedMemory,
+                 shape: Tuple[int, ...], dtype: np.dtype):
+        self.store = store
+        self.page_id = page_id
+        self.segment = segment
+        self.array = np.ndarray(shape, dtype, buffer=segment.buf)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.array.shape
+
+    def region(self, rect: Tuple[int, int, int, int] = None) -> PageRegion:
+        if rect is None:
+            rect = (0, 0, self.shape[1], self.shape[0])
+        return PageRegion(self.segment.name, self.shape, self.array.dtype.str, tuple(int(v) for v in rect))
+
+    def release(self):
+        self.store.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class SharedPageStore:
+    """
+    Reference counted pages in shared memory. `add` returns a page holding one reference for the caller,
+    every job holds another one. The segment is unlinked when the last reference is released.
+    """
+
+    def __init__(self):
+        self._pages = {}
+        self._refs = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self, image: np.ndarray) -> SharedPage:
+        segment = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+        page = SharedPage(self, next(self._ids), segment, image.shape, image.dtype)
+        page.array[...] = image     # The only copy of the pixels
+        with self._lock:
+            self._pages[page.page_id] = page
+            self._refs[page.page_id] = 1
+        return page
+
+    def acquire(self, page: SharedPage):
+        with self._lock:
+            self._refs[page.page_id] += 1
+
+    def release(self, page: SharedPage):
+        with self._lock:
+            self._refs[page.page_id] -= 1
+            if self._refs[page.page_id] > 0:
+                return
+            del self._refs[page.page_id]
+            del self._pages[page.page_id]
+        _free(page)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pages)
+
+    def close(self):
+        """Unlink all pages, whatever their reference count."""
+        with self._lock:
+            pages, self._pages, self._refs = list(self._pages.values()), {}, {}
+        for page in pages:
+            _free(page)
+
+
+def _free(page: SharedPage):
+    page.array = None       # The view has to go before the segment can be closed
+    try:
+        page.segment.close()
+    except BufferError:     # Views of the page are still alive, the mapping goes away with them
+        pass
+    page.segment.unlink()
+
+
+class PageRegionReader:
+    """Worker side: maps segments on first use and keeps the last `max_segments` of them mapped."""
+
+    def __init__(self, max_segments: int = 4):
+        self.max_segments = max_segments
+        self._segments = OrderedDict()
+
+    def view(self, region: PageRegion) -> np.ndarray:
+        if region.segment in self._segments:
+            self._segments.move_to_end(region.segment)
+            segment, page = self._segments[region.segment]
+        else:
+            segment = shared_memory.SharedMemory(name=region.segment)
+            page = np.ndarray(region.shape, np.dtype(region.dtype), buffer=segment.buf)
+            self._segments[region.segment] = (segment, page)
+            while len(self._segments) > self.max_segments:
+                old_segment = self._segments.popitem(last=False)[1][0]
+                try:
+                    old_segment.close()
+                except BufferError:     # A view of it is still in use, the mapping goes away with it
+                    pass
+        x, y, w, h = region.rect
+        return page[y:y + h, x:x + w]
@@ -0,0 +1,66 @@
+"""
+Preview text of the sections of the song being labeled. Every section's preview is rendered once and kept
+until its data changes: setting a section's data marks it dirty, `take_dirty` renders only the dirty ones,
+so an OCR result arriving for one of 50 sections serializes one section instead of all of them.
+With a transposition set the previews show the chord names in that key instead of the Nashville numbers.
+"""
+import json
+from typing import Dict, List, Optional, Set, Tuple
+
+
+def render_section(section: dict, key: Optional[str] = None, to_key: Optional[str] = None) -> str:
+    """Preview of a section, with the chords transposed from `key` to `to_key` if both are given."""
+    text = f"Section: {section['name']}\n"
+    if to_key and key and section.get("keys") is not None:
+        return text + f"  Akkorde in {to_key}:\n" + json.dumps(section["keys"].transposed(key, to_key), indent=2) + "\n"
+    if section["ocr_data"]:
+        return text + json.dumps(section["ocr_data"], indent=2) + "\n"
+    return text + "  No OCR data available\n"
+
+
+class SongDocument:
+    """
+    Tracks which of the sections (the section dicts of the main window, keyed by their "id") changed
+    since their preview was last rendered.
+    """
+
+    def __init__(self):
+        self.previews: Dict[int, str] = {}
+        self.dirty: Set[int] = set()
+        self.key: Optional[str] = None
+        self.to_key: Optional[str] = None
+
+    def set_transposition(self, key: Optional[str], to_key: Optional[str]):
+        """Show the chords of the song in `key` as names in `to_key` (None: Nashville numbers)."""
+        if (key, to_key) != (self.key, self.to_key) and (to_key or self.to_key):
+            self.dirty.update(self.previews)    # Every section looks different now
+        self.key, self.to_key = key, to_key
+
+    def set_ocr_data(self, section: dict, ocr_data):
+        """Set the data of a section, it only becomes dirty if the data actually differs."""
+        if section["ocr_data"] != ocr_data or section["id"] not in self.previews:
+            self.dirty.add(section["id"])
+        section["ocr_data"] = ocr_data
+
+    def mark_dirty(self, section: dict):
+        self.dirty.add(section["id"])
+
+    def discard(self, section: dict):
+        self.previews.pop(section["id"], None)
+        self.dirty.discard(section["id"])
+
+    def clear(self):
+        self.previews.clear()
+        self.dirty.clear()
+
+    def preview(self, section: dict) -> str:
+        if section["id"] in self.dirty or section["id"] not in self.previews:
+            self.previews[section["id"]] = render_section(section, self.key, self.to_key)
+            self.dirty.discard(section["id"])
+        return self.previews[section["id"]]
+
+    def take_dirty(self, sections: List[dict]) -> List[Tuple[int, str]]:
+        """(section id, preview) of the dirty sections, in the order of `sections`, rendered again."""
+        if not self.dirty:
+            return []
+        return [(section["id"], self.preview(section)) for section in sections if section["id"] in self.dirty]
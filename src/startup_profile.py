@@ -0,0 +1,69 @@
+"""
+`--profile-startup`: start the GUI in a child interpreter with `-X importtime`, close it as soon as the
+window is visible and print how long that took plus a summary of the slowest imports.
+"""
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import List, Tuple
+
+PROFILE_ENV = "CHORDSHEET_PROFILE_STARTUP"
+VISIBLE_MARKER = "window-visible-at"
+
+
+def profiling_requested() -> bool:
+    if not os.environ.get(PROFILE_ENV):
+        return False
+    # Keep the spawned OCR workers from inheriting -X importtime, only the GUI process is measured
+    sys._xoptions.pop("importtime", None)
+    return True
+
+
+def report_window_visible(app):
+    """Called in the child once the event loop runs, i.e. the window has been shown."""
+    print(f"{VISIBLE_MARKER} {time.time()}", flush=True)
+    app.quit()
+
+
+def summarize_importtime(stderr: str, top: int = 15) -> Tuple[float, List[Tuple[str, float]]]:
+    """
+    Sum up `-X importtime` output per top-level package.
+
+    Returns:
+        (total seconds, [(package, cumulative seconds)] sorted slowest first)
+    """
+    per_package = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name[1:]
+        if name.startswith(" "):    # Nested import, already part of its parent's cumulative time
+            continue
+        per_package[name.split(".")[0]] += int(cumulative) / 1e6
+    ranking = sorted(per_package.items(), key=lambda item: item[1], reverse=True)
+    return sum(per_package.values()), ranking[:top]
+
+
+def profile_startup(main_path: str, argv: List[str]) -> int:
+    env = dict(os.environ, **{PROFILE_ENV: "1"})
+    start = time.time()
+    process = subprocess.run([sys.executable, "-X", "importtime", main_path, *argv],
+                             env=env, capture_output=True, text=True)
+    visible_at = None
+    for line in process.stdout.splitlines():
+        if line.startswith(VISIBLE_MARKER):
+            visible_at = float(line.split()[1])
+    if visible_at is None:
+        print(process.stderr[-2000:], file=sys.stderr)
+        print("The window never became visible", file=sys.stderr)
+        return 1
+
+    total, ranking = summarize_importtime(process.stderr)
+    print(f"Window visible after {(visible_at - start) * 1000:.0f} ms (including interpreter start)")
+    print(f"Imports: {total * 1000:.0f} ms in total, slowest top-level packages:")
+    for package, seconds in ranking:
+        print(f"  {seconds * 1000:8.1f} ms  {package}")
+    return 0
@@ -1,32 +1,14 @@
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QFileDialog, QLabel, QLineEdit, QListWidget, QDialog, QDialogButtonBox
-from PyQt5.QtGui import QPixmap, QPainter, QPen, QImage, QPalette, QColor
-from PyQt5.QtCore import Qt, QRect, QThread, pyqtSignal, QThreadPool
-import cv2
-import numpy as np
-from pdf2image import convert_from_path
-
-from src.analyze_process import process_ocr_result
+import math
 
-class OCRWorker(QThread):
-    finished = pyqtSignal(str, tuple)
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QFileDialog, QLabel, QLineEdit, QListWidget, QDialog, QDialogButtonBox,
+                             QGraphicsItem, QGraphicsScene, QGraphicsView, QTableWidget, QTableWidgetItem, QHeaderView,
+                             QTextEdit)
+from PyQt5.QtGui import QPixmap, QPainter, QPen, QBrush, QImage, QPalette, QColor, QTextCursor, QTextFrameFormat
+from PyQt5.QtCore import Qt, QRect, QRectF, pyqtSignal
+import numpy as np
 
-    def __init__(self, image, region, reader, key, name_of_part):
-        super().__init__()
-        self.image = image
-        self.region = region
-        
-        self.reader = reader
-        self.key = key
-        self.name_of_part = name_of_part
-
-    def run(self):
-        x, y, w, h = self.region
-        roi = self.image[y:y+h, x:x+w]
-        
-        result = self.reader.readtext(roi)
-        final_json = process_ocr_result(result, self.key, self.name_of_part)
-        
-        self.finished.emit(str(self.region), tuple(final_json))
+from src.instrumentation import span
+from src.page_source import PageSource
 
 class SectionNameDialog(QDialog):
     def __init__(self, parent=None):
@@ -45,7 +27,8 @@ class SectionNameDialog(QDialog):
 
 
 class SelectImagePage(QWidget):
-    image_selected = pyqtSignal(np.ndarray)
+    source_selected = pyqtSignal(object)
+    project_selected = pyqtSignal(str)      # project.json of a saved project
 
     def __init__(self):
         super().__init__()
@@ -85,16 +68,13 @@ class SelectImagePage(QWidget):
             self, 
             "Open Image/PDF", 
             "", 
-            "PDF Files (*.pdf);;Image Files (*.png *.jpg *.bmp)"
+            "PDF Files (*.pdf);;Image Files (*.png *.jpg *.bmp);;Projekte (project.json)"
         )
-        if file_path:
-            if file_path.lower().endswith('.pdf'):
-                pages = convert_from_path(file_path)
-                image = np.array(pages[0])
-                image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-            else:
-                image = cv2.imread(file_path)
-            self.image_selected.emit(image)
+        if file_path.endswith("project.json"):
+            self.project_selected.emit(file_path)
+        elif file_path:
+            # Pages are only rasterized when they are shown
+            self.source_selected.emit(PageSource(file_path))
 
 
 class KeyOfSongWidget(QLineEdit):
@@ -124,42 +104,293 @@ class KeyOfSongWidget(QLineEdit):
             self.clear()  # Optionally clear the field after pressing Enter
 
 
-class ImageLabel(QLabel):
+class TiledPageItem(QGraphicsItem):
+    """
+    A page drawn from cached pixmap tiles. For every zoom level a downscaled copy of the page is used
+    (level n is 1/2^n of the full size) and only the tiles inside the exposed area are converted and drawn.
+    """
+    TILE_SIZE = 512
+
+    def __init__(self, image: np.ndarray):
+        super().__init__()
+        # The array is BGR (OpenCV order). The QImage shares its memory, so keep a reference to it.
+        self._array = np.ascontiguousarray(image)
+        height, width = self._array.shape[:2]
+        self._image = QImage(self._array.data, width, height, self._array.strides[0], QImage.Format_BGR888)
+        self._levels = {0: self._image}
+        self._tiles = {}
+        self.max_level = max(0, int(math.log2(max(width, height) / self.TILE_SIZE)) + 1)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return QRectF(0, 0, self._image.width(), self._image.height())
+
+    def _level_image(self, level: int) -> QImage:
+        if level not in self._levels:
+            scale = 2 ** level
+            self._levels[level] = self._image.scaled(max(1, self._image.width() // scale),
+                                                     max(1, self._image.height() // scale),
+                                                     Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        return self._levels[level]
+
+    def _tile(self, level: int, tx: int, ty: int) -> QPixmap:
+        key = (level, tx, ty)
+        if key not in self._tiles:
+            size = self.TILE_SIZE
+            # QImage.copy fills the part outside of the image with black, edge tiles are cut to the image instead
+            level_image = self._level_image(level)
+            rect = QRect(tx * size, ty * size, size, size).intersected(level_image.rect())
+            self._tiles[key] = QPixmap.fromImage(level_image.copy(rect))
+        return self._tiles[key]
+
+    def paint(self, painter, option, widget=None):
+        with span("viewer.paint"):
+            self._paint_tiles(painter, option)
+
+    def _paint_tiles(self, painter, option):
+        lod = option.levelOfDetailFromTransform(painter.worldTransform())
+        level = min(self.max_level, int(math.log2(1 / lod))) if 0 < lod < 1 else 0
+        scale = 2 ** level
+        level_image = self._level_image(level)
+        step = self.TILE_SIZE * scale     # Tile size in page pixels
+
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        tx_range = range(int(exposed.left() // step), min(int(exposed.right() // step) + 1,
+                                                          math.ceil(level_image.width() / self.TILE_SIZE)))
+        ty_range = range(int(exposed.top() // step), min(int(exposed.bottom() // step) + 1,
+                                                         math.ceil(level_image.height() / self.TILE_SIZE)))
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, level > 0)
+        for ty in ty_range:
+            for tx in tx_range:
+                tile = self._tile(level, tx, ty)
+                target = QRectF(tx * step, ty * step, tile.width() * scale, tile.height() * scale)
+                target = target.intersected(self.boundingRect())
+                source = QRectF(0, 0, target.width() / scale, target.height() / scale)
+                painter.drawPixmap(target, tile, source)
+
+
+class LatencyTable(QTableWidget):
+    """Debug panel: where the time of the last OCR jobs went, one row per section, newest on top."""
+    STAGES = ["total", "queue", "preprocess", "ocr.detect", "ocr.fast", "ocr.accurate", "parse"]
+    MAX_ROWS = 200
+
+    def __init__(self, parent=None):
+        super().__init__(0, 1 + len(self.STAGES), parent)
+        self.setHorizontalHeaderLabels(["Section"] + [f"{stage} (ms)" for stage in self.STAGES])
+        self.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.verticalHeader().hide()
+        self.setEditTriggers(QTableWidget.NoEditTriggers)
+
+    def add_timings(self, name, timings):
+        self.insertRow(0)
+        self.setItem(0, 0, QTableWidgetItem(name))
+        if "cache" in timings:
+            self.setItem(0, 1, QTableWidgetItem(f"{timings['cache'] * 1e3:.1f} (cache)"))
+        for column, stage in enumerate(self.STAGES, start=1):
+            if stage in timings:
+                item = QTableWidgetItem(f"{timings[stage] * 1e3:.1f}")
+                item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.setItem(0, column, item)
+        if self.rowCount() > self.MAX_ROWS:
+            self.removeRow(self.rowCount() - 1)
+
+
+class SectionOverview(QTextEdit):
+    """
+    Preview of all sections, every section in its own text frame. Updating a section replaces the text of
+    its frame only, the rest of the document is neither rebuilt nor laid out again. `show_details` shows a
+    single text instead, the next `set_sections` builds the overview again.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._frames = {}       # section id -> QTextFrame
+        self.showing_overview = False
+        self.setUndoRedoEnabled(False)      # Every update would stay on the undo stack otherwise
+
+    def set_sections(self, previews):
+        """Build the overview from (section id, text) pairs."""
+        self.clear()
+        self._frames = {}
+        self.showing_overview = True
+        cursor = QTextCursor(self.document())
+        cursor.beginEditBlock()     # Laid out once at the end, not after every frame
+        for section_id, text in previews:
+            self._frames[section_id] = cursor.insertFrame(QTextFrameFormat())
+            cursor.insertText(text)
+            cursor.movePosition(QTextCursor.End)
+        cursor.endEditBlock()
+
+    def update_section(self, section_id, text):
+        frame = self._frames.get(section_id)
+        if frame is None:
+            cursor = QTextCursor(self.document())
+            cursor.movePosition(QTextCursor.End)
+            self._frames[section_id] = frame = cursor.insertFrame(QTextFrameFormat())
+        cursor = frame.firstCursorPosition()
+        cursor.setPosition(frame.lastPosition(), QTextCursor.KeepAnchor)
+        cursor.insertText(text)
+
+    def remove_section(self, section_id):
+        frame = self._frames.pop(section_id, None)
+        if frame is not None:
+            cursor = QTextCursor(self.document())
+            cursor.setPosition(frame.firstPosition() - 1)       # The frame's boundaries go with its text
+            cursor.setPosition(frame.lastPosition() + 1, QTextCursor.KeepAnchor)
+            cursor.removeSelectedText()
+
+    def show_details(self, text):
+        self.setPlainText(text)
+        self._frames = {}
+        self.showing_overview = False
+
+
+class PageViewer(QGraphicsView):
+    """
+    Zoomable page view. The page is converted once, sections are separate overlay items, so adding one
+    does not touch the page pixels. Left drag selects a section, dragging the edge of a section resizes it,
+    Alt+drag inside a section moves it, Ctrl+wheel zooms, middle drag pans.
+    """
     section_selected = pyqtSignal(QRect)
+    selection_changing = pyqtSignal(QRect)      # Rubber band while a new section is drawn
+    section_resizing = pyqtSignal(int, QRect)     # Section id, rect while it is dragged
+    section_edited = pyqtSignal(int, QRect)       # Section id, rect once the drag is done
+    EDGE_TOLERANCE = 6      # Screen pixels around a section edge that grab it
+    EDGE_CURSORS = {"l": Qt.SizeHorCursor, "r": Qt.SizeHorCursor, "t": Qt.SizeVerCursor, "b": Qt.SizeVerCursor,
+                    "lt": Qt.SizeFDiagCursor, "rb": Qt.SizeFDiagCursor, "rt": Qt.SizeBDiagCursor,
+                    "lb": Qt.SizeBDiagCursor, "lrtb": Qt.SizeAllCursor}
 
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.begin = None
-        self.end = None
-        self.selected_rect = None
+        self.setScene(QGraphicsScene(self))
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+        self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
+        self.page_item = None
+        self.section_items = {}
+        self._rubber_band = None
+        self._begin = None
+        self._pan_start = None
+        self._edit = None       # (section id, edges, scene position at the press, rect at the press) while dragging
         self.setMouseTracking(True)
 
+    def set_page(self, image: np.ndarray):
+        self.scene().clear()
+        self.section_items = {}
+        self._edit = None
+        self.page_item = TiledPageItem(image)
+        self.scene().addItem(self.page_item)
+        self.setSceneRect(self.page_item.boundingRect())
+
+    def add_section(self, section_id, rect, color: QColor):
+        x, y, w, h = rect
+        item = self.scene().addRect(QRectF(x, y, w, h), QPen(Qt.NoPen), QBrush(color))
+        item.setZValue(1)
+        self.section_items[section_id] = item
+        return item
+
+    def remove_section(self, section_id):
+        item = self.section_items.pop(section_id, None)
+        if item is not None:
+            self.scene().removeItem(item)
+
+    def _edit_target(self, pos, move: bool = False):
+        """(section id, edges) grabbed at the view position `pos`, edges are some of "lrtb" ("lrtb" moves)."""
+        scene_pos = self.mapToScene(pos)
+        tolerance = self.EDGE_TOLERANCE / max(self.transform().m11(), 1e-6)
+        for section_id, item in self.section_items.items():
+            rect = item.rect()
+            if not rect.adjusted(-tolerance, -tolerance, tolerance, tolerance).contains(scene_pos):
+                continue
+            if move:
+                return section_id, "lrtb"
+            edges = ""
+            if abs(scene_pos.x() - rect.left()) <= tolerance:
+                edges += "l"
+            elif abs(scene_pos.x() - rect.right()) <= tolerance:
+                edges += "r"
+            if abs(scene_pos.y() - rect.top()) <= tolerance:
+                edges += "t"
+            elif abs(scene_pos.y() - rect.bottom()) <= tolerance:
+                edges += "b"
+            if edges:
+                return section_id, edges
+        return None
+
+    def _edited_rect(self, pos) -> QRectF:
+        _, edges, start, rect = self._edit
+        delta = self.mapToScene(pos) - start
+        rect = QRectF(rect)
+        if "l" in edges:
+            rect.setLeft(rect.left() + delta.x())
+        if "r" in edges:
+            rect.setRight(rect.right() + delta.x())
+        if "t" in edges:
+            rect.setTop(rect.top() + delta.y())
+        if "b" in edges:
+            rect.setBottom(rect.bottom() + delta.y())
+        return rect.normalized().intersected(self.page_item.boundingRect())
+
+    def wheelEvent(self, event):
+        if event.modifiers() & Qt.ControlModifier:
+            factor = 1.25 if event.angleDelta().y() > 0 else 0.8
+            self.scale(factor, factor)
+        else:
+            super().wheelEvent(event)
+
     def mousePressEvent(self, event):
-        self.begin = event.pos()
-        self.end = event.pos()
-        self.selected_rect = None
-        self.update()
+        if event.button() == Qt.MiddleButton:
+            self._pan_start = event.pos()
+            self.setCursor(Qt.ClosedHandCursor)
+        elif (event.button() == Qt.LeftButton and self.page_item is not None and
+              self._edit_target(event.pos(), bool(event.modifiers() & Qt.AltModifier)) is not None):
+            section_id, edges = self._edit_target(event.pos(), bool(event.modifiers() & Qt.AltModifier))
+            self._edit = (section_id, edges, self.mapToScene(event.pos()), self.section_items[section_id].rect())
+        elif event.button() == Qt.LeftButton and self.page_item is not None:
+            self._begin = self.mapToScene(event.pos())
+            pen = QPen(Qt.red, 2, Qt.SolidLine)
+            pen.setCosmetic(True)   # Same width at every zoom level
+            self._rubber_band = self.scene().addRect(QRectF(self._begin, self._begin), pen)
+            self._rubber_band.setZValue(2)
+        else:
+            super().mousePressEvent(event)
 
     def mouseMoveEvent(self, event):
-        if self.begin:
-            self.end = event.pos()
-            self.update()
+        if self._pan_start is not None:
+            delta = event.pos() - self._pan_start
+            self._pan_start = event.pos()
+            self.horizontalScrollBar().setValue(self.horizontalScrollBar().value() - delta.x())
+            self.verticalScrollBar().setValue(self.verticalScrollBar().value() - delta.y())
+        elif self._rubber_band is not None:
+            self._rubber_band.setRect(QRectF(self._begin, self.mapToScene(event.pos())).normalized())
+            self.selection_changing.emit(self._rubber_band.rect().toRect())
+        elif self._edit is not None:
+            item, rect = self.section_items.get(self._edit[0]), self._edited_rect(event.pos())
+            if item is not None and rect.width() >= 1 and rect.height() >= 1:
+                item.setRect(rect)
+                self.section_resizing.emit(self._edit[0], rect.toRect())
+        else:
+            target = self._edit_target(event.pos(), bool(event.modifiers() & Qt.AltModifier))
+            if target is None:
+                self.unsetCursor()
+            else:
+                self.setCursor(self.EDGE_CURSORS[target[1]])
+            super().mouseMoveEvent(event)
 
     def mouseReleaseEvent(self, event):
-        self.end = event.pos()
-        self.selected_rect = QRect(self.begin, self.end).normalized()
-        self.section_selected.emit(self.selected_rect)
-        self.begin = None
-        self.end = None
-        self.update()
-
-    def paintEvent(self, event):
-        super().paintEvent(event)
-        painter = QPainter(self)
-        painter.setPen(QPen(Qt.red, 2, Qt.SolidLine))
-        
-        if self.begin and self.end:
-            painter.drawRect(QRect(self.begin, self.end).normalized())
-        
-        if self.selected_rect:
-            painter.drawRect(self.selected_rect)
+        if self._pan_start is not None and event.button() == Qt.MiddleButton:
+            self._pan_start = None
+            self.unsetCursor()
+        elif self._rubber_band is not None and event.button() == Qt.LeftButton:
+            rect = self._rubber_band.rect().intersected(self.page_item.boundingRect()).toRect()
+            self.scene().removeItem(self._rubber_band)
+            self._rubber_band = None
+            self._begin = None
+            if rect.width() > 0 and rect.height() > 0:
+                self.section_selected.emit(rect)
+        elif self._edit is not None and event.button() == Qt.LeftButton:
+            section_id, item = self._edit[0], self.section_items.get(self._edit[0])
+            self._edit = None
+            if item is not None:
+                self.section_edited.emit(section_id, item.rect().toRect())
+        else:
+            super().mouseReleaseEvent(event)